@@ -8,7 +8,7 @@ from config import Config
 from extensions import init_extensions, login_manager, Session
 from routes import register_blueprints
 from models import User
-from services import project_store
+from services import auth_cache, project_store
 
 
 def create_app():
@@ -19,12 +19,7 @@ def create_app():
 
     @login_manager.user_loader
     def load_user(user_id):
-        db = Session()
-        try:
-            user = db.query(User).filter_by(id=user_id, is_active=True).first()
-            return user
-        finally:
-            Session.remove()
+        return auth_cache.load_user(user_id)
 
     register_blueprints(app)
 
@@ -31,8 +31,21 @@ class Config:
     RQ_PHOTO_QUEUE =      os.getenv("RQ_PHOTO_QUEUE", "kiroku_photos")
     RQ_LLM_QUEUE =        os.getenv("RQ_LLM_QUEUE", "kiroku_llm")
     RQ_QUEUE_NAME =       os.getenv("RQ_QUEUE_NAME", RQ_LLM_QUEUE)
+    # fork (un proceso por job) | preload (SimpleWorker con clientes calientes)
+    WORKER_MODE =         os.getenv("WORKER_MODE", "fork")
+    # Slots por cola en un solo proceso, ej. "transcribe=8,photos=4,llm=2"
+    WORKER_SLOTS =           os.getenv("WORKER_SLOTS", "")
+    WORKER_REPORT_INTERVAL = int(os.getenv("WORKER_REPORT_INTERVAL", "60"))
+    # Jobs de transcripción que se dejan pasar a RQ a la vez (round-robin entre
+    # proyectos); conviene >= slots de transcripción
+    FAIR_QUEUE_DEPTH =       int(os.getenv("FAIR_QUEUE_DEPTH", "8"))
+    # Fracción máxima de los slots de una cola que pueden estar con jobs bulk
+    BULK_MAX_SLOT_SHARE =  float(os.getenv("BULK_MAX_SLOT_SHARE", "0.5"))
 
     SESSION_LIFETIME_DAYS = int(os.getenv("SESSION_LIFETIME_DAYS", "1"))
+    # Cache de usuario/sesión en Redis; last_seen_at se baja a Postgres en lote
+    AUTH_CACHE_TTL_SECONDS =         int(os.getenv("AUTH_CACHE_TTL_SECONDS", "30"))
+    SESSION_FLUSH_INTERVAL_SECONDS = int(os.getenv("SESSION_FLUSH_INTERVAL_SECONDS", "60"))
 
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SECURE =   os.getenv("COOKIE_SECURE", "0") == "1"
@@ -40,6 +53,16 @@ class Config:
 
     DATA_DIR = os.path.abspath(os.getenv("DATA_DIR", "data"))
     RETENTION_DAYS =       int(os.getenv("RETENTION_DAYS", "90"))
+    # Borrado de vencidos por lotes; lo que no alcanza en el presupuesto
+    # queda para la próxima corrida
+    RETENTION_BATCH_SIZE =          int(os.getenv("RETENTION_BATCH_SIZE", "100"))
+    RETENTION_FILE_WORKERS =        int(os.getenv("RETENTION_FILE_WORKERS", "8"))
+    RETENTION_TIME_BUDGET_SECONDS = int(os.getenv("RETENTION_TIME_BUDGET_SECONDS", "600"))
+    # Un solo worker limpia a la vez; el lease se renueva mientras corre
+    RETENTION_LEASE_SECONDS =       int(os.getenv("RETENTION_LEASE_SECONDS", "120"))
+    # Los eventos crudos solo alimentan event_counts_hourly; el rollup vive más
+    EVENT_RAW_RETENTION_DAYS =    int(os.getenv("EVENT_RAW_RETENTION_DAYS", "7"))
+    EVENT_ROLLUP_RETENTION_DAYS = int(os.getenv("EVENT_ROLLUP_RETENTION_DAYS", "730"))
     AUDIO_STORAGE_BACKEND =    os.getenv("AUDIO_STORAGE_BACKEND", "disk")
     S3_AUDIO_BUCKET =          os.getenv("S3_AUDIO_BUCKET", "")
     S3_AUDIO_PREFIX =          os.getenv("S3_AUDIO_PREFIX", "audio")
@@ -57,6 +80,11 @@ class Config:
     PHOTO_JOB_TIMEOUT =       int(os.getenv("PHOTO_JOB_TIMEOUT", "300"))
     LLM_JOB_TIMEOUT =         int(os.getenv("LLM_JOB_TIMEOUT", "600"))
     PREPARE_PROJECT_TIMEOUT = int(os.getenv("PREPARE_PROJECT_TIMEOUT", "300"))
+    # Estilizado por proyecto: hilos por job, reintentos por foto (dentro de
+    # PHOTO_JOB_TIMEOUT) y techo del job_timeout del lote
+    PHOTO_STYLIZE_CONCURRENCY = int(os.getenv("PHOTO_STYLIZE_CONCURRENCY", "4"))
+    PHOTO_STYLIZE_RETRIES =     int(os.getenv("PHOTO_STYLIZE_RETRIES", "2"))
+    PHOTO_BATCH_MAX_TIMEOUT =   int(os.getenv("PHOTO_BATCH_MAX_TIMEOUT", "1800"))
 
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
     LLM_MODEL =      os.getenv("LLM_MODEL", "gpt-4o-mini")
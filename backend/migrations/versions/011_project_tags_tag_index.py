@@ -0,0 +1,50 @@
+"""index project_tags by tag_id
+
+Revision ID: 011_project_tags_tag_index
+Revises: 010_drop_llm_cost_columns
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "011_project_tags_tag_index"
+down_revision = "010_drop_llm_cost_columns"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Las tablas de tags no tenían migración propia: en una base creada solo
+    # con alembic no existen todavía. Se crean acá igual que en models/tags.py.
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if "user_tags" not in tables:
+        op.create_table(
+            "user_tags",
+            sa.Column("id", sa.Integer(), primary_key=True, autoincrement=True),
+            sa.Column("user_id", postgresql.UUID(as_uuid=True),
+                      sa.ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+            sa.Column("name", sa.String(length=50), nullable=False),
+            sa.Column("created_at", sa.DateTime(timezone=True), nullable=True)
+        )
+        op.create_index("ix_user_tags_user_id", "user_tags", ["user_id"])
+    if "project_tags" not in tables:
+        op.create_table(
+            "project_tags",
+            sa.Column("project_id", postgresql.UUID(as_uuid=True),
+                      sa.ForeignKey("projects.id", ondelete="CASCADE"), primary_key=True),
+            sa.Column("tag_id", sa.Integer(),
+                      sa.ForeignKey("user_tags.id", ondelete="CASCADE"), primary_key=True),
+            sa.Column("created_at", sa.DateTime(timezone=True), nullable=True)
+        )
+
+    # La PK es (project_id, tag_id): sirve para buscar por proyecto, no por
+    # tag. Los conteos por tag y el filtro por tag necesitan este índice.
+    op.create_index("ix_project_tags_tag_id", "project_tags", ["tag_id"], if_not_exists=True)
+
+
+def downgrade():
+    # Las tablas quedan: pueden venir de antes de esta migración
+    op.drop_index("ix_project_tags_tag_id", table_name="project_tags", if_exists=True)
@@ -0,0 +1,27 @@
+"""composite index for keyset pagination of projects
+
+Revision ID: 012_projects_user_created_index
+Revises: 011_project_tags_tag_index
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "012_projects_user_created_index"
+down_revision = "011_project_tags_tag_index"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_projects_user_created",
+        "projects",
+        ["user_id", sa.text("created_at DESC"), sa.text("id DESC")]
+    )
+
+
+def downgrade():
+    op.drop_index("ix_projects_user_created", table_name="projects")
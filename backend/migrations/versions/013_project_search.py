@@ -0,0 +1,61 @@
+"""trigram and full-text search indexes for projects and transcripts
+
+Revision ID: 013_project_search
+Revises: 012_projects_user_created_index
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "013_project_search"
+down_revision = "012_projects_user_created_index"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+    # ILIKE '%q%' sobre título/participante puede usar estos índices
+    op.create_index(
+        "ix_projects_title_trgm",
+        "projects",
+        ["title"],
+        postgresql_using="gin",
+        postgresql_ops={"title": "gin_trgm_ops"}
+    )
+    op.create_index(
+        "ix_project_states_participant_trgm",
+        "project_states",
+        ["participant_name"],
+        postgresql_using="gin",
+        postgresql_ops={"participant_name": "gin_trgm_ops"}
+    )
+
+    # El transcript de finalize es la concatenación de los segmentos; indexar
+    # por segmento permite devolver en qué momento se dijo algo.
+    op.add_column(
+        "project_segments",
+        sa.Column(
+            "search_vector",
+            postgresql.TSVECTOR(),
+            sa.Computed("to_tsvector('spanish'::regconfig, coalesce(text, ''))", persisted=True),
+            nullable=True
+        )
+    )
+    op.create_index(
+        "ix_project_segments_search_vector",
+        "project_segments",
+        ["search_vector"],
+        postgresql_using="gin"
+    )
+
+
+def downgrade():
+    op.drop_index("ix_project_segments_search_vector", table_name="project_segments")
+    op.drop_column("project_segments", "search_vector")
+    op.drop_index("ix_project_states_participant_trgm", table_name="project_states")
+    op.drop_index("ix_projects_title_trgm", table_name="projects")
@@ -0,0 +1,71 @@
+"""typed processing stats per finished project
+
+Revision ID: 014_project_processing_stats
+Revises: 013_project_search
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "014_project_processing_stats"
+down_revision = "013_project_search"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "project_processing_stats",
+        sa.Column("id", sa.BigInteger(), primary_key=True, autoincrement=True),
+        sa.Column("project_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("user_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("finished_at", sa.DateTime(timezone=True), nullable=False,
+                  server_default=sa.text("timezone('utc', now())")),
+        sa.Column("total_time", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("transcription_time", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("stylize_time", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("llm_time", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("segment_count", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("photo_count", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("photos_processed", sa.Integer(), nullable=False, server_default="0"),
+        sa.UniqueConstraint("project_id", name="uq_project_processing_stats_project")
+    )
+    op.create_index(
+        "ix_project_processing_stats_finished_at",
+        "project_processing_stats",
+        ["finished_at"]
+    )
+
+    # Backfill desde el JSONB de los proyectos que ya terminaron
+    op.execute("""
+        INSERT INTO project_processing_stats (
+            project_id, user_id, finished_at, total_time, transcription_time,
+            stylize_time, llm_time, segment_count, photo_count, photos_processed
+        )
+        SELECT
+            p.id,
+            p.user_id,
+            coalesce(p.updated_at, p.created_at),
+            coalesce((s.processing_metrics->>'total_time')::float, 0),
+            coalesce((s.processing_metrics->>'avg_transcription_time')::float, 0),
+            coalesce((s.processing_metrics->>'avg_stylize_time')::float, 0),
+            coalesce((s.processing_metrics->>'llm_time')::float, 0),
+            coalesce((s.processing_metrics->>'chunks_total')::int, 0),
+            coalesce((s.processing_metrics->>'photos_total')::int, 0),
+            coalesce((s.processing_metrics->>'photos_processed')::int, 0)
+        FROM projects p
+        JOIN project_states s ON s.project_id = p.id
+        WHERE p.status = 'done' AND s.processing_metrics IS NOT NULL
+        ON CONFLICT (project_id) DO NOTHING
+    """)
+
+
+def downgrade():
+    op.drop_index(
+        "ix_project_processing_stats_finished_at",
+        table_name="project_processing_stats"
+    )
+    op.drop_table("project_processing_stats")
@@ -0,0 +1,41 @@
+"""hourly rollup of project and photo events
+
+Revision ID: 015_event_counts_hourly
+Revises: 014_project_processing_stats
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "015_event_counts_hourly"
+down_revision = "014_project_processing_stats"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "event_counts_hourly",
+        sa.Column("kind", sa.String(length=32), primary_key=True),
+        sa.Column("hour", sa.DateTime(timezone=True), primary_key=True),
+        sa.Column("count", sa.Integer(), nullable=False, server_default="0")
+    )
+
+    op.execute("""
+        INSERT INTO event_counts_hourly (kind, hour, count)
+        SELECT 'project', date_trunc('hour', created_at), count(*)
+        FROM project_events
+        GROUP BY 2
+    """)
+    op.execute("""
+        INSERT INTO event_counts_hourly (kind, hour, count)
+        SELECT 'photo', date_trunc('hour', created_at), count(*)
+        FROM photo_events
+        GROUP BY 2
+    """)
+
+
+def downgrade():
+    op.drop_table("event_counts_hourly")
@@ -0,0 +1,33 @@
+"""version counters for persisted quota usage
+
+Revision ID: 016_user_quota_versions
+Revises: 015_event_counts_hourly
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "016_user_quota_versions"
+down_revision = "015_event_counts_hourly"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Cada cambio de cuota en Redis sube la versión; persistir solo escribe
+    # si trae una más nueva que la guardada
+    op.add_column(
+        "users",
+        sa.Column("stylize_quota_version", sa.BigInteger(), nullable=False, server_default="0")
+    )
+    op.add_column(
+        "users",
+        sa.Column("recording_quota_version", sa.BigInteger(), nullable=False, server_default="0")
+    )
+
+
+def downgrade():
+    op.drop_column("users", "recording_quota_version")
+    op.drop_column("users", "stylize_quota_version")
@@ -8,6 +8,8 @@ from .project import (
     ProjectPhoto,
     ProjectEvent,
     PhotoEvent,
+    ProjectProcessingStats,
+    EventCountHourly,
 )
 from .tags import UserTag, ProjectTag
 from .audit import AuditLog, log_audit, log_audit_for_request
@@ -24,6 +26,8 @@ __all__ = [
     "ProjectPhoto",
     "ProjectEvent",
     "PhotoEvent",
+    "ProjectProcessingStats",
+    "EventCountHourly",
     "UserTag",
     "ProjectTag",
     "AuditLog",
@@ -4,15 +4,18 @@ from sqlalchemy import (
     BigInteger,
     Boolean,
     Column,
+    Computed,
     DateTime,
+    Float,
     ForeignKey,
+    Index,
     Integer,
     Numeric,
     String,
     Text,
     UniqueConstraint
 )
-from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR, UUID
 from sqlalchemy.orm import relationship
 
 from .base import Base, utcnow
@@ -48,6 +51,15 @@ class Project(Base):
         return f"<Project {self.id} user={self.user_id} status={self.status}>"
 
 
+# Listado de proyectos por usuario con paginación keyset (created_at, id)
+Index(
+    "ix_projects_user_created",
+    Project.user_id,
+    Project.created_at.desc(),
+    Project.id.desc()
+)
+
+
 class ProjectState(Base):
     __tablename__ = "project_states"
 
@@ -102,6 +114,10 @@ class ProjectSegment(Base):
     status = Column(String(32), nullable=False, default="pending")
     text = Column(Text, nullable=True)
     transcription_time = Column(Numeric(10, 4), nullable=True)
+    search_vector = Column(
+        TSVECTOR,
+        Computed("to_tsvector('spanish'::regconfig, coalesce(text, ''))", persisted=True)
+    )
     created_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
     updated_at = Column(DateTime(timezone=True), default=utcnow, onupdate=utcnow, nullable=False)
 
@@ -181,3 +197,41 @@ class PhotoEvent(Base):
 
     def __repr__(self):
         return f"<PhotoEvent {self.id} project={self.project_id}>"
+
+
+class EventCountHourly(Base):
+    """Conteo por hora de project_events/photo_events (kind: project|photo)."""
+    __tablename__ = "event_counts_hourly"
+
+    kind = Column(String(32), primary_key=True)
+    hour = Column(DateTime(timezone=True), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<EventCountHourly {self.kind} {self.hour} count={self.count}>"
+
+
+class ProjectProcessingStats(Base):
+    """
+    Métricas tipadas de cada proyecto terminado. Sin FK a projects a
+    propósito: los gráficos del admin sobreviven a la retención.
+    """
+    __tablename__ = "project_processing_stats"
+    __table_args__ = (
+        UniqueConstraint("project_id", name="uq_project_processing_stats_project"),
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    project_id = Column(UUID(as_uuid=True), nullable=False)
+    user_id = Column(UUID(as_uuid=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), default=utcnow, nullable=False, index=True)
+    total_time = Column(Float, nullable=False, default=0.0)
+    transcription_time = Column(Float, nullable=False, default=0.0)
+    stylize_time = Column(Float, nullable=False, default=0.0)
+    llm_time = Column(Float, nullable=False, default=0.0)
+    segment_count = Column(Integer, nullable=False, default=0)
+    photo_count = Column(Integer, nullable=False, default=0)
+    photos_processed = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<ProjectProcessingStats project={self.project_id}>"
@@ -40,7 +40,8 @@ class ProjectTag(Base):
     tag_id = Column(
         Integer,
         ForeignKey("user_tags.id", ondelete="CASCADE"),
-        primary_key=True
+        primary_key=True,
+        index=True
     )
     created_at = Column(DateTime(timezone=True), default=utcnow)
 
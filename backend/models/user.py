@@ -2,6 +2,7 @@ import uuid
 
 from flask_login import UserMixin
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
     DateTime,
@@ -36,6 +37,9 @@ class User(Base, UserMixin):
     recording_seconds_used = Column(Integer, default=0, nullable=False)
     recording_window_days = Column(Integer, nullable=True)
     recording_window_started_at = Column(DateTime(timezone=True), nullable=True)
+    # Versión del último contador bajado desde Redis (services/quotas.py)
+    stylize_quota_version = Column(BigInteger, default=0, nullable=False)
+    recording_quota_version = Column(BigInteger, default=0, nullable=False)
 
     created_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
     updated_at = Column(DateTime(timezone=True), default=utcnow, onupdate=utcnow)
@@ -16,12 +16,23 @@ from models import (
     UserSession,
     AuditLog,
     Project,
-    ProjectEvent,
-    PhotoEvent,
+    ProjectPhoto,
+    ProjectProcessingStats,
+    ProjectSegment,
+    ProjectState,
     log_audit,
     utcnow
 )
-from services import project_store, retention, timeline
+from services import (
+    auth_cache,
+    event_rollup,
+    project_store,
+    quotas,
+    retention,
+    session_activity
+)
+from services.jobs import orchestrator
+from services.queue import LANE_BULK
 
 
 admin_bp = Blueprint("admin", __name__)
@@ -86,41 +97,51 @@ def admin_overview():
         )
 
         active_users = db.query(User).filter_by(is_active=True).count()
-        connected_users = (
-            db.query(UserSession.user_id)
-            .filter(UserSession.revoked_at.is_(None))
-            .filter(UserSession.expires_at > now)
-            .filter(UserSession.last_seen_at >= ten_min_ago)
-            .distinct()
-            .count()
-        )
+        connected_users = session_activity.count_connected_users()
+        if connected_users is None:
+            connected_users = (
+                db.query(UserSession.user_id)
+                .filter(UserSession.revoked_at.is_(None))
+                .filter(UserSession.expires_at > now)
+                .filter(UserSession.last_seen_at >= ten_min_ago)
+                .distinct()
+                .count()
+            )
 
-        active_projects = (
-            db.query(Project)
-            .filter(Project.status.in_(["queued", "processing"]))
-            .all()
-        )
+        active_filter = Project.status.in_(["queued", "processing"])
+        projects_active = (
+            db.query(func.count(Project.id))
+            .filter(active_filter)
+            .scalar()
+        ) or 0
         projects_error = db.query(Project).filter(Project.status == "error").count()
 
-        segments_pending = 0
-        photos_pending = 0
-        for project in active_projects:
-            project_id = str(project.id)
-            state = project_store.load_state(project_id) or {}
-            segments = state.get("segments") or {}
-            for segment in segments.values():
-                if segment.get("status") != "done":
-                    segments_pending += 1
-            if state.get("stylize_photos", True):
-                photos = timeline.get_photos(project_id)
-                for photo in photos:
-                    if not photo.get("stylized_path"):
-                        photos_pending += 1
+        segments_pending = (
+            db.query(func.count(ProjectSegment.id))
+            .join(Project, Project.id == ProjectSegment.project_id)
+            .filter(active_filter)
+            .filter(ProjectSegment.status != "done")
+            .scalar()
+        ) or 0
+        photos_pending = (
+            db.query(func.count(ProjectPhoto.id))
+            .join(Project, Project.id == ProjectPhoto.project_id)
+            .join(ProjectState, ProjectState.project_id == ProjectPhoto.project_id)
+            .filter(active_filter)
+            .filter(ProjectState.stylize_photos.is_(True))
+            .filter(or_(
+                ProjectPhoto.stylized_path.is_(None),
+                ProjectPhoto.stylized_path == ""
+            ))
+            .scalar()
+        ) or 0
 
         return jsonify({
             "ok": True,
             "stats": {
-                "projects_active": len(active_projects),
+                "active_users": active_users,
+                "connected_users": connected_users,
+                "projects_active": projects_active,
                 "projects_error": projects_error,
                 "segments_pending": segments_pending,
                 "photos_pending": photos_pending
@@ -148,52 +169,28 @@ def admin_projects_hourly():
 
     day_end = day_start + timedelta(days=1)
 
-    db = Session()
-    try:
-        project_rows = (
-            db.query(
-                func.date_trunc("hour", ProjectEvent.created_at).label("hour"),
-                func.count(ProjectEvent.id)
-            )
-            .filter(ProjectEvent.created_at >= day_start)
-            .filter(ProjectEvent.created_at < day_end)
-            .group_by("hour")
-            .order_by("hour")
-            .all()
-        )
-        photo_rows = (
-            db.query(
-                func.date_trunc("hour", PhotoEvent.created_at).label("hour"),
-                func.count(PhotoEvent.id)
-            )
-            .filter(PhotoEvent.created_at >= day_start)
-            .filter(PhotoEvent.created_at < day_end)
-            .group_by("hour")
-            .order_by("hour")
-            .all()
-        )
+    project_map = event_rollup.hourly_counts("project", day_start, day_end)
+    photo_map = event_rollup.hourly_counts("photo", day_start, day_end)
+    hours = []
+    project_counts = []
+    photo_counts = []
+    cursor = day_start
+    while cursor < day_end:
+        label = cursor.strftime("%H:%M")
+        hours.append(label)
+        project_counts.append(int(project_map.get(cursor, 0)))
+        photo_counts.append(int(photo_map.get(cursor, 0)))
+        cursor += timedelta(hours=1)
 
-        project_map = {row[0]: row[1] for row in project_rows}
-        photo_map = {row[0]: row[1] for row in photo_rows}
-        hours = []
-        project_counts = []
-        photo_counts = []
-        cursor = day_start
-        while cursor < day_end:
-            label = cursor.strftime("%H:%M")
-            hours.append(label)
-            project_counts.append(int(project_map.get(cursor, 0)))
-            photo_counts.append(int(photo_map.get(cursor, 0)))
-            cursor += timedelta(hours=1)
+    return jsonify({
+        "ok": True,
+        "hours": hours,
+        "project_counts": project_counts,
+        "photo_counts": photo_counts
+    })
 
-        return jsonify({
-            "ok": True,
-            "hours": hours,
-            "project_counts": project_counts,
-            "photo_counts": photo_counts
-        })
-    finally:
-        Session.remove()
+
+PROCESSING_HISTORY_MAX_HOURS = 30 * 24
 
 
 @admin_bp.route("/api/admin/overview/processing-history", methods=["GET"])
@@ -201,83 +198,103 @@ def admin_projects_hourly():
 @login_required
 @admin_required
 def admin_processing_history():
+    hours_value, error = _parse_optional_int(request.args.get("hours"), "hours")
+    if error:
+        return jsonify({"ok": False, "error": error}), 400
+    boundary_hours = max(1, min(hours_value or 24, PROCESSING_HISTORY_MAX_HOURS))
+
+    # Hasta 2 días se agrupa por hora; más que eso, por día
+    if boundary_hours <= 48:
+        unit, step, label_fmt = "hour", timedelta(hours=1), "%H:00"
+    else:
+        unit, step, label_fmt = "day", timedelta(days=1), "%Y-%m-%d"
+
     db = Session()
     try:
-        boundary_hours = 24
         now = utcnow()
-        start = now - timedelta(hours=boundary_hours)
-
-        projects = (
-            db.query(Project)
-            .filter(Project.status == "done")
-            .filter(Project.updated_at >= start)
+        # Rango semiabierto [start, end) de buckets enteros que termina con el
+        # actual: 24 horas son 24 buckets
+        if unit == "hour":
+            end = now.replace(minute=0, second=0, microsecond=0) + step
+            start = end - timedelta(hours=boundary_hours)
+        else:
+            end = now.replace(hour=0, minute=0, second=0, microsecond=0) + step
+            start = end - step * ((boundary_hours + 23) // 24)
+
+        # En UTC, no en la zona horaria de la sesión de la base
+        bucket = func.date_trunc(
+            unit,
+            func.timezone("UTC", ProjectProcessingStats.finished_at)
+        ).label("bucket")
+        total_time = ProjectProcessingStats.total_time
+        rows = (
+            db.query(
+                bucket,
+                func.count(ProjectProcessingStats.id),
+                func.avg(total_time),
+                func.percentile_cont(0.5).within_group(total_time),
+                func.percentile_cont(0.95).within_group(total_time),
+                func.avg(ProjectProcessingStats.transcription_time),
+                func.avg(ProjectProcessingStats.stylize_time),
+                func.avg(ProjectProcessingStats.llm_time)
+            )
+            .filter(ProjectProcessingStats.finished_at >= start)
+            .filter(ProjectProcessingStats.finished_at < end)
+            .group_by(bucket)
+            .order_by(bucket)
             .all()
         )
+        by_bucket = {row[0].replace(tzinfo=timezone.utc): row[1:] for row in rows}
 
-        hourly_buckets = {}
-        for offset in range(boundary_hours):
-            bucket_time = start + timedelta(hours=offset)
-            key = bucket_time.strftime("%H:00")
-            hourly_buckets[key] = {
-                "total": [],
-                "transcription": [],
-                "stylize": []
-            }
-
-        for project in projects:
-            state = project_store.load_state(str(project.id)) or {}
-            metrics = state.get("processing_metrics")
-            if not metrics:
-                continue
-
-            updated_at = project.updated_at or now
-            key = updated_at.strftime("%H:00")
-            bucket = hourly_buckets.get(key)
-            if not bucket:
-                continue
-
-            bucket["total"].append(metrics.get("total_time", 0))
-            bucket["transcription"].append(metrics.get("avg_transcription_time", 0))
-            bucket["stylize"].append(metrics.get("avg_stylize_time", 0))
+        def _round(value):
+            return round(float(value), 2) if value is not None else 0.0
 
         labels = []
         pipeline_times = []
+        pipeline_p50 = []
+        pipeline_p95 = []
         segment_times = []
         photo_times = []
+        llm_times = []
+        projects_count = 0
 
-        def _avg(values):
-            return round(sum(values) / len(values), 2) if values else 0.0
-
-        for offset in range(boundary_hours):
-            bucket_time = start + timedelta(hours=offset)
-            key = bucket_time.strftime("%H:00")
-            bucket = hourly_buckets[key]
-
-            labels.append(key)
-            pipeline_times.append(_avg(bucket["total"]))
-            segment_times.append(_avg(bucket["transcription"]))
-            photo_times.append(_avg(bucket["stylize"]))
+        cursor = start
+        while cursor < end:
+            count, avg_total, p50, p95, avg_transcription, avg_stylize, avg_llm = (
+                by_bucket.get(cursor) or (0, None, None, None, None, None, None)
+            )
+            projects_count += int(count or 0)
+            labels.append(cursor.strftime(label_fmt))
+            pipeline_times.append(_round(avg_total))
+            pipeline_p50.append(_round(p50))
+            pipeline_p95.append(_round(p95))
+            segment_times.append(_round(avg_transcription))
+            photo_times.append(_round(avg_stylize))
+            llm_times.append(_round(avg_llm))
+            cursor += step
 
         date_info = {
             "start": start.strftime("%Y-%m-%d %H:%M"),
             "end": now.strftime("%Y-%m-%d %H:%M"),
-            "projects_count": len(projects)
+            "projects_count": projects_count,
+            "bucket": unit
         }
 
         return jsonify({
             "ok": True,
             "labels": labels,
             "pipeline_times": pipeline_times,
+            "pipeline_p50": pipeline_p50,
+            "pipeline_p95": pipeline_p95,
             "segment_times": segment_times,
             "photo_times": photo_times,
+            "llm_times": llm_times,
             "date_info": date_info
         })
     finally:
         Session.remove()
 
 
-
-
 @admin_bp.route("/api/admin/users", methods=["GET"])
 @login_required
 @admin_required
@@ -456,6 +473,7 @@ def reset_user_password(user_id):
             user_agent=request.user_agent.string
         )
         db.commit()
+        auth_cache.invalidate_user(user.id)
 
         return jsonify({
             "ok": True,
@@ -497,6 +515,8 @@ def deactivate_user(user_id):
             user_agent=request.user_agent.string
         )
         db.commit()
+        auth_cache.invalidate_user(user.id)
+        auth_cache.invalidate_user_sessions(db, user.id)
 
         return jsonify({"ok": True})
     finally:
@@ -527,6 +547,7 @@ def activate_user(user_id):
             user_agent=request.user_agent.string
         )
         db.commit()
+        auth_cache.invalidate_user(user.id)
 
         return jsonify({"ok": True})
     finally:
@@ -559,6 +580,7 @@ def delete_user(user_id):
                     f"No se pudo eliminar proyecto {project_id}: {e}"
                 )
 
+        auth_cache.invalidate_user_sessions(db, user.id)
         db.query(UserSession).filter_by(user_id=user.id).delete()
 
         log_audit(
@@ -575,6 +597,7 @@ def delete_user(user_id):
         )
         db.delete(user)
         db.commit()
+        auth_cache.invalidate_user(user_id)
 
         return jsonify({"ok": True})
     finally:
@@ -624,6 +647,11 @@ def list_sessions():
             .limit(limit_value)
             .all()
         )
+        # Postgres puede ir hasta un intervalo de flush atrasado
+        fresh_seen = session_activity.get_last_seen([session.id for session, _ in rows])
+
+        def last_seen(session):
+            return max(session.last_seen_at, fresh_seen.get(str(session.id), session.last_seen_at))
 
         return jsonify({
             "ok": True,
@@ -633,11 +661,11 @@ def list_sessions():
                     "user_id": str(session.user_id),
                     "username": username,
                     "created_at": session.created_at.isoformat(),
-                    "last_seen_at": session.last_seen_at.isoformat(),
+                    "last_seen_at": last_seen(session).isoformat(),
                     "expires_at": session.expires_at.isoformat(),
                     "ip": session.ip,
                     "user_agent": session.user_agent,
-                    "is_connected": session.last_seen_at >= ten_min_ago
+                    "is_connected": last_seen(session) >= ten_min_ago
                 }
                 for session, username in rows
             ],
@@ -670,6 +698,7 @@ def revoke_session(session_id):
             user_agent=request.user_agent.string
         )
         db.commit()
+        auth_cache.invalidate_session(session_record.id)
 
         return jsonify({"ok": True})
     finally:
@@ -776,6 +805,52 @@ def clear_audit_logs():
         Session.remove()
 
 
+@admin_bp.route("/api/admin/project/<project_id>/reprocess", methods=["POST"])
+@login_required
+@admin_required
+def reprocess_project(project_id):
+    if not is_valid_uuid(project_id):
+        return jsonify({"ok": False, "error": "project_id inválido"}), 400
+
+    project = project_store.get_project_record(project_id)
+    if not project:
+        return jsonify({"ok": False, "error": "Proyecto no encontrado"}), 404
+
+    # Los proyectos terminados ya no tienen audio ni segmentos en disco
+    if project.status != "error":
+        return jsonify({
+            "ok": False,
+            "error": "Solo se pueden reprocesar proyectos con error"
+        }), 400
+
+    # Va por la lane bulk para no competir con grabaciones recién terminadas
+    job = orchestrator.enqueue_processing_pipeline(project_id, lane=LANE_BULK)
+
+    db = Session()
+    try:
+        log_audit(
+            db,
+            action="admin_reprocess_project",
+            actor_user_id=current_user.id,
+            target_user_id=project.user_id,
+            details={"project_id": project_id, "job_id": job.id},
+            ip=_client_ip(),
+            user_agent=request.user_agent.string
+        )
+        db.commit()
+    finally:
+        Session.remove()
+
+    return jsonify({"ok": True, "job_id": job.id})
+
+
+@admin_bp.route("/api/admin/retention", methods=["GET"])
+@login_required
+@admin_required
+def retention_status():
+    return jsonify({"ok": True, "retention": retention.get_status()})
+
+
 @admin_bp.route("/api/admin/cleanup-events", methods=["POST"])
 @login_required
 @admin_required
@@ -818,6 +893,7 @@ def update_user_flags(user_id):
 
     db = Session()
     try:
+        quotas.flush_user(user_id)
         user = db.query(User).filter_by(id=user_id).first()
         if not user:
             return jsonify({"ok": False, "error": "Usuario no encontrado"}), 404
@@ -853,6 +929,7 @@ def update_user_flags(user_id):
             user_agent=request.user_agent.string
         )
         db.commit()
+        auth_cache.invalidate_user(user.id)
 
         log.info("Admin %s actualizó flags user=%s", current_user.id, user.id)
 
@@ -872,6 +949,7 @@ def update_user_flags(user_id):
             }
         })
     finally:
+        quotas.invalidate_user(user_id)
         Session.remove()
 
 
@@ -892,6 +970,7 @@ def update_user_quota(user_id):
 
     db = Session()
     try:
+        quotas.flush_user(user_id)
         user = db.query(User).filter_by(id=user_id).first()
         if not user:
             return jsonify({"ok": False, "error": "Usuario no encontrado"}), 404
@@ -937,4 +1016,5 @@ def update_user_quota(user_id):
             }
         })
     finally:
+        quotas.invalidate_user(user_id)
         Session.remove()
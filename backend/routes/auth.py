@@ -6,6 +6,7 @@ from config import Config
 from extensions import Session, limiter
 from logger import get_logger
 from models import User, UserSession, log_audit, utcnow
+from services import auth_cache
 
 auth_bp = Blueprint("auth", __name__)
 log = get_logger("auth")
@@ -27,24 +28,18 @@ def register_auth_hooks(app):
         if not session_id:
             return None
 
-        db = Session()
-        try:
-            user_session = db.query(UserSession).filter_by(id=session_id).first()
-            if not user_session:
-                return None
-
-            if not user_session.is_valid:
-                user_session.revoke()
-                db.commit()
-                return _force_logout(
-                    "Sesión expirada. Inicia sesión nuevamente."
-                )
+        status = auth_cache.get_session_status(session_id)
+        if not status["exists"]:
+            return None
 
-            user_session.touch()
-            db.commit()
-        finally:
-            Session.remove()
+        if not auth_cache.is_session_valid(status):
+            if not status["revoked"]:
+                auth_cache.revoke_session(session_id)
+            return _force_logout(
+                "Sesión expirada. Inicia sesión nuevamente."
+            )
 
+        auth_cache.touch_session(session_id, current_user.id)
         return None
 
     @app.before_request
@@ -174,6 +169,8 @@ def api_logout():
             user_agent=request.user_agent.string
         )
         db.commit()
+        if session_id:
+            auth_cache.invalidate_session(session_id)
     finally:
         Session.remove()
 
@@ -224,6 +221,7 @@ def api_change_password():
 
         # debería hacer logout?
         db.commit()
+        auth_cache.invalidate_user(user.id)
         return jsonify({
             "ok": True,
             "redirect": "/projects"
@@ -1,17 +1,32 @@
 import os
 import os
-from flask import Blueprint, jsonify, send_from_directory, make_response
+from flask import (
+    Blueprint,
+    Response,
+    jsonify,
+    make_response,
+    send_from_directory,
+    stream_with_context
+)
 from flask_login import login_required, current_user
 
 from logger import get_logger
 from helpers import is_valid_uuid, get_mime_type
 from models import utcnow
-from services import project_store
-from services.export.html_renderer import convert_script_to_html
+from services import project_store, transcript_assembler
+from services.export.html_renderer import (
+    convert_script_to_html,
+    stream_script_html
+)
 from services.export.pdf_renderer import render_pdf_bytes
 from services.export.docx_renderer import render_docx_bytes
 
 jobs_bp = Blueprint('jobs', __name__)
+log = get_logger("jobs")
+
+# Marca final cuando el render falla a mitad de stream: el status ya salió
+# como 200, así que el cliente la busca para mostrar el error.
+PREVIEW_STREAM_ERROR_MARKER = "<!--preview-error-->"
 
 
 
@@ -40,6 +55,39 @@ def project_status(project_id):
     })
 
 
+@jobs_bp.route("/api/project/<project_id>/transcript")
+@login_required
+def project_transcript(project_id):
+    ok, result = _check_access(project_id)
+    if not ok:
+        return result
+
+    # Mientras se procesa: el prefijo contiguo ya transcrito. Después, la
+    # transcripción final guardada en el estado.
+    partial = transcript_assembler.get_transcript(project_id)
+    if partial is None:
+        state = project_store.load_state(project_id) or {}
+        transcript = state.get("transcript")
+        if not transcript:
+            return jsonify({"ok": False, "error": "Transcripción no disponible"}), 404
+        total = state.get("segments_total")
+        partial = {
+            "text": transcript,
+            "segments_ready": total,
+            "segments_total": total,
+            "complete": True
+        }
+
+    return jsonify({
+        "ok": True,
+        "status": result.status,
+        "transcript": partial["text"],
+        "segments_ready": partial["segments_ready"],
+        "segments_total": partial["segments_total"],
+        "complete": partial["complete"]
+    })
+
+
 @jobs_bp.route("/r/<project_id>/download/<filename>")
 @login_required
 def download_file(project_id, filename):
@@ -105,6 +153,34 @@ def project_preview(project_id):
         return jsonify({"ok": False, "error": str(e)}), 500
 
 
+@jobs_bp.route("/api/project/<project_id>/preview/stream")
+@login_required
+def project_preview_stream(project_id):
+    ok, result = _check_access(project_id)
+    if not ok:
+        return result
+
+    content, _ = _load_script_content(project_id)
+    if content is None:
+        return jsonify({"ok": False, "error": "script not found"}), 404
+
+    def generate():
+        try:
+            yield from stream_script_html(content, project_id, embed_images=True)
+        except Exception as e:
+            log.error("Preview stream failed for project %s: %s", project_id, e)
+            yield "\n" + PREVIEW_STREAM_ERROR_MARKER + "\n"
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/html"
+    )
+    # nginx no debe bufferear: la idea es que el cliente pinte al tiro
+    response.headers["X-Accel-Buffering"] = "no"
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
 def _load_script_content(project_id):
     project_dir = project_store.get_project_dir(project_id)
     script_path = os.path.join(project_dir, "script.md")
@@ -148,7 +224,6 @@ def export_pdf(project_id):
         response.headers['Content-Disposition'] = 'attachment; filename="guion_%s.pdf"' % str(project_id)[:8]
         return response
     except Exception as e:
-        log = get_logger("jobs")
         log.error("Export PDF failed for project %s: %s", project_id, e)
         return jsonify({"ok": False, "error": "Error al generar PDF"}), 500
 
@@ -171,7 +246,6 @@ def export_docx(project_id):
         response.headers['Content-Disposition'] = 'attachment; filename="guion_%s.docx"' % str(project_id)[:8]
         return response
     except Exception as e:
-        log = get_logger("jobs")
         log.error("Export DOCX failed for project %s: %s", project_id, e)
         return jsonify({"ok": False, "error": "Error al generar DOCX"}), 500
 
@@ -3,9 +3,10 @@ from flask_login import login_required, current_user
 
 from helpers import is_valid_uuid
 from extensions import limiter, LIMITS
-from services import project_store
+from services import project_store, search
 from services.jobs import orchestrator
 from datetime import datetime
+from sqlalchemy import func
 
 from extensions import Session
 from models import utcnow, log_audit_for_request, UserTag, ProjectTag, Project
@@ -229,30 +230,68 @@ def list_projects():
     offset = request.args.get("offset", "0")
     query = request.args.get("q", "").strip()
     status = request.args.get("status", "").strip()
+    tag = request.args.get("tag", "").strip()
 
     try:
         limit_value = max(1, min(int(limit), 100))
     except ValueError:
         limit_value = 10
 
+    try:
+        tag_value = int(tag) if tag else None
+    except ValueError:
+        return jsonify({"ok": False, "error": "tag inválido"}), 400
+
+    cursor = request.args.get("cursor", "").strip()
+    cursor_value = None
+    if cursor:
+        cursor_value = project_store.decode_project_cursor(cursor)
+        if cursor_value is None:
+            return jsonify({"ok": False, "error": "cursor inválido"}), 400
+
     try:
         offset_value = max(0, int(offset))
     except ValueError:
         offset_value = 0
 
-    projects, total = project_store.list_projects(
+    projects, total, next_cursor = project_store.list_projects(
         current_user.id,
         limit=limit_value,
         offset=offset_value,
         query=query or None,
-        status=status or None
+        status=status or None,
+        tag_id=tag_value,
+        cursor=cursor_value
     )
     return jsonify({
         "ok": True,
         "projects": projects,
         "total": total,
         "limit": limit_value,
-        "offset": offset_value
+        "offset": offset_value,
+        "next_cursor": next_cursor
+    })
+
+
+@projects_bp.route("/api/projects/search", methods=["GET"])
+@login_required
+def search_projects():
+    query = request.args.get("q", "").strip()
+    limit = request.args.get("limit", "20")
+
+    if len(query) < search.MIN_QUERY_LENGTH:
+        return jsonify({"ok": False, "error": "Búsqueda muy corta"}), 400
+
+    try:
+        limit_value = max(1, min(int(limit), 50))
+    except ValueError:
+        limit_value = 20
+
+    results = search.search_projects(current_user.id, query, limit=limit_value)
+    return jsonify({
+        "ok": True,
+        "query": query,
+        "results": results
     })
 
 
@@ -312,17 +351,23 @@ def update_project(project_id):
 def get_user_tags():
     db = Session()
     try:
-        tags = db.query(UserTag).filter_by(user_id=current_user.id).all()
+        rows = (
+            db.query(UserTag, func.count(ProjectTag.project_id))
+            .outerjoin(ProjectTag, ProjectTag.tag_id == UserTag.id)
+            .filter(UserTag.user_id == current_user.id)
+            .group_by(UserTag.id)
+            .all()
+        )
 
-        tag_data = []
-        for tag in tags:
-            count = db.query(ProjectTag).filter_by(tag_id=tag.id).count()
-            tag_data.append({
+        tag_data = [
+            {
                 "id": tag.id,
                 "name": tag.name,
-                "usage_count": count,
+                "usage_count": int(count or 0),
                 "created_at": tag.created_at.isoformat() if tag.created_at else None
-            })
+            }
+            for tag, count in rows
+        ]
         return jsonify({
             "ok": True,
             "tags": tag_data
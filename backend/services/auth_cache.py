@@ -0,0 +1,173 @@
+import json
+import uuid
+from datetime import datetime
+from typing import cast
+
+from sqlalchemy import update
+
+from config import Config
+from extensions import Session
+from logger import get_logger
+from models import User, UserSession, utcnow
+from services import session_activity
+from services.cache import get_redis_client
+
+
+log = get_logger("auth_cache")
+_redis = get_redis_client()
+
+
+# Solo lo que se usa vía current_user; nada de hashes ni contadores de cuota
+USER_FIELDS = (
+    "username",
+    "is_admin",
+    "is_active",
+    "must_change_password",
+    "can_stylize_images",
+)
+
+
+def _user_key(user_id):
+    return f"auth:user:{user_id}"
+
+
+def _session_key(session_id):
+    return f"auth:session:{session_id}"
+
+
+def _get_json(key):
+    try:
+        raw = _redis.get(key)
+        if raw:
+            return json.loads(cast(bytes, raw).decode("utf-8"))
+    except Exception:
+        pass
+    return None
+
+
+def _set_json(key, data):
+    try:
+        _redis.setex(key, Config.AUTH_CACHE_TTL_SECONDS, json.dumps(data).encode("utf-8"))
+    except Exception:
+        pass
+
+
+def _delete(*keys):
+    try:
+        _redis.delete(*keys)
+    except Exception:
+        pass
+
+
+def _user_from_cache(data):
+    # Objeto transitorio: no está en ninguna sesión de SQLAlchemy
+    return User(id=uuid.UUID(data["id"]), **{field: data[field] for field in USER_FIELDS})
+
+
+def load_user(user_id):
+    """Usuario activo para flask-login, desde Redis si está fresco."""
+    cached = _get_json(_user_key(user_id))
+    if cached:
+        return _user_from_cache(cached)
+
+    db = Session()
+    try:
+        user = db.query(User).filter_by(id=user_id, is_active=True).first()
+        if not user:
+            return None
+        data = {"id": str(user.id)}
+        data.update({field: getattr(user, field) for field in USER_FIELDS})
+        _set_json(_user_key(user_id), data)
+        return user
+    finally:
+        Session.remove()
+
+
+def invalidate_user(user_id):
+    _delete(_user_key(user_id))
+
+
+def get_session_status(session_id):
+    """
+    {"exists", "revoked", "expires_at"} de la sesión. Se cachea el resultado
+    para no consultar user_sessions en cada request.
+    """
+    cached = _get_json(_session_key(session_id))
+    if cached:
+        return cached
+
+    db = Session()
+    try:
+        user_session = db.query(UserSession).filter_by(id=session_id).first()
+        if not user_session:
+            status = {"exists": False, "revoked": False, "expires_at": None}
+        else:
+            status = {
+                "exists": True,
+                "revoked": user_session.revoked_at is not None,
+                "expires_at": user_session.expires_at.isoformat()
+            }
+        _set_json(_session_key(session_id), status)
+        return status
+    finally:
+        Session.remove()
+
+
+def is_session_valid(status):
+    if status["revoked"]:
+        return False
+    return utcnow() <= datetime.fromisoformat(status["expires_at"])
+
+
+def invalidate_session(session_id):
+    _delete(_session_key(session_id))
+    session_activity.forget_session(session_id)
+
+
+def invalidate_user_sessions(db, user_id):
+    session_ids = [
+        row[0]
+        for row in db.query(UserSession.id).filter(UserSession.user_id == user_id).all()
+    ]
+    if session_ids:
+        _delete(*[_session_key(session_id) for session_id in session_ids])
+    for session_id in session_ids:
+        session_activity.forget_session(session_id)
+
+
+def touch_session(session_id, user_id):
+    """
+    La actividad queda en Redis y el flusher la baja a Postgres en lote. Si
+    Redis no responde se escribe directo para no perder last_seen_at.
+    """
+    try:
+        session_activity.record_touch(session_id, user_id)
+        return
+    except Exception:
+        pass
+
+    db = Session()
+    try:
+        db.execute(
+            update(UserSession)
+            .where(UserSession.id == session_id)
+            .values(last_seen_at=utcnow())
+        )
+        db.commit()
+    finally:
+        Session.remove()
+
+
+def revoke_session(session_id):
+    db = Session()
+    try:
+        db.execute(
+            update(UserSession)
+            .where(UserSession.id == session_id)
+            .where(UserSession.revoked_at.is_(None))
+            .values(revoked_at=utcnow())
+        )
+        db.commit()
+    finally:
+        Session.remove()
+    invalidate_session(session_id)
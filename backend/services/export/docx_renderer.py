@@ -1,15 +1,120 @@
 import os
 import io
+import hashlib
 
+from PIL import Image, ImageOps
 from docx import Document
 from docx.shared import Inches, Pt, RGBColor
 from docx.enum.table import WD_TABLE_ALIGNMENT
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 
+from logger import get_logger
 from services.export.script_parser import parse_script
 
 
-def _add_vida_table(doc, blocks, project_dir):
+log = get_logger("docx_export")
+
+IMAGE_WIDTH_INCHES = 4
+IMAGE_DPI = 150
+
+
+class ImageAssetCache:
+    """
+    Imágenes del proyecto ya escaladas al ancho del DOCX. Se guardan en
+    export_cache/ (<hash de la ruta>.<hash de mtime + tamaño>.img) para no
+    decodificar la foto original en cada export, y en memoria para que una
+    foto repetida entregue siempre los mismos bytes: python-docx deduplica
+    partes por hash. Al escribir una entrada se borran las anteriores de la
+    misma ruta (la foto se volvió a estilizar).
+    """
+
+    def __init__(self, project_dir):
+        self._cache_dir = os.path.join(project_dir, "export_cache")
+        self._blobs = {}
+
+    def get(self, img_path):
+        if img_path in self._blobs:
+            return self._blobs[img_path]
+        try:
+            stat = os.stat(img_path)
+        except OSError:
+            return None
+
+        path_key = hashlib.sha1(os.path.realpath(img_path).encode("utf-8")).hexdigest()
+        version_key = hashlib.sha1(f"{stat.st_mtime_ns}:{stat.st_size}".encode("utf-8")).hexdigest()[:16]
+        cached_path = os.path.join(self._cache_dir, f"{path_key}.{version_key}.img")
+
+        blob = None
+        if os.path.exists(cached_path):
+            with open(cached_path, "rb") as fh:
+                blob = fh.read()
+        else:
+            blob = self._scale(img_path)
+            if blob is not None:
+                try:
+                    os.makedirs(self._cache_dir, exist_ok=True)
+                    tmp_path = cached_path + ".tmp"
+                    with open(tmp_path, "wb") as fh:
+                        fh.write(blob)
+                    os.replace(tmp_path, cached_path)
+                    self._prune(path_key, cached_path)
+                except OSError as e:
+                    log.warning("No se pudo cachear imagen %s: %s", img_path, e)
+
+        if blob is None:
+            with open(img_path, "rb") as fh:
+                blob = fh.read()
+
+        self._blobs[img_path] = blob
+        return blob
+
+    def _prune(self, path_key, current_path):
+        """Borra otras versiones de la misma foto y las entradas sin ruta en el nombre."""
+        current_name = os.path.basename(current_path)
+        for name in os.listdir(self._cache_dir):
+            if name == current_name or not name.endswith(".img"):
+                continue
+            prefix = name.split(".", 1)[0]
+            if prefix == path_key or name.count(".") == 1:
+                try:
+                    os.remove(os.path.join(self._cache_dir, name))
+                except OSError:
+                    pass
+
+    def _scale(self, img_path):
+        target_px = IMAGE_WIDTH_INCHES * IMAGE_DPI
+        try:
+            with Image.open(img_path) as img:
+                img = ImageOps.exif_transpose(img)
+                if img.width > target_px:
+                    height = max(1, round(img.height * target_px / img.width))
+                    img = img.resize((target_px, height), Image.LANCZOS)
+
+                out = io.BytesIO()
+                if img.mode in ("RGBA", "LA", "P"):
+                    img.save(out, format="PNG", optimize=True, dpi=(IMAGE_DPI, IMAGE_DPI))
+                else:
+                    img.convert("RGB").save(
+                        out,
+                        format="JPEG",
+                        quality=85,
+                        optimize=True,
+                        dpi=(IMAGE_DPI, IMAGE_DPI)
+                    )
+                return out.getvalue()
+        except Exception as e:
+            log.warning("No se pudo escalar imagen %s: %s", img_path, e)
+            return None
+
+
+def _add_picture(paragraph, img_path, assets):
+    blob = assets.get(img_path)
+    if blob is None:
+        raise ValueError("Imagen ilegible")
+    paragraph.add_run().add_picture(io.BytesIO(blob), width=Inches(IMAGE_WIDTH_INCHES))
+
+
+def _add_vida_table(doc, blocks, project_dir, assets):
     table = doc.add_table(rows=1, cols=1)
     table.style = "Table Grid"
     table.alignment = WD_TABLE_ALIGNMENT.CENTER
@@ -27,16 +132,16 @@ def _add_vida_table(doc, blocks, project_dir):
     title_run.font.color.rgb = RGBColor(64, 64, 64)
 
     for block in blocks or []:
-        b_type = block.get("type")
+        b_type = block.type
         if b_type == "paragraph":
-            lines = (block.get("text", "") or "").split("\n") or [""]
+            lines = (block.text or "").split("\n") or [""]
             for line in lines:
                 para = cell.add_paragraph()
                 para.paragraph_format.space_before = Pt(0)
                 para.paragraph_format.space_after = Pt(0)
                 para.add_run(line)
         elif b_type == "image":
-            img_rel = os.path.basename(block.get("src", "") or "")
+            img_rel = os.path.basename(block.src or "")
             if not img_rel:
                 continue
             img_path = os.path.join(project_dir, "photos", img_rel)
@@ -44,9 +149,9 @@ def _add_vida_table(doc, blocks, project_dir):
                 para = cell.add_paragraph()
                 para.alignment = WD_ALIGN_PARAGRAPH.CENTER
                 try:
-                    para.add_run().add_picture(img_path, width=Inches(4))
+                    _add_picture(para, img_path, assets)
                 except Exception:
-                    para.add_run(block.get("alt", "Foto"))
+                    para.add_run(block.text or "Foto")
             else:
                 para = cell.add_paragraph()
                 para.paragraph_format.space_before = Pt(0)
@@ -60,10 +165,11 @@ def _add_vida_table(doc, blocks, project_dir):
 def render_docx_bytes(content, project_id, project_dir):
     doc = Document()
     nodes = parse_script(content)
+    assets = ImageAssetCache(project_dir)
     prev_blank = False
 
     for node in nodes:
-        n_type = node.get("type")
+        n_type = node.type
 
         if n_type == "blank":
             if prev_blank:
@@ -75,8 +181,7 @@ def render_docx_bytes(content, project_id, project_dir):
         prev_blank = False
 
         if n_type == "heading":
-            level = node.get("level", 1)
-            para = doc.add_heading(node.get("text", ""), level=level)
+            para = doc.add_heading(node.text, level=node.level)
             para.paragraph_format.space_after = Pt(0)
             continue
 
@@ -86,27 +191,27 @@ def render_docx_bytes(content, project_id, project_dir):
             continue
 
         if n_type == "paragraph":
-            para = doc.add_paragraph(node.get("text", ""))
+            para = doc.add_paragraph(node.text)
             para.paragraph_format.space_before = Pt(0)
             para.paragraph_format.space_after = Pt(0)
             continue
 
         if n_type == "image":
-            img_rel = os.path.basename(node.get("src", "") or "")
+            img_rel = os.path.basename(node.src or "")
             img_path = os.path.join(project_dir, "photos", img_rel)
             if os.path.exists(img_path):
                 try:
                     para = doc.add_paragraph()
                     para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                    para.add_run().add_picture(img_path, width=Inches(4))
+                    _add_picture(para, img_path, assets)
                 except Exception:
-                    doc.add_paragraph(node.get("alt", "Foto"))
+                    doc.add_paragraph(node.text or "Foto")
             else:
                 doc.add_paragraph("[Imagen no encontrada: %s]" % img_rel)
             continue
 
         if n_type == "vida":
-            _add_vida_table(doc, node.get("blocks", []), project_dir)
+            _add_vida_table(doc, node.blocks, project_dir, assets)
             continue
 
     bio = io.BytesIO()
@@ -1,8 +1,20 @@
 from services import project_store
-from services.export.script_parser import parse_script, render_nodes_to_html
+from services.export.script_parser import (
+    iter_nodes_html,
+    parse_script,
+    render_nodes_to_html
+)
 
 
 def convert_script_to_html(content, project_id, embed_images=True):
     project_dir = project_store.get_project_dir(project_id)
     nodes = parse_script(content)
     return render_nodes_to_html(nodes, project_dir, embed_images=embed_images)
+
+
+def stream_script_html(content, project_id, embed_images=True):
+    """Igual que convert_script_to_html, pero entrega un fragmento por línea."""
+    project_dir = project_store.get_project_dir(project_id)
+    nodes = parse_script(content)
+    for fragment in iter_nodes_html(nodes, project_dir, embed_images=embed_images):
+        yield fragment + "\n"
@@ -1,6 +1,9 @@
 import os
 import re
+import hashlib
+import threading
 import html as html_lib
+from collections import OrderedDict, namedtuple
 
 from helpers import encode_image_base64, get_mime_type
 
@@ -10,97 +13,117 @@ VIDA_END_RE = re.compile(r"<\s*/\s*VIDA\s+INTERNA\s*>", re.IGNORECASE)
 IMAGE_RE = re.compile(r"!\[(.*?)\]\((.+?)\)")
 STRONG_RE = re.compile(r"\*\*(.+?)\*\*")
 
+# Un solo regex por línea para todo lo que no es VIDA INTERNA. El orden de
+# las alternativas respeta el orden de los chequeos originales.
+LINE_RE = re.compile(
+    r"(?P<h1># )|(?P<h2>## )"
+    r"|\s*(?:(?P<hr>---)\s*$|!\[(?P<alt>.*?)\]\((?P<src>.+?)\))"
+)
 
-def _parse_vida_blocks(vida_content):
-    lines = (vida_content or "").split("\n")
+# Nodos compactos e inmutables: se comparten entre renderers vía caché, así
+# que nadie debe poder mutarlos. Para imágenes, `text` es el alt.
+Node = namedtuple("Node", ["type", "text", "level", "src", "blocks"])
+
+BLANK_NODE = Node("blank", "", 0, None, ())
+HR_NODE = Node("hr", "", 0, None, ())
+
+_NODE_CACHE_SIZE = 32
+_node_cache = OrderedDict()
+_node_cache_lock = threading.Lock()
+
+
+def _image_node(alt, src):
+    return Node("image", alt or "Foto", 0, src, ())
+
+
+def _paragraph_node(text):
+    return Node("paragraph", text, 0, None, ())
+
+
+def _parse_vida_blocks(vida_lines):
     blocks = []
     buffer = []
 
-    def flush_paragraph():
-        if buffer:
-            blocks.append({"type": "paragraph", "text": "\n".join(buffer)})
-            buffer.clear()
-
-    for line in lines:
-        stripped = line.strip()
-        img_match = IMAGE_RE.match(stripped)
+    for line in vida_lines or [""]:
+        img_match = IMAGE_RE.match(line.strip()) if "![" in line else None
         if img_match:
-            flush_paragraph()
-            blocks.append({
-                "type": "image",
-                "alt": img_match.group(1) or "Foto",
-                "src": img_match.group(2)
-            })
+            if buffer:
+                blocks.append(_paragraph_node("\n".join(buffer)))
+                buffer = []
+            blocks.append(_image_node(img_match.group(1), img_match.group(2)))
             continue
 
         buffer.append(line)
 
-    flush_paragraph()
-    return blocks
+    if buffer:
+        blocks.append(_paragraph_node("\n".join(buffer)))
+    return tuple(blocks)
 
 
-def parse_script(content):
-    content = (content or "").strip()
-    if not content:
-        return []
-
-    lines = content.split("\n")
+def _tokenize(content):
     nodes = []
-    inside_vida = False
-    vida_lines = []
-
-    def push_vida():
-        vida_content = "\n".join(vida_lines)
-        nodes.append({
-            "type": "vida",
-            "blocks": _parse_vida_blocks(vida_content)
-        })
-
-    for line in lines:
-        if inside_vida:
-            if VIDA_END_RE.search(line):
-                inside_vida = False
-                push_vida()
-                vida_lines = []
+    append = nodes.append
+    match_line = LINE_RE.match
+    vida_lines = None
+
+    for line in content.split("\n"):
+        if vida_lines is not None:
+            if "<" in line and VIDA_END_RE.search(line):
+                append(Node("vida", "", 0, None, _parse_vida_blocks(vida_lines)))
+                vida_lines = None
                 continue
             vida_lines.append(line)
             continue
 
-        if VIDA_START_RE.search(line):
-            inside_vida = True
+        if "<" in line and VIDA_START_RE.search(line):
             vida_lines = []
             continue
 
-        if not line.strip():
-            nodes.append({"type": "blank"})
-            continue
-
-        if line.startswith("# "):
-            nodes.append({"type": "heading", "level": 1, "text": line[2:].strip()})
+        if not line or line.isspace():
+            append(BLANK_NODE)
             continue
 
-        if line.startswith("## "):
-            nodes.append({"type": "heading", "level": 2, "text": line[3:].strip()})
-            continue
+        m = match_line(line)
+        if m is None:
+            append(_paragraph_node(line))
+        elif m.lastgroup == "h1":
+            append(Node("heading", line[2:].strip(), 1, None, ()))
+        elif m.lastgroup == "h2":
+            append(Node("heading", line[3:].strip(), 2, None, ()))
+        elif m.group("hr") is not None:
+            append(HR_NODE)
+        else:
+            append(_image_node(m.group("alt"), m.group("src")))
 
-        if line.strip() == "---":
-            nodes.append({"type": "hr"})
-            continue
+    if vida_lines is not None:
+        append(Node("vida", "", 0, None, _parse_vida_blocks(vida_lines)))
 
-        img_match = IMAGE_RE.match(line.strip())
-        if img_match:
-            nodes.append({
-                "type": "image",
-                "alt": img_match.group(1) or "Foto",
-                "src": img_match.group(2)
-            })
-            continue
+    return tuple(nodes)
 
-        nodes.append({"type": "paragraph", "text": line})
-
-    if inside_vida:
-        push_vida()
 
+def parse_script(content):
+    """
+    Parsea el guion en una tupla de `Node`. El resultado se memoiza por hash
+    del contenido, así HTML, PDF y DOCX reutilizan el mismo árbol.
+    """
+    content = (content or "").strip()
+    if not content:
+        return ()
+
+    key = hashlib.sha1(content.encode("utf-8")).hexdigest()
+    with _node_cache_lock:
+        cached = _node_cache.get(key)
+        if cached is not None:
+            _node_cache.move_to_end(key)
+            return cached
+
+    nodes = _tokenize(content)
+
+    with _node_cache_lock:
+        _node_cache[key] = nodes
+        _node_cache.move_to_end(key)
+        while len(_node_cache) > _NODE_CACHE_SIZE:
+            _node_cache.popitem(last=False)
     return nodes
 
 
@@ -154,55 +177,54 @@ def _safe_image_tag(filename, photos_dir, embed_images):
     )
 
 
-def render_nodes_to_html(nodes, project_dir, embed_images=False):
+def iter_nodes_html(nodes, project_dir, embed_images=False):
+    """
+    Genera el HTML nodo a nodo. Cada fragmento es un elemento completo, así
+    que se puede enviar al cliente apenas se produce.
+    """
     photos_dir = os.path.join(project_dir, "photos")
-    html_parts = []
     prev_blank = False
 
     for node in nodes:
-        n_type = node.get("type")
+        n_type = node.type
 
         if n_type == "blank":
             if not prev_blank:
-                html_parts.append('<div style="height: 1em;"></div>')
+                yield '<div style="height: 1em;"></div>'
             prev_blank = True
             continue
 
         prev_blank = False
 
         if n_type == "heading":
-            level = node.get("level", 1)
-            text = html_lib.escape(node.get("text", ""))
+            level = node.level
+            text = html_lib.escape(node.text)
             if level == 1:
-                html_parts.append(
-                    f'<h1 style="text-align: center; margin: 0 0 0.5em 0; font-size: 24px;">{text}</h1>'
-                )
+                yield f'<h1 style="text-align: center; margin: 0 0 0.5em 0; font-size: 24px;">{text}</h1>'
             else:
-                html_parts.append(
-                    f'<h2 style="margin: 1em 0 0.5em 0; font-size: 18px;">{text}</h2>'
-                )
+                yield f'<h2 style="margin: 1em 0 0.5em 0; font-size: 18px;">{text}</h2>'
             continue
 
         if n_type == "hr":
-            html_parts.append('<hr style="margin: 1em 0;">')
+            yield '<hr style="margin: 1em 0;">'
             continue
 
         if n_type == "image":
-            html_parts.append(_safe_image_tag(node.get("src", ""), photos_dir, embed_images))
+            yield _safe_image_tag(node.src or "", photos_dir, embed_images)
             continue
 
         if n_type == "vida":
             vida_html_parts = []
-            for block in node.get("blocks", []):
-                b_type = block.get("type")
+            for block in node.blocks:
+                b_type = block.type
                 if b_type == "image":
-                    vida_html_parts.append(_safe_image_tag(block.get("src", ""), photos_dir, embed_images))
+                    vida_html_parts.append(_safe_image_tag(block.src or "", photos_dir, embed_images))
                 elif b_type == "paragraph":
                     vida_html_parts.append(
-                        f'<div style="margin: 0 0 0.75em 0; font-size: 14px; line-height: 1.6; color: #000; white-space: pre-wrap;">{_render_multiline(block.get("text", ""))}</div>'
+                        f'<div style="margin: 0 0 0.75em 0; font-size: 14px; line-height: 1.6; color: #000; white-space: pre-wrap;">{_render_multiline(block.text)}</div>'
                     )
             inner_html = "".join(vida_html_parts)
-            html_parts.append(
+            yield (
                 '<div style="border: 1px solid #111; background: #fff; border-radius: 16px; padding: 16px;">'
                 '<p style="margin: 0; font-size: 11px; font-weight: 700; letter-spacing: 0.3em; text-transform: uppercase; color: rgba(0,0,0,0.7);">Vida interna</p>'
                 f'<div style="margin-top: 8px; font-size: 14px; line-height: 1.6; color: #000;">{inner_html}</div>'
@@ -211,10 +233,12 @@ def render_nodes_to_html(nodes, project_dir, embed_images=False):
             continue
 
         if n_type == "paragraph":
-            text_html = _render_text(node.get("text", ""))
-            html_parts.append(
+            text_html = _render_text(node.text)
+            yield (
                 f'<div style="margin: 0; font-size: 14px; line-height: 1.6; color: #000; white-space: pre-wrap;">{text_html}</div>'
             )
             continue
 
-    return "\n".join(html_parts)
+
+def render_nodes_to_html(nodes, project_dir, embed_images=False):
+    return "\n".join(iter_nodes_html(nodes, project_dir, embed_images=embed_images))
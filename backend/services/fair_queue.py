@@ -0,0 +1,201 @@
+import time
+
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+
+from config import Config
+from logger import get_logger
+from services.cache import get_redis_client
+from services.queue import enqueue_deferred, get_queue
+
+
+log = get_logger("fair_queue")
+_redis = get_redis_client()
+
+
+# Capa de reparto justo delante de una cola RQ. Los jobs se crean diferidos y
+# quedan en una lista por proyecto; el pump los pasa a RQ en round-robin entre
+# proyectos, manteniendo la cola RQ corta (Config.FAIR_QUEUE_DEPTH). Así un
+# proyecto largo no deja cientos de jobs delante de uno corto.
+
+# Jobs que el pump sacó pero que todavía no se confirma que estén en RQ
+RELEASE_GRACE_SECONDS = 60
+
+
+def _ring_key(queue_name):
+    return f"fair:{queue_name}:ring"
+
+
+def _active_key(queue_name):
+    return f"fair:{queue_name}:active"
+
+
+def _pending_prefix(queue_name):
+    return f"fair:{queue_name}:pending:"
+
+
+def _releasing_key(queue_name):
+    return f"fair:{queue_name}:releasing"
+
+
+# KEYS[1]: anillo, KEYS[2]: set de proyectos en el anillo, KEYS[3]: pendientes
+# ARGV[1]: proyecto, ARGV[2..]: ids de jobs
+_SUBMIT_SCRIPT = """
+for i = 2, #ARGV do
+    redis.call('RPUSH', KEYS[3], ARGV[i])
+end
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+return #ARGV - 1
+"""
+
+# KEYS[1]: anillo, KEYS[2]: set de proyectos, KEYS[3]: cola RQ, KEYS[4]: releasing
+# ARGV[1]: prefijo de pendientes, ARGV[2]: profundidad objetivo, ARGV[3]: now
+# Una vuelta entrega como mucho un job por proyecto.
+_PUMP_SCRIPT = """
+local room = tonumber(ARGV[2]) - redis.call('LLEN', KEYS[3])
+local released = {}
+while room > 0 do
+    local n = redis.call('LLEN', KEYS[1])
+    if n == 0 then
+        break
+    end
+    local progressed = false
+    for i = 1, n do
+        if room <= 0 then
+            break
+        end
+        local project = redis.call('LPOP', KEYS[1])
+        local pending = ARGV[1] .. project
+        local job_id = redis.call('LPOP', pending)
+        if job_id then
+            table.insert(released, job_id)
+            redis.call('ZADD', KEYS[4], ARGV[3], job_id)
+            room = room - 1
+            progressed = true
+        end
+        if redis.call('LLEN', pending) > 0 then
+            redis.call('RPUSH', KEYS[1], project)
+        else
+            redis.call('SREM', KEYS[2], project)
+        end
+    end
+    if not progressed then
+        break
+    end
+end
+return released
+"""
+
+# KEYS[1]: pendientes del proyecto. Devuelve los ids que había; el anillo se
+# limpia solo en el próximo pump
+_DROP_SCRIPT = """
+local ids = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+return ids
+"""
+
+_submit_script = _redis.register_script(_SUBMIT_SCRIPT)
+_pump_script = _redis.register_script(_PUMP_SCRIPT)
+_drop_script = _redis.register_script(_DROP_SCRIPT)
+
+
+def create_deferred_job(queue, *args, **kwargs):
+    """Crea y guarda el job sin encolarlo; otros jobs pueden depender de él."""
+    job = queue.create_job(
+        "worker.dispatch",
+        args=args,
+        status=JobStatus.DEFERRED,
+        **kwargs
+    )
+    job.save()
+    return job
+
+
+def submit(queue_name, project_id, jobs):
+    if not jobs:
+        return 0
+    _submit_script(
+        keys=[
+            _ring_key(queue_name),
+            _active_key(queue_name),
+            _pending_prefix(queue_name) + str(project_id)
+        ],
+        args=[str(project_id)] + [job.id for job in jobs]
+    )
+    return pump(queue_name)
+
+
+def drop_project(queue_name, project_id):
+    """Saca los jobs del proyecto que el pump no soltó todavía y los borra."""
+    raw_ids = _drop_script(keys=[_pending_prefix(queue_name) + str(project_id)])
+    job_ids = [
+        raw_id.decode("utf-8") if isinstance(raw_id, bytes) else raw_id
+        for raw_id in raw_ids
+    ]
+    if job_ids:
+        pipe = _redis.pipeline()
+        for job in Job.fetch_many(job_ids, connection=_redis):
+            if job is not None:
+                job.delete(pipeline=pipe)
+        pipe.execute()
+    return job_ids
+
+
+def pump(queue_name):
+    queue = get_queue(queue_name)
+    released = _pump_script(
+        keys=[
+            _ring_key(queue_name),
+            _active_key(queue_name),
+            queue.key,
+            _releasing_key(queue_name)
+        ],
+        args=[_pending_prefix(queue_name), Config.FAIR_QUEUE_DEPTH, int(time.time())]
+    )
+    count = 0
+    for raw_id in released:
+        job_id = raw_id.decode("utf-8") if isinstance(raw_id, bytes) else raw_id
+        if _enqueue(queue, job_id):
+            count += 1
+        _redis.zrem(_releasing_key(queue_name), job_id)
+    return count
+
+
+def _enqueue(queue, job_id):
+    try:
+        job = Job.fetch(job_id, connection=queue.connection)
+    except NoSuchJobError:
+        log.warning("Job %s ya no existe; se descarta", job_id)
+        return False
+    if job.get_status() != JobStatus.DEFERRED:
+        return False
+    enqueue_deferred(queue, job)
+    return True
+
+
+def recover_releasing(queue_name):
+    """
+    Si el proceso murió entre sacar un job y encolarlo en RQ, el job quedó
+    diferido para siempre (y con él finalize). Se reintenta acá.
+    """
+    queue = get_queue(queue_name)
+    key = _releasing_key(queue_name)
+    stale = _redis.zrangebyscore(key, "-inf", time.time() - RELEASE_GRACE_SECONDS)
+    for raw_id in stale:
+        job_id = raw_id.decode("utf-8")
+        if _enqueue(queue, job_id):
+            log.warning("Job %s recuperado tras una liberación incompleta", job_id)
+        _redis.zrem(key, job_id)
+
+
+def run_pump_loop(queue_names, interval_seconds=15):
+    while True:
+        for queue_name in queue_names:
+            try:
+                recover_releasing(queue_name)
+                pump(queue_name)
+            except Exception as e:
+                log.error("Error en pump de %s: %s", queue_name, e)
+        time.sleep(interval_seconds)
@@ -0,0 +1,404 @@
+import time
+
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+
+from logger import get_logger
+from services import fair_queue
+from services.cache import get_redis_client
+from services.queue import enqueue_deferred, get_queue
+
+
+log = get_logger("job_graph")
+_redis = get_redis_client()
+
+
+# Fan-in propio en vez de depends_on de RQ: con cientos de dependencias RQ
+# revisa el set completo en cada término, y si una falla para siempre el
+# job final queda diferido sin que nadie se entere. Acá cada grafo es un hash
+# con un contador; cada hijo que termina lo baja en una sola llamada y el que
+# lo deja en cero suelta el job final.
+#
+# Un grafo por proyecto (graph_id); `run` identifica el intento de prepare que
+# lo armó, así los hijos de un intento anterior no cuentan para el nuevo.
+# Un hijo que muere sin pasar por dispatch (work-horse matado, job abandonado
+# o borrado) lo detecta el sweeper y lo cuenta como fallido.
+
+# Qué pasa si un hijo falla sin reintentos pendientes
+POLICY_CONTINUE = "continue"  # cuenta como terminado; el final corre igual
+POLICY_ABORT = "abort"  # el final no corre; se cancela lo pendiente y, cuando
+                        # terminan los hijos en curso, se encola on_abort
+POLICIES = (POLICY_CONTINUE, POLICY_ABORT)
+
+OUTCOME_OK = "ok"
+OUTCOME_FAILED = "failed"
+OUTCOME_CANCELLED = "cancelled"
+
+META_KEY = "graph"
+GRAPH_TTL = 2 * 24 * 60 * 60
+ACTIVE_KEY = "graph:active"
+
+# waiting -> releasing -> released
+# waiting -> aborting (esperando hijos en curso) -> abort_releasing -> aborted
+STATE_RELEASED = "released"
+STATE_ABORTED = "aborted"
+INACTIVE_STATES = ("aborting", "abort_releasing", STATE_ABORTED)
+
+# Estados de RQ de los que un job ya no sale solo
+DEAD_STATUSES = (JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED)
+
+# Los hijos se registran antes de encolarse: en un grafo recién creado un
+# hijo que todavía no existe en RQ no cuenta como muerto
+SWEEP_GRACE_SECONDS = 120
+
+
+def _graph_key(graph_id):
+    return f"graph:{graph_id}"
+
+
+def _done_key(graph_id):
+    return f"graph:{graph_id}:done"
+
+
+def _children_key(graph_id):
+    return f"graph:{graph_id}:children"
+
+
+# KEYS[1]: hash del grafo, KEYS[2]: set de terminados, KEYS[3]: hijos
+# (id -> política), KEYS[4]: grafos activos
+# ARGV: run, ttl, now, graph_id, nº de campos del hash, campos..., hijos...
+# Si el grafo ya existe para este run no hace nada: un reintento no apila
+# hijos ni reinicia el contador.
+_CREATE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'run') == ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+local n = tonumber(ARGV[5])
+redis.call('HSET', KEYS[1], unpack(ARGV, 6, 5 + n))
+if #ARGV > 5 + n then
+    redis.call('HSET', KEYS[3], unpack(ARGV, 6 + n))
+end
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], tonumber(ARGV[2]))
+end
+redis.call('ZADD', KEYS[4], ARGV[3], ARGV[4])
+return 1
+"""
+
+# KEYS[1]: hash del grafo, KEYS[2]: set de hijos terminados
+# ARGV: run, ok | failed | cancelled, política, ttl, ids de hijos...
+# Devuelve {acción, restantes, abortó_ahora}; acción: release | abort |
+# abort_done | wait | duplicate | stale
+_COMPLETE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'run') ~= ARGV[1] then
+    return {'stale', 0, 0}
+end
+local state = redis.call('HGET', KEYS[1], 'state')
+local added = 0
+for i = 5, #ARGV do
+    added = added + redis.call('SADD', KEYS[2], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[2], tonumber(ARGV[4]))
+local remaining = tonumber(redis.call('HGET', KEYS[1], 'remaining'))
+if added == 0 then
+    -- Entrega repetida: solo se reintenta soltar lo que quedó a medias
+    if state == 'releasing' then
+        return {'release', remaining, 0}
+    elseif state == 'abort_releasing' then
+        return {'abort_done', remaining, 0}
+    end
+    return {'duplicate', remaining, 0}
+end
+remaining = redis.call('HINCRBY', KEYS[1], 'remaining', -added)
+local action = 'wait'
+local aborted_now = 0
+if ARGV[2] == 'failed' then
+    redis.call('HINCRBY', KEYS[1], 'failed', added)
+    if ARGV[3] == 'abort' and state == 'waiting' then
+        state = 'aborting'
+        redis.call('HSET', KEYS[1], 'state', state)
+        action = 'abort'
+        aborted_now = 1
+    end
+end
+if remaining <= 0 then
+    if state == 'waiting' then
+        redis.call('HSET', KEYS[1], 'state', 'releasing')
+        return {'release', remaining, 0}
+    elseif state == 'aborting' then
+        redis.call('HSET', KEYS[1], 'state', 'abort_releasing')
+        return {'abort_done', remaining, aborted_now}
+    end
+end
+return {action, remaining, aborted_now}
+"""
+
+# KEYS[1]: hash del grafo, KEYS[2]: grafos activos; ARGV: run, estado, graph_id
+_FINISH_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'run') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'state', ARGV[2])
+redis.call('ZREM', KEYS[2], ARGV[3])
+return 1
+"""
+
+# KEYS[1..3]: hash, terminados, hijos; KEYS[4]: grafos activos
+# ARGV: run, graph_id. Solo borra si el grafo sigue siendo de ese run.
+_DISCARD_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'run') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+redis.call('ZREM', KEYS[4], ARGV[2])
+return 1
+"""
+
+_create_script = _redis.register_script(_CREATE_SCRIPT)
+_complete_script = _redis.register_script(_COMPLETE_SCRIPT)
+_finish_script = _redis.register_script(_FINISH_SCRIPT)
+_discard_script = _redis.register_script(_DISCARD_SCRIPT)
+
+
+def child_meta(graph_id, run_id, policy=POLICY_CONTINUE):
+    """meta para los jobs hijos; worker.dispatch lo lee al terminar el job."""
+    if policy not in POLICIES:
+        raise ValueError(f"Política desconocida: {policy}")
+    return {META_KEY: {"id": str(graph_id), "run": run_id, "policy": policy}}
+
+
+def create(graph_id, run_id, children, final_job, on_abort=None, fair_queues=()):
+    """
+    Registra el grafo. children es {job_id: política}; final_job debe estar
+    creado diferido y se encola cuando terminan todos. on_abort es un alias
+    de worker.ALLOWED_JOBS que recibe (graph_id, motivo, run_id); tiene que
+    ignorar los run que ya no son el vigente. fair_queues son las
+    colas de fair_queue donde el proyecto puede tener hijos sin soltar; se
+    vacían si el grafo aborta.
+    Hay que llamarlo antes de encolar los hijos. Es idempotente por run.
+    """
+    now = int(time.time())
+    fields = {
+        "run": run_id,
+        "created_at": now,
+        "remaining": len(children),
+        "failed": 0,
+        "state": "waiting",
+        "final_job": final_job.id,
+        "queue": final_job.origin,
+        "on_abort": on_abort or "",
+        "fair_queues": ",".join(fair_queues),
+    }
+    args = [run_id, GRAPH_TTL, now, str(graph_id), len(fields) * 2]
+    for name, value in fields.items():
+        args.extend([name, value])
+    for job_id, policy in children.items():
+        args.extend([job_id, policy])
+    return bool(_create_script(
+        keys=[
+            _graph_key(graph_id),
+            _done_key(graph_id),
+            _children_key(graph_id),
+            ACTIVE_KEY
+        ],
+        args=args
+    ))
+
+
+def discard(graph_id, run_id):
+    """
+    Olvida el grafo de un intento que falló antes de quedar armado, para que
+    el sweeper no lo aborte mientras espera el reintento.
+    """
+    return bool(_discard_script(
+        keys=[
+            _graph_key(graph_id),
+            _done_key(graph_id),
+            _children_key(graph_id),
+            ACTIVE_KEY
+        ],
+        args=[run_id, str(graph_id)]
+    ))
+
+
+def get_status(graph_id):
+    raw = _redis.hgetall(_graph_key(graph_id))
+    if not raw:
+        return None
+    data = {k.decode("utf-8"): v.decode("utf-8") for k, v in raw.items()}
+    data["remaining"] = int(data.get("remaining") or 0)
+    data["failed"] = int(data.get("failed") or 0)
+    return data
+
+
+def is_child(job):
+    return bool(job and (job.meta or {}).get(META_KEY))
+
+
+def is_active(job):
+    """False si el grafo del job abortó o ya es de otro intento: no correrlo."""
+    graph = job.meta[META_KEY]
+    run, state = _redis.hmget(_graph_key(graph["id"]), "run", "state")
+    if run is None or run.decode("utf-8") != graph["run"]:
+        return False
+    return state.decode("utf-8") not in INACTIVE_STATES
+
+
+def child_finished(job, outcome=OUTCOME_OK):
+    """Llamado por worker.dispatch cuando un hijo termina del todo."""
+    if not is_child(job):
+        return None
+    graph = job.meta[META_KEY]
+    return _complete(graph["id"], graph["run"], [job.id], outcome, graph.get("policy"), job)
+
+
+def _complete(graph_id, run_id, job_ids, outcome, policy, failed_job=None):
+    result = _complete_script(
+        keys=[_graph_key(graph_id), _done_key(graph_id)],
+        args=[run_id, outcome, policy or POLICY_CONTINUE, GRAPH_TTL] + list(job_ids)
+    )
+    action = result[0].decode("utf-8") if isinstance(result[0], bytes) else result[0]
+
+    if action == "release":
+        _release_final(graph_id, run_id)
+    elif action == "abort":
+        _abort(graph_id, run_id, failed_job, job_ids)
+    elif action == "abort_done":
+        # El hijo que abortó era el último: no queda nada que cancelar
+        if int(result[2]):
+            _abort(graph_id, run_id, failed_job, job_ids)
+        _finish_abort(graph_id, run_id)
+    elif action == "stale":
+        log.info("Jobs %s pertenecen a otro intento de %s", ",".join(job_ids), graph_id)
+    return action
+
+
+def _release_final(graph_id, run_id):
+    status = get_status(graph_id)
+    if not status:
+        return
+    queue = get_queue(status["queue"])
+    try:
+        job = Job.fetch(status["final_job"], connection=queue.connection)
+    except NoSuchJobError:
+        log.warning("Job final %s de %s ya no existe", status["final_job"], graph_id)
+        job = None
+    if job is not None and job.get_status() == JobStatus.DEFERRED:
+        enqueue_deferred(queue, job)
+        if status["failed"]:
+            log.warning("Grafo %s: %d hijos fallaron; se finaliza igual", graph_id, status["failed"])
+    _finish_script(keys=[_graph_key(graph_id), ACTIVE_KEY], args=[run_id, STATE_RELEASED, graph_id])
+
+
+def _abort(graph_id, run_id, failed_job, job_ids):
+    """
+    El final no corre y lo que no empezó se cancela. Los hijos en curso (el
+    lote de fotos, transcripciones ya soltadas) terminan o se saltan en
+    dispatch; on_abort se encola cuando el contador llega a cero.
+    """
+    status = get_status(graph_id) or {}
+    reason = _abort_reason(failed_job, job_ids)
+    log.error("Grafo %s abortado: %s", graph_id, reason)
+    _redis.hset(_graph_key(graph_id), "reason", reason)
+
+    final_id = status.get("final_job")
+    if final_id:
+        try:
+            Job.fetch(final_id, connection=_redis).delete()
+        except NoSuchJobError:
+            pass
+
+    dropped = []
+    for queue_name in filter(None, (status.get("fair_queues") or "").split(",")):
+        dropped.extend(fair_queue.drop_project(queue_name, graph_id))
+    if dropped:
+        log.info("Grafo %s: %d hijos pendientes cancelados", graph_id, len(dropped))
+        _complete(graph_id, run_id, dropped, OUTCOME_CANCELLED, POLICY_CONTINUE)
+
+
+def _abort_reason(failed_job, job_ids):
+    if failed_job is not None and failed_job.args:
+        return f"Falló el job {failed_job.args[0]}"
+    return f"Falló el job {job_ids[0]}" if job_ids else "Falló un job"
+
+
+def _finish_abort(graph_id, run_id):
+    status = get_status(graph_id) or {}
+    on_abort = status.get("on_abort")
+    if on_abort and status.get("queue"):
+        get_queue(status["queue"]).enqueue(
+            "worker.dispatch",
+            on_abort,
+            graph_id,
+            status.get("reason") or "Falló un job",
+            run_id
+        )
+    _finish_script(keys=[_graph_key(graph_id), ACTIVE_KEY], args=[run_id, STATE_ABORTED, graph_id])
+
+
+def sweep_graph(graph_id):
+    """
+    Cuenta como fallidos los hijos que ya no van a avisar: borrados, o en
+    failed/stopped/canceled sin haber pasado por dispatch (work-horse matado,
+    timeout fuera del proceso, job abandonado que RQ movió a failed).
+    """
+    status = get_status(graph_id)
+    if not status:
+        _redis.zrem(ACTIVE_KEY, graph_id)
+        return 0
+    run_id = status["run"]
+    state = status.get("state")
+    if state == "releasing":
+        _release_final(graph_id, run_id)
+        return 0
+    if state == "abort_releasing":
+        _finish_abort(graph_id, run_id)
+        return 0
+    if state not in ("waiting", "aborting"):
+        _redis.zrem(ACTIVE_KEY, graph_id)
+        return 0
+
+    children = {
+        job_id.decode("utf-8"): policy.decode("utf-8")
+        for job_id, policy in _redis.hgetall(_children_key(graph_id)).items()
+    }
+    done = {job_id.decode("utf-8") for job_id in _redis.smembers(_done_key(graph_id))}
+    pending = [job_id for job_id in children if job_id not in done]
+    if not pending:
+        return 0
+
+    young = time.time() - float(status.get("created_at") or 0) < SWEEP_GRACE_SECONDS
+    dead = []
+    for job_id, job in zip(pending, Job.fetch_many(pending, connection=_redis)):
+        if job is None:
+            if not young:
+                dead.append(job_id)
+        elif job.get_status(refresh=False) in DEAD_STATUSES:
+            dead.append(job_id)
+    for job_id in dead:
+        log.warning("Grafo %s: hijo %s murió sin avisar", graph_id, job_id)
+        _complete(graph_id, run_id, [job_id], OUTCOME_FAILED, children[job_id])
+    return len(dead)
+
+
+def sweep_graphs():
+    swept = 0
+    horizon = time.time() - GRAPH_TTL
+    _redis.zremrangebyscore(ACTIVE_KEY, "-inf", horizon)
+    for raw_id in _redis.zrange(ACTIVE_KEY, 0, -1):
+        graph_id = raw_id.decode("utf-8")
+        try:
+            swept += sweep_graph(graph_id)
+        except Exception as e:
+            log.error("Error revisando grafo %s: %s", graph_id, e)
+    return swept
+
+
+def run_sweep_loop(interval_seconds=60):
+    while True:
+        try:
+            sweep_graphs()
+        except Exception as e:
+            log.error("Error en sweeper de grafos: %s", e)
+        time.sleep(interval_seconds)
@@ -3,7 +3,7 @@ import time
 from pathlib import Path
 
 from logger import get_logger
-from services import project_store, timeline, quotas
+from services import project_store, timeline, transcript_assembler, quotas
 from services.lm import render
 from services.cleanup import cleanup_project_files
 from services.lm.llm_service import (
@@ -29,11 +29,25 @@ def finalize_project_job(project_id):
         raise RuntimeError("Sin segmentos para procesar")
 
     ordered_segments = sorted(segments.values(), key=lambda s: s.get("start_ms", 0))
-    transcript = " ".join(seg.get("text", "") for seg in ordered_segments if seg.get("text")).strip()
 
     photos = timeline.get_photos(project_id)
+    _refund_unused_stylize_quota(project_id, state, photos)
     sorted_photos = sorted(photos, key=lambda p: p.get("t_ms", 0))
-    transcript_with_markers = _insert_photo_markers(ordered_segments, sorted_photos)
+
+    # Normalmente los transcribe ya dejaron todo armado en Redis; si no está
+    # completo o no coincide con la base (Redis reiniciado, segmentos de otra
+    # corrida) se arma acá
+    transcript = " ".join(seg.get("text", "") for seg in ordered_segments if seg.get("text")).strip()
+    plain = transcript_assembler.get_transcript(project_id)
+    marked = transcript_assembler.get_transcript(project_id, with_markers=True)
+    if (
+        _is_assembled(plain, ordered_segments)
+        and _is_assembled(marked, ordered_segments)
+        and plain["text"] == transcript
+    ):
+        transcript_with_markers = marked["text"]
+    else:
+        transcript_with_markers = _insert_photo_markers(ordered_segments, sorted_photos)
 
     project_dir = project_store.get_project_dir(project_id)
     Path(project_dir).mkdir(parents=True, exist_ok=True)
@@ -76,6 +90,7 @@ def finalize_project_job(project_id):
         "processing_metrics": metrics,
         "transcript": transcript
     })
+    project_store.record_processing_stats(project_id, state.get("user_id"), metrics)
 
     project_store.update_project_status(
         project_id,
@@ -93,29 +108,59 @@ def finalize_project_job(project_id):
     log.info("Proyecto %s finalizado", project_id)
 
 
+def fail_project_job(project_id, reason, graph_run=None):
+    """Cierre del pipeline cuando job_graph lo aborta: sin guion, a error."""
+    state = project_store.load_state(project_id)
+    if not state:
+        return
+    # Un grafo de un intento anterior de prepare no decide por el vigente
+    current_run = (state.get("processing_jobs") or {}).get("graph_run")
+    if graph_run and current_run != graph_run:
+        log.info("Proyecto %s: aborto del grafo %s ignorado (vigente %s)", project_id, graph_run, current_run)
+        return
+    _refund_unused_stylize_quota(project_id, state, timeline.get_photos(project_id))
+    project_store.update_project_status(project_id, status="error", error_message=reason)
+    log.error("Proyecto %s abortado: %s", project_id, reason)
+
+
+def _refund_unused_stylize_quota(project_id, state, photos):
+    # prepare_project reservó una unidad por foto encolada; se devuelven las
+    # que no terminaron estilizadas. La marca evita devolver dos veces si
+    # finalize se reintenta.
+    jobs = state.get("processing_jobs") or {}
+    reserved = int(jobs.get("stylize_quota_reserved") or 0)
+    user_id = state.get("user_id")
+    if not reserved or not user_id or jobs.get("stylize_quota_refunded"):
+        return
+
+    reserved_ids = set((jobs.get("photos") or {}).keys())
+    stylized = len([
+        p for p in photos
+        if p.get("photo_id") in reserved_ids and p.get("stylized_path")
+    ])
+    unused = max(0, reserved - stylized)
+    project_store.update_processing_jobs(project_id, {"stylize_quota_refunded": True})
+    if unused:
+        quotas.release_stylize_quota(user_id, unused)
+        log.info("Proyecto %s: %d estilizaciones devueltas", project_id, unused)
+
+
+def _is_assembled(assembled, segments):
+    return bool(assembled) and assembled["complete"] and assembled["segments_total"] == len(segments)
+
+
 # Hay una explicación muy interesante de por qué hago esto. algún día lo
 # documentaré
 def _insert_photo_markers(segments, photos):
+    markers, leftover = transcript_assembler.photo_markers(segments, photos)
     parts = []
-    sorted_photos = sorted(photos, key=lambda p: p.get("t_ms", 0))
-    photo_index = 0
-    total_photos = len(sorted_photos)
-
-    for segment in segments:
+    for segment, marker in zip(segments, markers):
         text = segment.get("text", "")
         if text:
             parts.append(text)
-
-        segment_end = segment.get("end_ms", 0)
-        while photo_index < total_photos and sorted_photos[photo_index].get("t_ms", 0) <= segment_end:
-            photo_id = sorted_photos[photo_index]["photo_id"]
-            parts.append(f" [[FOTO:{photo_id}]] ")
-            photo_index += 1
-
-    while photo_index < total_photos:
-        parts.append(f" [[FOTO:{sorted_photos[photo_index]['photo_id']}]] ")
-        photo_index += 1
-
+        parts.append(marker)
+    if not segments:
+        parts.append(leftover)
     return "".join(parts).strip()
 
 
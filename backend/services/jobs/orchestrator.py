@@ -3,24 +3,28 @@ from rq import Retry
 from config import Config
 from logger import get_logger
 from services import project_store
-from services.queue import get_queue
-from rq import Retry
+from services.queue import LANE_HIGH, LANES, get_lane_queue
 
 
 log = get_logger("orchestrator")
 
 
-def enqueue_processing_pipeline(project_id):
-    queue = get_queue(Config.RQ_PREPARE_QUEUE)
+def enqueue_processing_pipeline(project_id, lane=LANE_HIGH):
+    if lane not in LANES:
+        raise ValueError(f"Lane desconocida: {lane}")
+    queue = get_lane_queue(Config.RQ_PREPARE_QUEUE, lane)
     retry = Retry(max=3, interval=[10, 60, 180])
+    # La lane va como argumento: un worker libre puede tomar prepare antes
+    # de que processing_jobs la registre
     job = queue.enqueue(
         "worker.dispatch",
         "prepare_project",
         project_id,
+        lane,
         job_timeout=Config.PREPARE_PROJECT_TIMEOUT,
         retry=retry
     )
-    project_store.update_processing_jobs(project_id, {"prepare": job.id})
+    project_store.update_processing_jobs(project_id, {"prepare": job.id, "lane": lane})
     project_store.update_project_status(project_id, status="queued", job_id=job.id)
-    log.info("Proyecto %s en cola (prepare job %s)", project_id, job.id)
+    log.info("Proyecto %s en cola (prepare job %s, lane %s)", project_id, job.id, lane)
     return job
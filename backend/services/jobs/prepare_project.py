@@ -1,27 +1,42 @@
 import os
-import os
 import shutil
 import subprocess
+import uuid
 
 from rq import Retry, get_current_job
 
 from config import Config
 from logger import get_logger
-from services import project_store, timeline
-from services.queue import get_queue
+from services import fair_queue, job_graph, project_store, quotas, timeline, transcript_assembler
+from services.jobs.stylize_photo_job import stylize_batch_timeout
+from services.queue import LANE_HIGH, get_lane_queue
 from services.storage import get_audio_storage
 
 
 log = get_logger("prepare_project")
 
 
-def prepare_project_job(project_id):
+def prepare_project_job(project_id, lane=None):
     log.info("Preparando proyecto %s", project_id)
 
     state = project_store.load_state(project_id)
     if not state:
         raise RuntimeError("Proyecto no encontrado")
 
+    # Cada etapa deja un checkpoint; un reintento (o un reproceso) retoma
+    # desde la última completa en vez de rehacer todo
+    checkpoints = (state.get("processing_jobs") or {}).get("checkpoints") or {}
+    current_job = get_current_job()
+    run_id = current_job.id if current_job else None
+    if run_id and checkpoints.get("jobs_enqueued") == run_id:
+        log.info("Proyecto %s: jobs ya encolados por este prepare", project_id)
+        project_store.update_project_status(
+            project_id,
+            status="processing",
+            job_id=state["processing_jobs"].get("finalize")
+        )
+        return
+
     ingest = state.get("ingest", {})
     chunks = sorted(ingest.get("chunks", []), key=lambda c: c.get("seq", 0))
     if not chunks:
@@ -33,98 +48,231 @@ def prepare_project_job(project_id):
     os.makedirs(audio_dir, exist_ok=True)
     os.makedirs(segments_dir, exist_ok=True)
 
-    storage = get_audio_storage()
-    local_paths = []
-    cleanup = []
-    for chunk in chunks:
-        path, is_temp = storage.ensure_local_file(project_id, chunk)
-        absolute = os.path.abspath(path)
-        local_paths.append(absolute)
-        if is_temp:
-            cleanup.append(absolute)
-
     full_wav = os.path.join(audio_dir, "full.wav")
-    _build_wav_from_chunks(project_id, local_paths, full_wav)
-
-    for temp in cleanup:
-        try:
-            os.remove(temp)
-        except OSError:
-            pass
+    if checkpoints.get("full_wav") and os.path.exists(full_wav):
+        log.info("Proyecto %s: full.wav ya construido", project_id)
+    else:
+        _build_full_wav(project_id, chunks, full_wav)
+        project_store.update_checkpoints(project_id, {"full_wav": True})
 
     duration_ms = ingest.get("duration_ms", 0)
     photos = timeline.get_photos(project_id)
-    segments = _slice_segments(full_wav, segments_dir, duration_ms, photos)
+    segments = state.get("segments") or {}
+    if checkpoints.get("segments") and _segments_on_disk(project_dir, segments):
+        log.info("Proyecto %s: %d segmentos ya cortados", project_id, len(segments))
+    else:
+        segments = _slice_segments(full_wav, segments_dir, duration_ms, photos)
+        project_store.replace_segments(project_id, segments)
+        project_store.update_checkpoints(project_id, {"segments": True})
+
+    # Orden y marcadores de foto fijos desde ya; los transcribe van armando
+    # la transcripción a medida que terminan
+    try:
+        transcript_assembler.init(project_id, segments, photos)
+    except Exception as e:
+        log.warning("No se pudo iniciar el ensamblado de %s: %s", project_id, e)
 
-    project_store.replace_segments(project_id, segments)
     stylize_enabled = state.get("stylize_photos", True)
     project_store.update_state_fields(project_id, {
         "photos_total": len(photos) if stylize_enabled else 0,
         "photos_done": len([p for p in photos if p.get("stylized_path")])
     })
 
-    current_job = get_current_job()
     retry_fast = Retry(max=2, interval=[10, 30])
-    transcribe_queue = get_queue(Config.RQ_TRANSCRIBE_QUEUE)
-    stylize_queue = get_queue(Config.RQ_PHOTO_QUEUE)
-    finalize_queue = get_queue(Config.RQ_LLM_QUEUE)
-
-    transcribe_jobs = []
-    for segment_id in segments.keys():
-        job = transcribe_queue.enqueue(
-            "worker.dispatch",
-            "transcribe_segment",
-            project_id,
-            segment_id,
-            job_timeout=Config.TRANSCRIBE_JOB_TIMEOUT,
-            retry=retry_fast,
-            depends_on=current_job
+    # Todo el pipeline sigue en la lane con que se encoló prepare; los jobs
+    # encolados antes de que viniera como argumento la tienen en el estado
+    lane = lane or (state.get("processing_jobs") or {}).get("lane", LANE_HIGH)
+    transcribe_queue = get_lane_queue(Config.RQ_TRANSCRIBE_QUEUE, lane)
+    stylize_queue = get_lane_queue(Config.RQ_PHOTO_QUEUE, lane)
+    finalize_queue = get_lane_queue(Config.RQ_LLM_QUEUE, lane)
+
+    pending_photos = []
+    if stylize_enabled:
+        pending_photos = [p for p in photos if not p.get("stylized_path")]
+
+    # Una sola reserva para todas las fotos; solo se encolan las concedidas
+    user_id = state.get("user_id")
+    quota_reserved = 0
+    if pending_photos and user_id:
+        granted, error = quotas.reserve_stylize_batch(
+            user_id,
+            len(pending_photos),
+            reason="photo_stylize"
         )
-        transcribe_jobs.append((segment_id, job))
-
-    stylize_jobs = []
-    if state.get("stylize_photos", True):
-        for photo in photos:
-            if photo.get("stylized_path"):
-                continue
-            job = stylize_queue.enqueue(
+        if granted < len(pending_photos):
+            log.warning(
+                "Cuota de estilizado insuficiente (%d/%d): %s",
+                granted,
+                len(pending_photos),
+                error
+            )
+        pending_photos = pending_photos[:granted]
+        quota_reserved = granted
+
+    # Cada intento arma su propio grafo: si este falla a medias, los jobs que
+    # alcanzó a crear no cuentan para el del reintento (que tiene el mismo
+    # job id de RQ)
+    graph_run = f"{run_id or 'local'}.{uuid.uuid4().hex[:8]}"
+    created_jobs = []
+    try:
+        pending_segments = [
+            segment_id for segment_id, segment in segments.items()
+            if segment.get("status") != "done"
+        ]
+        stylize_job_id = str(uuid.uuid4()) if pending_photos else None
+
+        # finalize no usa depends_on: queda diferido y job_graph lo suelta
+        # cuando termina el último hijo. Sin hijos, espera solo a prepare.
+        if pending_segments or stylize_job_id:
+            finalize_job = fair_queue.create_deferred_job(
+                finalize_queue,
+                "finalize_project",
+                project_id,
+                timeout=Config.LLM_JOB_TIMEOUT,
+                retry=Retry(max=1)
+            )
+        else:
+            finalize_job = finalize_queue.enqueue(
                 "worker.dispatch",
-                "stylize_photo",
+                "finalize_project",
                 project_id,
-                photo["photo_id"],
-                job_timeout=Config.PHOTO_JOB_TIMEOUT,
+                depends_on=current_job,
+                job_timeout=Config.LLM_JOB_TIMEOUT,
+                retry=Retry(max=1)
+            )
+        created_jobs.append(finalize_job)
+
+        # Las transcripciones no van directo a RQ: quedan diferidas y
+        # fair_queue las va soltando en round-robin entre proyectos. Sin un
+        # segmento el guion no sirve, así que una que falle aborta el grafo.
+        transcribe_jobs = []
+        for segment_id in pending_segments:
+            job = fair_queue.create_deferred_job(
+                transcribe_queue,
+                "transcribe_segment",
+                project_id,
+                segment_id,
+                timeout=Config.TRANSCRIBE_JOB_TIMEOUT,
                 retry=retry_fast,
-                depends_on=current_job
+                meta=job_graph.child_meta(project_id, graph_run, job_graph.POLICY_ABORT)
+            )
+            transcribe_jobs.append((segment_id, job))
+            created_jobs.append(job)
+
+        children = {job.id: job_graph.POLICY_ABORT for _, job in transcribe_jobs}
+        if stylize_job_id:
+            # Las fotos que fallen no frenan el guion
+            children[stylize_job_id] = job_graph.POLICY_CONTINUE
+        if children:
+            job_graph.create(
+                project_id,
+                graph_run,
+                children,
+                finalize_job,
+                on_abort="fail_project",
+                fair_queues=[transcribe_queue.name]
             )
-            stylize_jobs.append((photo["photo_id"], job))
 
-    depends = [job for _, job in transcribe_jobs]
-    depends.extend(job for _, job in stylize_jobs)
-    finalize_job = finalize_queue.enqueue(
-        "worker.dispatch",
-        "finalize_project",
-        project_id,
-        depends_on=depends or current_job,
-        job_timeout=Config.LLM_JOB_TIMEOUT,
-        retry=Retry(max=1)
-    )
+        jobs_state = {
+            "prepare": current_job.id if current_job else None,
+            "transcribe": {seg_id: job.id for seg_id, job in transcribe_jobs},
+            "photos": {photo["photo_id"]: stylize_job_id for photo in pending_photos},
+            "finalize": finalize_job.id,
+            "graph_run": graph_run,
+            "stylize_quota_reserved": quota_reserved,
+            "lane": lane,
+            "checkpoints": dict(checkpoints, full_wav=True, segments=True)
+        }
+        project_store.set_processing_jobs(project_id, jobs_state)
+        fair_queue.submit(
+            transcribe_queue.name,
+            project_id,
+            [job for _, job in transcribe_jobs]
+        )
 
-    jobs_state = {
-        "prepare": current_job.id if current_job else None,
-        "transcribe": {seg_id: job.id for seg_id, job in transcribe_jobs},
-        "photos": {photo_id: job.id for photo_id, job in stylize_jobs},
-        "finalize": finalize_job.id
-    }
-    project_store.set_processing_jobs(project_id, jobs_state)
+        # Un solo job de estilizado por proyecto, con los reintentos por foto
+        # adentro. Va último: es el único que consume la cuota reservada, así
+        # que solo se encola si todo lo anterior quedó registrado.
+        if stylize_job_id:
+            created_jobs.append(stylize_queue.enqueue(
+                "worker.dispatch",
+                "stylize_project_photos",
+                project_id,
+                [photo["photo_id"] for photo in pending_photos],
+                job_id=stylize_job_id,
+                job_timeout=stylize_batch_timeout(len(pending_photos)),
+                retry=retry_fast,
+                depends_on=current_job,
+                meta=job_graph.child_meta(project_id, graph_run, job_graph.POLICY_CONTINUE)
+            ))
+
+        # Recién con todo encolado: un reintento de este prepare que vea el
+        # checkpoint no rehace nada
+        project_store.update_checkpoints(project_id, {"jobs_enqueued": run_id})
+    except Exception:
+        # prepare se reintenta: no dejar jobs huérfanos de este intento ni la
+        # reserva colgando (ni registrada, para que nadie la devuelva de nuevo)
+        _discard_jobs(project_id, transcribe_queue.name, created_jobs, graph_run)
+        if quota_reserved:
+            quotas.release_stylize_quota(user_id, quota_reserved)
+            try:
+                project_store.update_processing_jobs(project_id, {"stylize_quota_reserved": 0})
+            except Exception as e:
+                log.warning("No se pudo limpiar la reserva registrada de %s: %s", project_id, e)
+        raise
     project_store.update_project_status(project_id, status="processing", job_id=finalize_job.id)
     log.info(
-        "Proyecto %s: %d segmentos, %d fotos encoladas",
+        "Proyecto %s: %d/%d segmentos y %d fotos encoladas",
         project_id,
+        len(pending_segments),
         len(segments),
-        len(stylize_jobs)
+        len(pending_photos)
     )
 
 
+def _discard_jobs(project_id, fair_queue_name, jobs, graph_run):
+    try:
+        # Primero el grafo: sin él el sweeper no ve a los hijos borrados
+        job_graph.discard(project_id, graph_run)
+        fair_queue.drop_project(fair_queue_name, project_id)
+        for job in jobs:
+            job.delete()
+    except Exception as e:
+        log.warning("No se pudieron descartar jobs de %s: %s", project_id, e)
+
+
+def _build_full_wav(project_id, chunks, full_wav):
+    storage = get_audio_storage()
+    local_paths = []
+    cleanup = []
+    for chunk in chunks:
+        path, is_temp = storage.ensure_local_file(project_id, chunk)
+        absolute = os.path.abspath(path)
+        local_paths.append(absolute)
+        if is_temp:
+            cleanup.append(absolute)
+
+    _build_wav_from_chunks(project_id, local_paths, full_wav)
+
+    for temp in cleanup:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+
+
+def _segments_on_disk(project_dir, segments):
+    if not segments:
+        return False
+    for segment in segments.values():
+        if segment.get("status") == "done":
+            continue
+        wav_path = os.path.join(project_dir, segment.get("wav_path") or "")
+        if not os.path.exists(wav_path):
+            return False
+    return True
+
+
 def _build_wav_from_chunks(project_id, chunk_paths, output_path):
     output_dir = os.path.abspath(os.path.dirname(output_path))
     os.makedirs(output_dir, exist_ok=True)
@@ -136,8 +284,12 @@ def _build_wav_from_chunks(project_id, chunk_paths, output_path):
                 shutil.copyfileobj(src, combined)
             total_bytes += os.path.getsize(path)
 
+    # Se escribe aparte y se renombra: un full.wav a medias nunca queda con
+    # el nombre final
+    partial_path = output_path + ".partial.wav"
     cmd = [
         "ffmpeg",
+        "-y",
         "-hide_banner",
         "-loglevel",
         "error",
@@ -149,9 +301,10 @@ def _build_wav_from_chunks(project_id, chunk_paths, output_path):
         "1",
         "-c:a",
         "pcm_s16le",
-        output_path
+        partial_path
     ]
     subprocess.run(cmd, check=True)
+    os.replace(partial_path, output_path)
 
     try:
         os.remove(combined_path)
@@ -193,6 +346,7 @@ def _extract_segment(source_wav, segments_dir, segment_id, start_ms, end_ms):
     duration_sec = (end_ms - start_ms) / 1000.0
     cmd = [
         "ffmpeg",
+        "-y",
         "-hide_banner",
         "-loglevel",
         "error",
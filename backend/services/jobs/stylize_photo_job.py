@@ -1,8 +1,14 @@
+import math
 import os
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
+from config import Config
 from logger import get_logger
-from services import project_store, timeline, quotas
+from services import project_store, timeline
 from services.media.image_stylize import stylize_image_file
 
 
@@ -10,29 +16,16 @@ log = get_logger("stylize_photo")
 
 
 def stylize_photo_job(project_id, photo_id):
-    state = project_store.load_state(project_id) or {}
-    user_id = state.get("user_id")
-    quota_used = False
-    if user_id:
-        ok, error = quotas.reserve_stylize_quota(user_id, reason="photo_stylize")
-        if not ok:
-            log.warning("Cuota de estilizado no disponible: %s", error)
-            return
-        quota_used = True
-
-    photos = timeline.get_photos(project_id)
-    target = next((p for p in photos if p["photo_id"] == photo_id), None)
+    # La cuota ya se reservó en prepare_project; lo que no se use se devuelve
+    # en finalize_project
+    target = timeline.get_photo(project_id, photo_id)
     if not target:
         log.warning("Foto %s no encontrada", photo_id)
-        if quota_used and user_id:
-            quotas.release_stylize_quota(user_id)
         return
 
     original_path = target.get("original_path")
     if not original_path or not os.path.exists(original_path):
         log.warning("Foto %s sin archivo original", photo_id)
-        if quota_used and user_id:
-            quotas.release_stylize_quota(user_id)
         return
 
     project_dir = project_store.get_project_dir(project_id)
@@ -44,9 +37,146 @@ def stylize_photo_job(project_id, photo_id):
 
     if not success:
         log.error("Falló estilizado de %s", photo_id)
-        if quota_used and user_id:
-            quotas.release_stylize_quota(user_id)
         return
 
     timeline.update_photo_stylized(project_id, photo_id, stylized_path)
     log.info("Foto %s estilizada en %.2fs", photo_id, elapsed)
+
+
+# Cada cuántas fotos terminadas se escribe a la base dentro del lote
+PHOTO_RESULTS_FLUSH_SIZE = 8
+# Margen antes del job_timeout para guardar lo terminado y salir
+PHOTO_BATCH_MARGIN_SECONDS = 30
+
+# Llamadas que un lote dejó corriendo al vencer su plazo. El proceso del
+# worker sigue vivo (SimpleWorker/slots), así que se cuentan; con su lote
+# cancelado descartan lo que generen en vez de dejarlo como estilizado.
+_abandoned = set()
+_abandoned_lock = threading.Lock()
+
+
+def stylize_batch_timeout(photo_count):
+    """
+    job_timeout del lote: una ronda de PHOTO_JOB_TIMEOUT por cada tanda de
+    hilos, con techo. Cada foto tiene su propio plazo adentro del job.
+    """
+    rounds = math.ceil(photo_count / max(1, Config.PHOTO_STYLIZE_CONCURRENCY))
+    return min(Config.PHOTO_JOB_TIMEOUT * max(1, rounds), Config.PHOTO_BATCH_MAX_TIMEOUT)
+
+
+def _stylize_with_retries(project_dir, photo, batch_deadline, cancelled):
+    photo_id = photo["photo_id"]
+    original_path = photo.get("original_path")
+    if not original_path or not os.path.exists(original_path):
+        log.warning("Foto %s sin archivo original", photo_id)
+        return None
+
+    stylized_path = os.path.join(project_dir, "photos", f"stylized_{photo_id}.jpg")
+    # Se escribe aparte y se renombra solo si el lote sigue esperando
+    partial_path = os.path.join(project_dir, "photos", f"stylized_{photo_id}.{uuid.uuid4().hex[:8]}.partial.jpg")
+    # Los reintentos de una foto caben en PHOTO_JOB_TIMEOUT y en lo que le
+    # queda al lote
+    deadline = min(time.time() + Config.PHOTO_JOB_TIMEOUT, batch_deadline)
+    attempts = Config.PHOTO_STYLIZE_RETRIES + 1
+    for attempt in range(attempts):
+        start = time.time()
+        if stylize_image_file(original_path, partial_path):
+            if cancelled.is_set():
+                log.warning("Foto %s terminó con su lote ya cancelado; se descarta", photo_id)
+                _remove_quietly(partial_path)
+                return None
+            os.replace(partial_path, stylized_path)
+            log.info("Foto %s estilizada en %.2fs", photo_id, time.time() - start)
+            return stylized_path
+        if attempt + 1 >= attempts or cancelled.is_set():
+            break
+        backoff = min(30, 2 ** (attempt + 1))
+        if time.time() + backoff >= deadline:
+            log.error("Falló estilizado de %s: sin plazo para reintentar", photo_id)
+            return None
+        time.sleep(backoff)
+
+    log.error("Falló estilizado de %s tras %d intentos", photo_id, attempts)
+    return None
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _track_abandoned(futures):
+    with _abandoned_lock:
+        _abandoned.difference_update([f for f in _abandoned if f.done()])
+        _abandoned.update(f for f in futures if not f.done())
+        return len(_abandoned)
+
+
+def stylize_project_photos_job(project_id, photo_ids):
+    """
+    Un solo job por proyecto: lee las fotos una vez, estiliza con un pool
+    acotado y guarda los resultados en lote. Reejecutarlo solo procesa las
+    que siguen sin estilizar.
+    """
+    wanted = set(photo_ids or [])
+    photos = [
+        p for p in timeline.get_photos(project_id)
+        if p["photo_id"] in wanted and not p.get("stylized_path")
+    ]
+    if not photos:
+        return
+
+    project_dir = project_store.get_project_dir(project_id)
+    workers = max(1, min(Config.PHOTO_STYLIZE_CONCURRENCY, len(photos)))
+    start = time.time()
+    # Mismo cálculo que el job_timeout con el que se encoló
+    batch_deadline = start + max(0, stylize_batch_timeout(len(wanted)) - PHOTO_BATCH_MARGIN_SECONDS)
+    done = 0
+    finished = 0
+    timed_out = False
+    pending = {}
+    cancelled = threading.Event()
+    # Sin with: al vencer el plazo no se espera a las llamadas colgadas
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = {}
+    try:
+        for photo in photos:
+            future = pool.submit(_stylize_with_retries, project_dir, photo, batch_deadline, cancelled)
+            futures[future] = photo["photo_id"]
+        try:
+            for future in as_completed(futures, timeout=max(0, batch_deadline - time.time())):
+                finished += 1
+                stylized_path = future.result()
+                if not stylized_path:
+                    continue
+                pending[futures[future]] = stylized_path
+                if len(pending) >= PHOTO_RESULTS_FLUSH_SIZE:
+                    done += timeline.update_photos_stylized(project_id, pending)
+                    pending = {}
+        except FuturesTimeoutError:
+            timed_out = True
+    finally:
+        cancelled.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+        abandoned = _track_abandoned(futures)
+        if abandoned:
+            log.warning("Estilizado: %d llamadas abandonadas siguen corriendo en este proceso", abandoned)
+        # Lo que ya terminó se guarda aunque el lote haya fallado
+        if pending:
+            done += timeline.update_photos_stylized(project_id, pending)
+
+    log.info(
+        "Proyecto %s: %d/%d fotos estilizadas en %.2fs (%d hilos)",
+        project_id,
+        done,
+        len(photos),
+        time.time() - start,
+        workers
+    )
+    if timed_out:
+        # Que RQ lo reintente: el reintento solo toma las que faltan
+        raise RuntimeError(
+            f"Plazo del lote vencido: {len(photos) - finished} fotos de {project_id} sin estilizar"
+        )
@@ -1,20 +1,58 @@
 import os
 import time
 
+from rq import get_current_job
+
+from config import Config
 from logger import get_logger
-from services import project_store
+from services import fair_queue, project_store, transcript_assembler
+from services.cache import get_redis_client
 from services.media.stt_service import transcribe_wav
 
 
 log = get_logger("transcribe_segment")
+_redis = get_redis_client()
+
+LOCK_POLL_SECONDS = 2
 
 
 def transcribe_segment_job(project_id, segment_id):
+    try:
+        _transcribe_segment(project_id, segment_id)
+    finally:
+        # Se liberó lugar en la cola (de esta lane): que pase el siguiente proyecto
+        job = get_current_job()
+        fair_queue.pump(job.origin if job else Config.RQ_TRANSCRIBE_QUEUE)
+
+
+def _transcribe_segment(project_id, segment_id):
     segment = project_store.get_segment(project_id, segment_id)
     if not segment:
         log.error("Segmento %s no encontrado", segment_id)
         return
 
+    # El estado done es el checkpoint: un reintento o un job duplicado no
+    # vuelve a transcribir
+    if segment.get("status") == "done":
+        log.info("Segmento %s ya transcrito", segment_id)
+        return
+
+    # Si otro job ya lo está transcribiendo se espera a que termine en vez de
+    # salir: finalize depende de que este job acabe con el segmento listo
+    lock_key = f"transcribe:lock:{project_id}:{segment_id}"
+    while not _redis.set(lock_key, b"1", nx=True, ex=Config.TRANSCRIBE_JOB_TIMEOUT):
+        log.info("Segmento %s ya se está transcribiendo; esperando", segment_id)
+        time.sleep(LOCK_POLL_SECONDS)
+        segment = project_store.get_segment(project_id, segment_id)
+        if not segment or segment.get("status") == "done":
+            return
+    try:
+        _run_transcription(project_id, segment_id, segment)
+    finally:
+        _redis.delete(lock_key)
+
+
+def _run_transcription(project_id, segment_id, segment):
     project_dir = project_store.get_project_dir(project_id)
     wav_path = os.path.join(project_dir, segment["wav_path"])
     start = time.time()
@@ -27,4 +65,5 @@ def transcribe_segment_job(project_id, segment_id):
             fh.write(text)
 
     project_store.update_segment_text(project_id, segment_id, text, elapsed)
+    transcript_assembler.add_segment(project_id, segment_id, text)
     log.info("Segmento %s transcrito en %.2fs", segment_id, elapsed)
@@ -1,13 +1,14 @@
+import base64
 import json
 import os
 import shutil
 import uuid
 from datetime import datetime, timedelta, timezone
-from decimal import Decimal
 from typing import cast
 
 from sqlalchemy import update
-from sqlalchemy import update, func
+from sqlalchemy import Numeric, String, Text, column, delete, select, update, func, tuple_, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from config import Config
 from extensions import Session
@@ -18,9 +19,12 @@ from models import (
     ProjectState,
     ProjectSegment,
     ProjectIngestChunk,
+    ProjectProcessingStats,
+    ProjectTag,
     utcnow
 )
 from services.cache import get_redis_client
+from services.storage import get_audio_storage
 
 
 log = get_logger("project_state")
@@ -36,6 +40,11 @@ def _to_uuid(value):
         return None
 
 
+def to_uuid(value):
+    """UUID del valor, o None si no es un UUID válido."""
+    return _to_uuid(value)
+
+
 def _state_cache_key(project_id):
     return f"project_state:{project_id}"
 
@@ -396,33 +405,54 @@ def get_ingest_data(project_id):
 
 
 def replace_segments(project_id, segments):
+    """
+    Upsert de todos los segmentos en un solo INSERT ... ON CONFLICT (los
+    que ya no existen se borran). Las filas que se mantienen conservan su id.
+    """
     project_uuid = _to_uuid(project_id)
     if not project_uuid:
         raise ValueError("Proyecto no encontrado")
+    now = utcnow()
+    rows = [
+        {
+            "project_id": project_uuid,
+            "segment_id": segment_id,
+            "start_ms": int(data.get("start_ms", 0)),
+            "end_ms": int(data.get("end_ms", 0)),
+            "wav_path": data.get("wav_path"),
+            "text_path": data.get("text_path"),
+            "status": data.get("status", "pending"),
+            "text": data.get("text"),
+            "transcription_time": float(data.get("transcription_time", 0.0) or 0.0),
+            "created_at": now,
+            "updated_at": now
+        }
+        for segment_id, data in segments.items()
+    ]
     session = Session()
     try:
-        session.query(ProjectSegment).filter_by(project_id=project_uuid).delete(synchronize_session=False)
-        rows = []
-        for segment_id, data in segments.items():
-            rows.append(ProjectSegment(
-                project_id=project_uuid,
-                segment_id=segment_id,
-                start_ms=int(data.get("start_ms", 0)),
-                end_ms=int(data.get("end_ms", 0)),
-                wav_path=data.get("wav_path"),
-                text_path=data.get("text_path"),
-                status=data.get("status", "pending"),
-                text=data.get("text"),
-                transcription_time=Decimal(str(float(data.get("transcription_time", 0.0) or 0.0)))
-            ))
+        session.execute(
+            delete(ProjectSegment)
+            .where(ProjectSegment.project_id == project_uuid)
+            .where(ProjectSegment.segment_id.not_in(list(segments.keys())))
+        )
         if rows:
-            session.add_all(rows)
+            stmt = pg_insert(ProjectSegment)
+            stmt = stmt.on_conflict_do_update(
+                constraint="uq_project_segment",
+                set_={
+                    key: stmt.excluded[key]
+                    for key in rows[0]
+                    if key not in ("project_id", "segment_id", "created_at")
+                }
+            )
+            session.execute(stmt, rows)
         session.execute(
             update(ProjectState)
             .where(ProjectState.project_id == project_uuid)
             .values(
                 segments_total=len(rows),
-                segments_done=0
+                segments_done=len([row for row in rows if row["status"] == "done"])
             )
         )
         session.commit()
@@ -460,32 +490,59 @@ def get_segment(project_id, segment_id):
 
 
 def update_segment_text(project_id, segment_id, text, elapsed):
+    update_segments_text(project_id, [(segment_id, text, elapsed)])
+
+
+def update_segments_text(project_id, results):
+    """
+    Guarda varias transcripciones [(segment_id, texto, segundos)] con un
+    UPDATE ... FROM (VALUES ...). segments_done solo suma las que no
+    estaban terminadas.
+    """
     project_uuid = _to_uuid(project_id)
-    if not project_uuid:
-        return
+    if not project_uuid or not results:
+        return 0
+    rows = [
+        (segment_id, text, float(elapsed or 0.0))
+        for segment_id, text, elapsed in results
+    ]
     session = Session()
     try:
-        segment = (
-            session.query(ProjectSegment)
-            .filter_by(project_id=project_uuid, segment_id=segment_id)
+        # FOR UPDATE: si otro job termina el mismo segmento a la vez, uno
+        # de los dos lo ve ya terminado y no lo cuenta de nuevo
+        newly_done = session.execute(
+            select(ProjectSegment.segment_id)
+            .where(ProjectSegment.project_id == project_uuid)
+            .where(ProjectSegment.segment_id.in_([row[0] for row in rows]))
+            .where(ProjectSegment.status != "done")
             .with_for_update()
-            .first()
+        ).scalars().all()
+
+        data = values(
+            column("segment_id", String),
+            column("text", Text),
+            column("transcription_time", Numeric(10, 4)),
+            name="results"
+        ).data(rows)
+        session.execute(
+            update(ProjectSegment)
+            .where(ProjectSegment.project_id == project_uuid)
+            .where(ProjectSegment.segment_id == data.c.segment_id)
+            .values(
+                text=data.c.text,
+                transcription_time=data.c.transcription_time,
+                status="done",
+                updated_at=utcnow()
+            )
+            .execution_options(synchronize_session=False)
         )
-        if not segment:
-            return
-        status_value = getattr(segment, "status") or ""
-        already_done = status_value == "done"
-        setattr(segment, "text", text)
-        setattr(segment, "transcription_time", Decimal(str(float(elapsed))))
-        setattr(segment, "status", "done")
-
-        if not already_done:
-            _increment_progress_rows(session, project_uuid, segments_delta=1)
-
+        if newly_done:
+            _increment_progress_rows(session, project_uuid, segments_delta=len(newly_done))
         session.commit()
     finally:
         Session.remove()
     _invalidate_cache(project_id)
+    return len(newly_done)
 
 
 def set_processing_jobs(project_id, jobs_dict):
@@ -513,7 +570,8 @@ def update_processing_jobs(project_id, updates):
         state = session.query(ProjectState).filter_by(project_id=project_uuid).with_for_update().first()
         if not state:
             return None
-        jobs = getattr(state, "processing_jobs") or {}
+        # Copia: mutar el mismo dict no marca la columna JSONB como cambiada
+        jobs = dict(getattr(state, "processing_jobs") or {})
         jobs.update(updates)
         setattr(state, "processing_jobs", jobs)
         session.commit()
@@ -524,6 +582,32 @@ def update_processing_jobs(project_id, updates):
     return result
 
 
+def update_checkpoints(project_id, updates):
+    """
+    Marca etapas completadas en processing_jobs["checkpoints"]. Va con
+    FOR UPDATE porque prepare y los jobs hijos escriben en paralelo.
+    """
+    project_uuid = _to_uuid(project_id)
+    if not project_uuid:
+        return None
+    session = Session()
+    try:
+        state = session.query(ProjectState).filter_by(project_id=project_uuid).with_for_update().first()
+        if not state:
+            return None
+        jobs = dict(getattr(state, "processing_jobs") or {})
+        checkpoints = dict(jobs.get("checkpoints") or {})
+        checkpoints.update(updates)
+        jobs["checkpoints"] = checkpoints
+        setattr(state, "processing_jobs", jobs)
+        session.commit()
+        result = checkpoints
+    finally:
+        Session.remove()
+    _invalidate_cache(project_id)
+    return result
+
+
 def _increment_progress_rows(session, project_uuid, segments_delta=0, photos_delta=0):
     updates = {}
     if segments_delta:
@@ -588,6 +672,35 @@ def update_project_status(project_id, **fields):
         Session.remove()
 
 
+def record_processing_stats(project_id, user_id, metrics):
+    project_uuid = _to_uuid(project_id)
+    if not project_uuid:
+        return
+    values = {
+        "project_id": project_uuid,
+        "user_id": _to_uuid(user_id),
+        "finished_at": utcnow(),
+        "total_time": _as_float(metrics.get("total_time")),
+        "transcription_time": _as_float(metrics.get("avg_transcription_time")),
+        "stylize_time": _as_float(metrics.get("avg_stylize_time")),
+        "llm_time": _as_float(metrics.get("llm_time")),
+        "segment_count": int(metrics.get("chunks_total") or 0),
+        "photo_count": int(metrics.get("photos_total") or 0),
+        "photos_processed": int(metrics.get("photos_processed") or 0)
+    }
+    stmt = pg_insert(ProjectProcessingStats).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_project_processing_stats_project",
+        set_={key: stmt.excluded[key] for key in values if key != "project_id"}
+    )
+    session = Session()
+    try:
+        session.execute(stmt)
+        session.commit()
+    finally:
+        Session.remove()
+
+
 def delete_project(project_id):
     project_uuid = _to_uuid(project_id)
     if not project_uuid:
@@ -602,23 +715,76 @@ def delete_project(project_id):
     finally:
         Session.remove()
 
+    # El proyecto ya no está en la base: si quedan archivos se loguea, como
+    # en retention, en vez de devolver un error por algo ya borrado
+    try:
+        remove_project_files(project_id)
+    except Exception as e:
+        log.error("No se pudieron borrar archivos de %s: %s", project_id, e)
+    log.info("Proyecto eliminado: %s", project_id)
+    return True
+
+
+def remove_project_files(project_id):
+    """Cache del proyecto, directorio local y chunks en el storage de audio."""
+    _invalidate_cache(project_id)
     project_dir = get_project_dir(project_id)
     if os.path.isdir(project_dir):
         shutil.rmtree(project_dir)
-    _invalidate_cache(project_id)
-    log.info("Proyecto eliminado: %s", project_id)
-    return True
+    get_audio_storage().delete_project(project_id)
 
 
-def list_projects(user_id, limit=10, offset=0, query=None, status=None):
+def encode_project_cursor(created_at, project_id):
+    # Sin created_at no hay keyset posible: la siguiente página va por offset
+    if created_at is None:
+        return None
+    raw = f"{created_at.isoformat()}|{project_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_project_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        created_raw, project_raw = raw.split("|", 1)
+        created_at = datetime.fromisoformat(created_raw)
+    except (ValueError, UnicodeError):
+        return None
+    project_uuid = _to_uuid(project_raw)
+    if not project_uuid:
+        return None
+    return created_at, project_uuid
+
+
+def list_projects(
+    user_id,
+    limit=10,
+    offset=0,
+    query=None,
+    status=None,
+    tag_id=None,
+    cursor=None
+):
+    """
+    Lista proyectos del usuario, más nuevos primero.
+
+    Con `cursor` (ver encode_project_cursor) se pagina por keyset sobre
+    (created_at, id) y `offset` solo indica cuántos proyectos ya vio el
+    cliente, para poder devolver el total. El total sale de un count(*) OVER
+    () en la misma query: filas restantes desde el cursor + offset.
+    Retorna (projects, total, next_cursor).
+    """
     user_uuid = _to_uuid(user_id)
     if not user_uuid:
-        return [], 0
+        return [], 0, None
 
     session = Session()
     try:
         base = (
-            session.query(Project, ProjectState)
+            session.query(
+                Project,
+                ProjectState,
+                func.count().over().label("remaining")
+            )
             .join(ProjectState, ProjectState.project_id == Project.id)
             .filter(Project.user_id == user_uuid)
         )
@@ -633,16 +799,38 @@ def list_projects(user_id, limit=10, offset=0, query=None, status=None):
         if status:
             base = base.filter(Project.status == status)
 
-        total = base.count()
-        rows = (
-            base.order_by(Project.created_at.desc())
-            .offset(offset)
-            .limit(limit)
-            .all()
-        )
+        if tag_id is not None:
+            base = (
+                base.join(ProjectTag, ProjectTag.project_id == Project.id)
+                .filter(ProjectTag.tag_id == tag_id)
+            )
+
+        if cursor is not None:
+            cursor_created_at, cursor_id = cursor
+            base = base.filter(
+                tuple_(Project.created_at, Project.id)
+                < tuple_(cursor_created_at, cursor_id)
+            )
+
+        ordered = base.order_by(Project.created_at.desc(), Project.id.desc())
+        if cursor is None and offset:
+            ordered = ordered.offset(offset)
+        rows = ordered.limit(limit).all()
+
+        # El window count se evalúa antes de OFFSET/LIMIT: sin cursor es el
+        # total; con cursor son las filas que quedan después de él.
+        if rows:
+            remaining = rows[0].remaining
+            total = offset + remaining if cursor is not None else remaining
+        elif cursor is not None:
+            total = offset
+        elif offset:
+            total = base.count()
+        else:
+            total = 0
 
         projects = []
-        for project, state_row in rows:
+        for project, state_row, _ in rows:
             projects.append({
                 "project_id": str(project.id),
                 "project_name": project.title,
@@ -656,7 +844,12 @@ def list_projects(user_id, limit=10, offset=0, query=None, status=None):
                 "stylize_errors": project.stylize_errors
             })
 
-        return projects, total
+        next_cursor = None
+        if len(rows) == limit:
+            last = rows[-1][0]
+            next_cursor = encode_project_cursor(last.created_at, last.id)
+
+        return projects, total, next_cursor
     finally:
         Session.remove()
 
@@ -7,3 +7,36 @@ from services.cache import get_redis_client
 def get_queue(name=None):
     queue_name = name or Config.RQ_QUEUE_NAME
     return Queue(name=queue_name, connection=get_redis_client())
+
+
+def enqueue_deferred(queue, job):
+    """
+    Encola un job creado diferido sin depends_on (fair_queue, job_graph).
+    Queue.enqueue_job deja quieto todo job en DEFERRED, esperando
+    dependencias que acá no hay. Queue._enqueue_job (privado en RQ) lo marca
+    en cola y lo empuja en un solo pipeline.
+    """
+    return queue._enqueue_job(job)
+
+
+# Lanes de prioridad. La alta usa el nombre de cola de siempre; la bulk
+# (reprocesos, backlog tras una caída) lleva sufijo y los workers la drenan
+# después de la alta.
+LANE_HIGH = "high"
+LANE_BULK = "bulk"
+LANES = (LANE_HIGH, LANE_BULK)
+BULK_SUFFIX = "_bulk"
+
+
+def lane_queue_name(queue_name, lane=LANE_HIGH):
+    if lane == LANE_BULK and not is_bulk_queue(queue_name):
+        return f"{queue_name}{BULK_SUFFIX}"
+    return queue_name
+
+
+def is_bulk_queue(queue_name):
+    return queue_name.endswith(BULK_SUFFIX)
+
+
+def get_lane_queue(queue_name, lane=LANE_HIGH):
+    return get_queue(lane_queue_name(queue_name, lane))
@@ -1,229 +1,496 @@
-from datetime import timedelta
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import BigInteger, DateTime, Integer, cast, column, update, values
+from sqlalchemy.dialects.postgresql import UUID
 
 from extensions import Session
 from logger import get_logger
-from models import User, utcnow
+from models import User
+from services.cache import get_redis_client
 
 
 log = get_logger("quota")
+_redis = get_redis_client()
 
 
 WINDOW_HOURS = 24
 SECONDS_PER_MINUTE = 60
-
-
-def _reset_window(user, started_attr, used_attr, now):
-    started_at = getattr(user, started_attr)
-    if not started_at or now - started_at >= timedelta(hours=WINDOW_HOURS):
-        setattr(user, started_attr, now)
-        setattr(user, used_attr, 0)
-        return True
-    return False
-
-
-def get_recording_quota(user_id):
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Las cuotas viven en Redis (un hash por usuario y tipo) y se bajan a
+# Postgres en lote desde el worker. Si la llave expira o Redis se reinicia se
+# vuelve a cargar desde users. Cada cambio sube la versión del hash y users
+# solo acepta versiones más nuevas: con varios workers persistiendo (y
+# flush_user desde admin) una foto vieja que llegue tarde no pisa a la nueva.
+QUOTA_KEY_TTL = 2 * SECONDS_PER_DAY
+DIRTY_KEY = "quota:dirty"
+PERSIST_BATCH_SIZE = 500
+
+# Mientras un admin edita las cuotas de un usuario no se recarga desde la
+# base: flush_user deja una retención y sube la generación, invalidate_user
+# la suelta. Una carga que leyó la base con otra generación se descarta.
+# Las consultas no esperan la retención: responden con lo leído de la base.
+HOLD_SECONDS = 5
+HOLD_POLL_SECONDS = 0.05
+
+QUOTA_KINDS = {
+    "stylize": {
+        "used_attr": "stylizes_used_in_window",
+        "started_attr": "stylize_window_started_at",
+        "version_attr": "stylize_quota_version",
+    },
+    "recording": {
+        "used_attr": "recording_seconds_used",
+        "started_attr": "recording_window_started_at",
+        "version_attr": "recording_quota_version",
+    },
+}
+
+# KEYS[1]: hash de la cuota, KEYS[2]: set de cuotas por persistir
+# ARGV: now, amount, mode, miembro para KEYS[2], ttl
+# mode: check | strict (todo o nada) | partial (lo que alcance) | force | release
+# Devuelve {granted, used, limit, started, allowed, window}; granted = -1 si
+# falta cargar
+_QUOTA_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {-1, 0, 0, 0, 0, 0}
+end
+local now = tonumber(ARGV[1])
+local amount = tonumber(ARGV[2])
+local mode = ARGV[3]
+local h = redis.call('HMGET', KEYS[1], 'limit', 'used', 'started', 'window', 'allowed')
+local limit = tonumber(h[1])
+local used = tonumber(h[2])
+local started = tonumber(h[3])
+local window = tonumber(h[4])
+local allowed = tonumber(h[5])
+local changed = false
+local granted = 0
+
+if limit >= 0 and window > 0 and (started == 0 or now - started >= window) then
+    started = now
+    used = 0
+    changed = true
+end
+
+if mode == 'release' then
+    if limit >= 0 then
+        granted = math.min(amount, used)
+        used = used - granted
+        changed = changed or granted > 0
+    end
+elseif mode == 'force' then
+    if limit >= 0 then
+        used = used + amount
+        granted = amount
+        changed = true
+    end
+elseif allowed == 0 then
+    granted = 0
+elseif limit < 0 then
+    granted = amount
+elseif mode ~= 'check' then
+    local remaining = math.max(0, limit - used)
+    if mode == 'partial' then
+        granted = math.min(amount, remaining)
+    elseif remaining >= amount then
+        granted = amount
+    end
+    used = used + granted
+    changed = changed or granted > 0
+end
+
+if changed then
+    redis.call('HSET', KEYS[1], 'used', used, 'started', started)
+    redis.call('HINCRBY', KEYS[1], 'version', 1)
+    redis.call('SADD', KEYS[2], ARGV[4])
+end
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[5]))
+return {granted, used, limit, started, allowed, window}
+"""
+
+# KEYS[1]: hash de la cuota, KEYS[2]: retención, KEYS[3]: generación
+# ARGV: generación leída antes de ir a la base, ttl, luego pares campo, valor
+# Devuelve 0 si hay retención o la generación cambió
+_HYDRATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 1
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+if (redis.call('GET', KEYS[3]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+return 1
+"""
+
+# KEYS[1]: hash de la cuota, KEYS[2]: set de cuotas por persistir
+# ARGV: versión ya persistida, miembro para KEYS[2]
+# Borra solo si nada cambió desde la lectura; si no, devuelve 0
+_RELEASE_FLUSHED_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 and (redis.call('HGET', KEYS[1], 'version') or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[2], ARGV[2])
+return 1
+"""
+
+_quota_script = _redis.register_script(_QUOTA_SCRIPT)
+_hydrate_script = _redis.register_script(_HYDRATE_SCRIPT)
+_release_flushed_script = _redis.register_script(_RELEASE_FLUSHED_SCRIPT)
+
+
+def _quota_key(user_id, kind):
+    return f"quota:{user_id}:{kind}"
+
+
+def _hold_key(user_id):
+    return f"quota:{user_id}:hold"
+
+
+def _generation_key(user_id):
+    return f"quota:{user_id}:generation"
+
+
+def _to_epoch(value):
+    return int(value.timestamp()) if value else 0
+
+
+def _to_datetime(epoch):
+    return datetime.fromtimestamp(int(epoch), tz=timezone.utc) if epoch else None
+
+
+def _quota_fields(user, kind):
+    if kind == "stylize":
+        allowed = user.is_admin or user.can_stylize_images
+        limit = user.daily_stylize_quota
+        window = WINDOW_HOURS * 60 * 60
+    else:
+        allowed = True
+        limit = user.recording_minutes_quota
+        if limit is not None:
+            limit = int(limit) * SECONDS_PER_MINUTE
+        window = (user.recording_window_days or 0) * SECONDS_PER_DAY
+
+    if user.is_admin:
+        limit = None
+        window = 0
+
+    attrs = QUOTA_KINDS[kind]
+    return {
+        "limit": -1 if limit is None else max(0, int(limit)),
+        "used": int(getattr(user, attrs["used_attr"]) or 0),
+        "started": _to_epoch(getattr(user, attrs["started_attr"])),
+        "window": int(window),
+        "allowed": 1 if allowed else 0,
+        "version": int(getattr(user, attrs["version_attr"]) or 0),
+    }
+
+
+def _hydrate(user_id):
+    """
+    Carga las cuotas desde users. Devuelve (campos por tipo, cargadas):
+    campos None si el usuario no existe; cargadas False si un admin las está
+    editando y no quedaron en Redis.
+    """
+    generation = (_redis.get(_generation_key(user_id)) or b"0").decode("utf-8")
     db = Session()
     try:
         user = db.query(User).filter_by(id=user_id).first()
         if not user:
+            return None, False
+        fields_by_kind = {kind: _quota_fields(user, kind) for kind in QUOTA_KINDS}
+    finally:
+        Session.remove()
+
+    for kind, fields in fields_by_kind.items():
+        args = [generation, QUOTA_KEY_TTL]
+        for name, value in fields.items():
+            args.extend([name, value])
+        keys = [_quota_key(user_id, kind), _hold_key(user_id), _generation_key(user_id)]
+        if not int(_hydrate_script(keys=keys, args=args)):
+            return fields_by_kind, False
+    return fields_by_kind, True
+
+
+def _check_fields(fields, now):
+    """Lo mismo que el modo check de _QUOTA_SCRIPT, sobre lo leído de la base."""
+    used = fields["used"]
+    started = fields["started"]
+    if fields["limit"] >= 0 and fields["window"] > 0 and (started == 0 or now - started >= fields["window"]):
+        used = 0
+        started = now
+    return [0, used, fields["limit"], started, fields["allowed"], fields["window"]]
+
+
+def _apply(user_id, kind, mode, amount=1):
+    """
+    Una ida a Redis en el caso normal. None si el usuario no existe.
+    """
+    key = _quota_key(user_id, kind)
+    now = int(time.time())
+    args = [now, int(amount), mode, f"{user_id}:{kind}", QUOTA_KEY_TTL]
+    result = _quota_script(keys=[key, DIRTY_KEY], args=args)
+    while int(result[0]) == -1:
+        fields_by_kind, loaded = _hydrate(user_id)
+        if fields_by_kind is None:
             return None
+        if not loaded:
+            if mode == "check":
+                # Las requests solo consultan: no esperan la retención
+                result = _check_fields(fields_by_kind[kind], now)
+                break
+            # Reservar y consumir solo pasa en jobs; la retención dura como
+            # mucho HOLD_SECONDS
+            time.sleep(HOLD_POLL_SECONDS)
+        result = _quota_script(keys=[key, DIRTY_KEY], args=args)
+    granted, used, limit, started, allowed, window = (int(value) for value in result)
+    return {
+        "granted": granted,
+        "used": used,
+        "limit": None if limit < 0 else limit,
+        "started": started,
+        "allowed": bool(allowed),
+        "window": window,
+    }
 
-        if user.is_admin:
-            return {
-                "total_seconds": None,
-                "used_seconds": 0,
-                "remaining_seconds": None,
-                "window_days": None,
-                "reset_at": None
-            }
-
-        quota_minutes = user.recording_minutes_quota
-        if quota_minutes is None:
-            return {
-                "total_seconds": None,
-                "used_seconds": 0,
-                "remaining_seconds": None,
-                "window_days": user.recording_window_days,
-                "reset_at": None
-            }
 
-        try:
-            quota_minutes = int(quota_minutes)
-        except (TypeError, ValueError):
-            quota_minutes = 0
-
-        total_seconds = max(0, quota_minutes) * SECONDS_PER_MINUTE
-        used_seconds = int(user.recording_seconds_used or 0)
-
-        now = utcnow()
-        window_days = user.recording_window_days
-        reset_at = None
-        if window_days:
-            started_at = user.recording_window_started_at
-            if not started_at or now - started_at >= timedelta(days=window_days):
-                user.recording_window_started_at = now
-                user.recording_seconds_used = 0
-                used_seconds = 0
-                db.commit()
-                started_at = now
-            reset_at = started_at + timedelta(days=window_days)
-
-        remaining_seconds = max(0, total_seconds - used_seconds)
+def get_recording_quota(user_id):
+    status = _apply(user_id, "recording", "check")
+    if status is None:
+        return None
+
+    window_days = status["window"] // SECONDS_PER_DAY or None
+
+    if status["limit"] is None:
         return {
-            "total_seconds": total_seconds,
-            "used_seconds": used_seconds,
-            "remaining_seconds": remaining_seconds,
+            "total_seconds": None,
+            "used_seconds": 0,
+            "remaining_seconds": None,
             "window_days": window_days,
-            "reset_at": reset_at
+            "reset_at": None
         }
-    finally:
-        Session.remove()
+
+    reset_at = None
+    if window_days:
+        reset_at = _to_datetime(status["started"]) + timedelta(days=window_days)
+
+    total_seconds = status["limit"]
+    used_seconds = status["used"]
+    return {
+        "total_seconds": total_seconds,
+        "used_seconds": used_seconds,
+        "remaining_seconds": max(0, total_seconds - used_seconds),
+        "window_days": window_days,
+        "reset_at": reset_at
+    }
 
 
 def consume_recording_seconds(user_id, seconds):
     if seconds <= 0:
         return
-
-    db = Session()
-    try:
-        user = db.query(User).filter_by(id=user_id).first()
-        if not user or user.is_admin:
-            return
-
-        if user.recording_minutes_quota is None:
-            return
-
-        now = utcnow()
-        window_days = user.recording_window_days
-        if window_days:
-            started_at = user.recording_window_started_at
-            if not started_at or now - started_at >= timedelta(days=window_days):
-                user.recording_window_started_at = now
-                user.recording_seconds_used = 0
-
-        current_used = int(user.recording_seconds_used or 0)
-        user.recording_seconds_used = current_used + int(seconds)
-        db.commit()
-    finally:
-        Session.remove()
+    _apply(user_id, "recording", "force", amount=int(seconds))
 
 
 def reserve_stylize_quota(user_id, reason=""):
     return _reserve_quota(
         user_id,
-        quota_attr="daily_stylize_quota",
-        used_attr="stylizes_used_in_window",
-        started_attr="stylize_window_started_at",
+        kind="stylize",
         label="estilizaciones",
-        reason=reason,
-        requires_flag="can_stylize_images"
+        reason=reason
     )
 
 
-def release_stylize_quota(user_id):
-    _release_quota(
-        user_id,
-        quota_attr="daily_stylize_quota",
-        used_attr="stylizes_used_in_window"
-    )
+def reserve_stylize_batch(user_id, count, reason=""):
+    """
+    Reserva hasta `count` estilizaciones de una vez. Devuelve (concedidas,
+    error); concede menos si la cuota no alcanza para todas.
+    """
+    if count <= 0:
+        return 0, None
 
+    status = _apply(user_id, "stylize", "partial", amount=count)
+    if status is None:
+        return 0, "Usuario no encontrado"
 
-def _release_quota(user_id, quota_attr, used_attr):
-    db = Session()
-    try:
-        user = db.query(User).filter_by(id=user_id).first()
-        if not user or user.is_admin:
-            return
+    if not status["allowed"]:
+        return 0, "No tienes permiso para usar esta función"
 
-        if getattr(user, quota_attr) is None:
-            return
+    if status["limit"] == 0:
+        return 0, "No tienes cuota disponible para estilizaciones"
 
-        used = getattr(user, used_attr) or 0
-        if used > 0:
-            setattr(user, used_attr, used - 1)
-            db.commit()
-    finally:
-        Session.remove()
+    granted = status["granted"]
+    if granted <= 0:
+        return 0, "Has alcanzado tu cuota diaria de estilizaciones"
 
+    if reason and status["limit"] is not None:
+        log.info(
+            "Reserva de cuota estilizaciones: user=%s reason=%s %d/%d",
+            user_id,
+            reason,
+            granted,
+            count
+        )
+    return granted, None
 
-def _reserve_quota(
-    user_id,
-    quota_attr,
-    used_attr,
-    started_attr,
-    label,
-    reason="",
-    requires_flag=None
-):
-    db = Session()
-    try:
-        user = db.query(User).filter_by(id=user_id).first()
-        if not user:
-            return False, "Usuario no encontrado"
 
-        if user.is_admin:
-            return True, None
+def release_stylize_quota(user_id, amount=1):
+    if amount <= 0:
+        return
+    _apply(user_id, "stylize", "release", amount=amount)
 
-        if requires_flag and not getattr(user, requires_flag, False):
-            return False, "No tienes permiso para usar esta función"
 
-        quota_value = getattr(user, quota_attr)
-        if quota_value is None:
-            return True, None
+def _reserve_quota(user_id, kind, label, reason=""):
+    status = _apply(user_id, kind, "strict")
+    if status is None:
+        return False, "Usuario no encontrado"
 
-        try:
-            quota_value = int(quota_value)
-        except (TypeError, ValueError):
-            return False, "La cuota no es válida"
+    if not status["allowed"]:
+        return False, "No tienes permiso para usar esta función"
 
-        if quota_value <= 0:
-            return False, f"No tienes cuota disponible para {label}"
+    if status["limit"] == 0:
+        return False, f"No tienes cuota disponible para {label}"
 
-        now = utcnow()
-        _reset_window(user, started_attr, used_attr, now)
+    if status["granted"] <= 0:
+        return False, f"Has alcanzado tu cuota diaria de {label}"
 
-        used = getattr(user, used_attr) or 0
-        if used >= quota_value:
-            return False, f"Has alcanzado tu cuota diaria de {label}"
+    if reason and status["limit"] is not None:
+        log.info("Reserva de cuota %s: user=%s reason=%s", label, user_id, reason)
 
-        setattr(user, used_attr, used + 1)
-        db.commit()
+    return True, None
 
-        if reason:
-            log.info("Reserva de cuota %s: user=%s reason=%s", label, user.id, reason)
 
-        return True, None
-    finally:
-        Session.remove()
+def has_stylize_quota(user_id):
+    status = _apply(user_id, "stylize", "check")
+    if status is None or not status["allowed"]:
+        return False
+    if status["limit"] is None:
+        return True
+    return status["used"] < status["limit"]
+
+
+def _persist_rows(session, kind, rows):
+    attrs = QUOTA_KINDS[kind]
+    version_column = getattr(User, attrs["version_attr"])
+    data = values(
+        column("id", UUID(as_uuid=False)),
+        column("used", Integer),
+        column("started", DateTime(timezone=True)),
+        column("version", BigInteger),
+        name="quota"
+    ).data(rows)
+    # Una foto más vieja que la guardada (otro worker, flush_user) no escribe
+    session.execute(
+        update(User)
+        .where(User.id == cast(data.c.id, UUID(as_uuid=True)))
+        .where(version_column < data.c.version)
+        .values({
+            attrs["used_attr"]: data.c.used,
+            attrs["started_attr"]: data.c.started,
+            attrs["version_attr"]: data.c.version,
+        })
+        .execution_options(synchronize_session=False)
+    )
 
 
-def has_stylize_quota(user_id):
-    db = Session()
+def persist_quotas(members=None):
+    """
+    Baja a users los contadores que cambiaron en Redis. Si falla la escritura
+    se vuelven a marcar como pendientes.
+    """
+    if members is None:
+        members = [
+            member.decode("utf-8")
+            for member in (_redis.spop(DIRTY_KEY, PERSIST_BATCH_SIZE) or [])
+        ]
+    if not members:
+        return 0
+
+    pipe = _redis.pipeline(transaction=False)
+    for member in members:
+        user_id, kind = member.rsplit(":", 1)
+        pipe.hmget(_quota_key(user_id, kind), "used", "started", "version")
+    snapshots = pipe.execute()
+
     try:
-        user = db.query(User).filter_by(id=user_id).first()
-        if not user:
-            return False
-        if user.is_admin:
-            return True
-        if not user.can_stylize_images:
-            return False
-
-        quota_value = user.daily_stylize_quota
-        if quota_value is None:
-            return True
-        try:
-            quota_value = int(quota_value)
-        except (TypeError, ValueError):
-            return False
-        if quota_value <= 0:
-            return False
-
-        now = utcnow()
-        started_at = user.stylize_window_started_at
-        used = user.stylizes_used_in_window or 0
-        if not started_at or now - started_at >= timedelta(hours=WINDOW_HOURS):
-            used = 0
-
-        return used < quota_value
+        _write_snapshots(members, snapshots)
+    except Exception:
+        _redis.sadd(DIRTY_KEY, *members)
+        raise
+    return len(members)
+
+
+def _write_snapshots(members, snapshots):
+    rows_by_kind = {kind: [] for kind in QUOTA_KINDS}
+    for member, (used, started, version) in zip(members, snapshots):
+        if used is None:
+            continue
+        user_id, kind = member.rsplit(":", 1)
+        rows_by_kind[kind].append((user_id, int(used), _to_datetime(started), int(version or 0)))
+
+    session = Session()
+    try:
+        for kind, rows in rows_by_kind.items():
+            if rows:
+                _persist_rows(session, kind, rows)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
     finally:
         Session.remove()
+
+
+def flush_user(user_id):
+    """
+    Antes de que un admin toque las cuotas: retener la recarga, persistir y
+    soltar lo de Redis. Quien llama debe terminar con invalidate_user.
+    """
+    pipe = _redis.pipeline()
+    pipe.set(_hold_key(user_id), 1, ex=HOLD_SECONDS)
+    pipe.incr(_generation_key(user_id))
+    pipe.expire(_generation_key(user_id), QUOTA_KEY_TTL)
+    pipe.execute()
+
+    for kind in QUOTA_KINDS:
+        key = _quota_key(user_id, kind)
+        member = f"{user_id}:{kind}"
+        # Lo que se reserve entre la lectura y el borrado deja el hash
+        # distinto y se vuelve a persistir
+        while True:
+            snapshot = _redis.hmget(key, "used", "started", "version")
+            if snapshot[0] is not None:
+                _write_snapshots([member], [snapshot])
+            released = _release_flushed_script(
+                keys=[key, DIRTY_KEY],
+                args=[snapshot[2] or b"0", member]
+            )
+            if int(released):
+                break
+
+
+def invalidate_user(user_id):
+    """Suelta la retención de flush_user; la próxima lectura carga desde users."""
+    pipe = _redis.pipeline()
+    for kind in QUOTA_KINDS:
+        pipe.delete(_quota_key(user_id, kind))
+        pipe.srem(DIRTY_KEY, f"{user_id}:{kind}")
+    pipe.incr(_generation_key(user_id))
+    pipe.expire(_generation_key(user_id), QUOTA_KEY_TTL)
+    pipe.delete(_hold_key(user_id))
+    pipe.execute()
+
+
+def run_persist_loop(interval_seconds=10):
+    while True:
+        try:
+            while persist_quotas() >= PERSIST_BATCH_SIZE:
+                pass
+        except Exception as e:
+            log.error("Error al persistir cuotas: %s", e)
+        time.sleep(interval_seconds)
@@ -1,60 +1,157 @@
+import os
+import random
+import socket
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
+from sqlalchemy import any_, bindparam, delete, insert
+from sqlalchemy.dialects.postgresql import ARRAY, UUID
+
 from extensions import Session
 from logger import get_logger
 from config import Config
-from models import AuditLog, Project, ProjectEvent, PhotoEvent, log_audit, utcnow
-from services import project_store
+from models import AuditLog, Project, ProjectEvent, PhotoEvent, utcnow
+from services import event_rollup, project_store
+from services.cache import get_redis_client
 
 
 log = get_logger("retention")
+_redis = get_redis_client()
 
 
-def cleanup_expired_projects():
-    now = utcnow()
+def _expire_batch(now, batch_size):
+    """
+    Un lote en una transacción: auditoría en un solo INSERT y un solo
+    DELETE ... WHERE id = ANY(...). Los hijos caen por ON DELETE CASCADE.
+    """
     db = Session()
     try:
-        expired = (
-            db.query(Project)
+        rows = (
+            db.query(Project.id, Project.user_id, Project.expires_at)
             .filter(Project.expires_at <= now)
+            .order_by(Project.expires_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
             .all()
         )
-        if not expired:
-            return 0
-
-        count = 0
-        for project in expired:
-            project_id = str(project.id)
-            log_audit(
-                db,
-                action="project_expired_cleanup",
-                actor_user_id=None,
-                target_user_id=project.user_id,
-                details={
-                    "project_id": project_id,
-                    "expires_at": (
-                        project.expires_at.isoformat()
-                        if project.expires_at else None
-                    )
-                }
-            )
-            db.commit()
+        if not rows:
+            return []
 
-            try:
-                project_store.delete_project(project_id)
-                count += 1
-            except Exception as e:
-                log.error("No se pudo borrar proyecto %s: %s", project_id, e)
+        db.execute(insert(AuditLog), [
+            {
+                "action": "project_expired_cleanup",
+                "actor_user_id": None,
+                "target_user_id": user_id,
+                "details": {
+                    "project_id": str(project_id),
+                    "expires_at": expires_at.isoformat() if expires_at else None
+                },
+                "created_at": now
+            }
+            for project_id, user_id, expires_at in rows
+        ])
+        ids = [project_id for project_id, _, _ in rows]
+        db.execute(
+            delete(Project)
+            .where(Project.id == any_(bindparam("ids", ids, type_=ARRAY(UUID(as_uuid=True)))))
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        return [str(project_id) for project_id in ids]
+    finally:
+        Session.remove()
 
-        log.info("Limpieza completada: %s proyectos", count)
-        return count
+
+def _remove_files(project_id):
+    try:
+        project_store.remove_project_files(project_id)
+        return True
+    except Exception as e:
+        log.error("No se pudieron borrar archivos de %s: %s", project_id, e)
+        return False
+
+
+def _count_expired(now):
+    db = Session()
+    try:
+        return db.query(Project.id).filter(Project.expires_at <= now).count()
     finally:
         Session.remove()
 
 
+def cleanup_expired_projects(batch_size=None, time_budget_seconds=None, keep_going=None):
+    """
+    Borra proyectos vencidos por lotes hasta agotar el presupuesto de tiempo
+    (o hasta que keep_going() diga que no); lo que queda sale en la próxima
+    corrida. Los archivos (disco y S3) se borran en paralelo mientras avanza
+    el siguiente lote.
+    """
+    batch_size = batch_size or Config.RETENTION_BATCH_SIZE
+    time_budget_seconds = time_budget_seconds or Config.RETENTION_TIME_BUDGET_SECONDS
+    now = utcnow()
+    start = time.monotonic()
+    deadline = start + time_budget_seconds
+
+    deleted = 0
+    batches = 0
+    file_jobs = []
+    with ThreadPoolExecutor(max_workers=Config.RETENTION_FILE_WORKERS) as pool:
+        while time.monotonic() < deadline and (keep_going is None or keep_going()):
+            project_ids = _expire_batch(now, batch_size)
+            if not project_ids:
+                break
+            batches += 1
+            deleted += len(project_ids)
+            file_jobs.extend(pool.submit(_remove_files, project_id) for project_id in project_ids)
+            elapsed = time.monotonic() - start
+            log.info(
+                "Limpieza lote %s: %s proyectos (%s en total, %.1f/s)",
+                batches,
+                len(project_ids),
+                deleted,
+                deleted / max(elapsed, 1e-6)
+            )
+            if len(project_ids) < batch_size:
+                break
+        files_failed = len([job for job in file_jobs if not job.result()])
+
+    stats = {
+        "deleted": deleted,
+        "batches": batches,
+        "files_failed": files_failed,
+        "pending": _count_expired(now) if batches and deleted == batches * batch_size else 0,
+        "seconds": round(time.monotonic() - start, 1),
+    }
+    if deleted or stats["pending"]:
+        log.info(
+            "Limpieza completada: %s proyectos en %ss (%s lotes, %s con error de archivos, %s pendientes)",
+            deleted,
+            stats["seconds"],
+            batches,
+            files_failed,
+            stats["pending"]
+        )
+    return stats
+
+
+def _raw_event_cutoff(kind, now):
+    # Nunca borrar eventos que todavía no están en el rollup
+    cutoff = now - timedelta(days=Config.EVENT_RAW_RETENTION_DAYS)
+    watermark = event_rollup.get_watermark(kind)
+    if watermark is None:
+        return None
+    return min(cutoff, watermark)
+
+
 def cleanup_expired_events():
-    cutoff = utcnow() - timedelta(days=Config.RETENTION_DAYS)
+    event_rollup.rollup_event_counts()
+
+    now = utcnow()
+    cutoff = now - timedelta(days=Config.RETENTION_DAYS)
+    project_cutoff = _raw_event_cutoff("project", now)
+    photo_cutoff = _raw_event_cutoff("photo", now)
     db = Session()
     try:
         deleted_audit = (
@@ -62,16 +159,20 @@ def cleanup_expired_events():
             .filter(AuditLog.created_at < cutoff)
             .delete(synchronize_session=False)
         )
-        deleted_projects = (
-            db.query(ProjectEvent)
-            .filter(ProjectEvent.created_at < cutoff)
-            .delete(synchronize_session=False)
-        )
-        deleted_photos = (
-            db.query(PhotoEvent)
-            .filter(PhotoEvent.created_at < cutoff)
-            .delete(synchronize_session=False)
-        )
+        deleted_projects = 0
+        if project_cutoff is not None:
+            deleted_projects = (
+                db.query(ProjectEvent)
+                .filter(ProjectEvent.created_at < project_cutoff)
+                .delete(synchronize_session=False)
+            )
+        deleted_photos = 0
+        if photo_cutoff is not None:
+            deleted_photos = (
+                db.query(PhotoEvent)
+                .filter(PhotoEvent.created_at < photo_cutoff)
+                .delete(synchronize_session=False)
+            )
         db.commit()
 
         total = (deleted_audit or 0) + (deleted_projects or 0) + (deleted_photos or 0)
@@ -87,11 +188,182 @@ def cleanup_expired_events():
         Session.remove()
 
 
+# Todos los workers arrancan el loop, pero solo el que tiene el lease corre
+# la limpieza. El lease se renueva mientras dura la corrida; si se pierde se
+# corta entre lotes. La corrida en curso va en current_run y solo al terminar
+# pasa a last_run; last_ok_run es la última que terminó bien, y es la que
+# miran los demás para saber si ya toca de nuevo.
+LEASE_KEY = "retention:lease"
+CURRENT_RUN_KEY = "retention:current_run"
+LAST_RUN_KEY = "retention:last_run"
+LAST_OK_RUN_KEY = "retention:last_ok_run"
+SCHEDULE_JITTER = 0.2
+
+# KEYS[1]: lease; ARGV: dueño, ttl en ms
+_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS[1]: lease; ARGV: dueño
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_renew_script = _redis.register_script(_RENEW_SCRIPT)
+_release_script = _redis.register_script(_RELEASE_SCRIPT)
+
+
+def _owner_id():
+    return f"{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}"
+
+
+class _Lease:
+    """Lease en Redis con un hilo que lo renueva cada ttl/3."""
+
+    def __init__(self, owner, ttl_seconds):
+        self.owner = owner
+        self.ttl_ms = int(ttl_seconds * 1000)
+        self.lost = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+
+    def acquire(self):
+        if not _redis.set(LEASE_KEY, self.owner, nx=True, px=self.ttl_ms):
+            return False
+        self._thread = threading.Thread(target=self._keep_alive, daemon=True)
+        self._thread.start()
+        return True
+
+    def _keep_alive(self):
+        while not self._done.wait(self.ttl_ms / 3000):
+            try:
+                renewed = _renew_script(keys=[LEASE_KEY], args=[self.owner, self.ttl_ms])
+            except Exception as e:
+                log.warning("No se pudo renovar el lease de limpieza: %s", e)
+                continue
+            if not renewed:
+                log.warning("Lease de limpieza perdido; se corta la corrida")
+                self.lost.set()
+                return
+
+    def release(self):
+        self._done.set()
+        if self._thread:
+            self._thread.join()
+        try:
+            _release_script(keys=[LEASE_KEY], args=[self.owner])
+        except Exception as e:
+            log.warning("No se pudo liberar el lease de limpieza: %s", e)
+
+
+def _read_run(key):
+    raw = _redis.hgetall(key)
+    if not raw:
+        return None
+    data = {key.decode("utf-8"): value.decode("utf-8") for key, value in raw.items()}
+    for key in ("started_at", "finished_at", "seconds"):
+        if data.get(key):
+            data[key] = float(data[key])
+    for key in ("deleted", "batches", "files_failed", "pending", "events_deleted"):
+        if data.get(key):
+            data[key] = int(data[key])
+    return data
+
+
+def get_last_run():
+    return _read_run(LAST_RUN_KEY)
+
+
+def get_status():
+    """Corrida en curso, última corrida, última exitosa y dueño del lease, para el admin."""
+    owner = _redis.get(LEASE_KEY)
+    ttl_ms = _redis.pttl(LEASE_KEY) if owner else None
+    return {
+        "current_run": _read_run(CURRENT_RUN_KEY) if owner else None,
+        "last_run": get_last_run(),
+        "last_ok_run": _read_run(LAST_OK_RUN_KEY),
+        "running": owner is not None,
+        "lease_owner": owner.decode("utf-8") if owner else None,
+        "lease_ttl_seconds": round(ttl_ms / 1000, 1) if ttl_ms and ttl_ms > 0 else None,
+    }
+
+
+def _is_due(interval_seconds):
+    # Una corrida que terminó en error o perdió el lease no cuenta
+    last_ok = _read_run(LAST_OK_RUN_KEY)
+    if not last_ok or not last_ok.get("started_at"):
+        return True
+    return time.time() - last_ok["started_at"] >= interval_seconds
+
+
+def _save_finished(record):
+    pipe = _redis.pipeline()
+    pipe.delete(CURRENT_RUN_KEY, LAST_RUN_KEY)
+    pipe.hset(LAST_RUN_KEY, mapping=record)
+    if record["status"] == "ok":
+        pipe.delete(LAST_OK_RUN_KEY)
+        pipe.hset(LAST_OK_RUN_KEY, mapping=record)
+    pipe.execute()
+
+
+def run_cleanup_once(force=False, interval_seconds=3600):
+    """
+    Corre la limpieza si este proceso consigue el lease (y si ya toca, salvo
+    force). Devuelve el registro de la corrida o None si no corrió.
+    """
+    if not force and not _is_due(interval_seconds):
+        return None
+
+    owner = _owner_id()
+    lease = _Lease(owner, Config.RETENTION_LEASE_SECONDS)
+    if not lease.acquire():
+        return None
+
+    # Otro pudo terminar justo entre el chequeo y el lease
+    if not force and not _is_due(interval_seconds):
+        lease.release()
+        return None
+
+    record = {"owner": owner, "started_at": time.time(), "status": "running"}
+    try:
+        _redis.delete(CURRENT_RUN_KEY)
+        _redis.hset(CURRENT_RUN_KEY, mapping=record)
+        stats = cleanup_expired_projects(keep_going=lambda: not lease.lost.is_set())
+        record.update(stats)
+        if not lease.lost.is_set():
+            record["events_deleted"] = cleanup_expired_events()
+        record["status"] = "lost_lease" if lease.lost.is_set() else "ok"
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = str(e)[:500]
+        raise
+    finally:
+        record["finished_at"] = time.time()
+        try:
+            _save_finished(record)
+        finally:
+            lease.release()
+    return record
+
+
+def _jittered(seconds):
+    return seconds * random.uniform(1 - SCHEDULE_JITTER, 1 + SCHEDULE_JITTER)
+
+
 def run_cleanup_loop(interval_seconds=3600):
+    # Cada proceso revisa varias veces por intervalo, en momentos distintos;
+    # el primero que encuentra la limpieza vencida toma el lease
+    check_seconds = max(30, interval_seconds / 6)
+    time.sleep(_jittered(check_seconds))
     while True:
         try:
-            cleanup_expired_projects()
-            cleanup_expired_events()
+            run_cleanup_once(interval_seconds=interval_seconds)
         except Exception as e:
             log.error("Error en limpieza automática: %s", e)
-        time.sleep(interval_seconds)
+        time.sleep(_jittered(check_seconds))
@@ -0,0 +1,189 @@
+from sqlalchemy import case, func, or_, select, union_all
+
+from extensions import Session
+from models import Project, ProjectSegment, ProjectState
+from services.project_store import to_uuid
+
+
+SEARCH_CONFIG = "spanish"
+MIN_QUERY_LENGTH = 2
+SEGMENTS_PER_PROJECT = 3
+HEADLINE_OPTIONS = "StartSel=«, StopSel=», MaxWords=24, MinWords=8, MaxFragments=1"
+
+# ts_rank_cd normalizado con rank/(rank+1): queda en [0, 1) como similarity
+RANK_NORMALIZATION = 32
+LIKE_ESCAPE = "\\"
+
+
+def _escape_like(value):
+    return (
+        value.replace(LIKE_ESCAPE, LIKE_ESCAPE * 2)
+        .replace("%", LIKE_ESCAPE + "%")
+        .replace("_", LIKE_ESCAPE + "_")
+    )
+
+
+def _segment_hits(session, user_uuid, query, limit):
+    """Segmentos cuyo texto calza con la query, top N por proyecto."""
+    ts_query = func.websearch_to_tsquery(SEARCH_CONFIG, query)
+    rank = func.ts_rank_cd(ProjectSegment.search_vector, ts_query, RANK_NORMALIZATION)
+    ranked = (
+        session.query(
+            ProjectSegment.project_id.label("project_id"),
+            ProjectSegment.segment_id.label("segment_id"),
+            ProjectSegment.start_ms.label("start_ms"),
+            ProjectSegment.end_ms.label("end_ms"),
+            ProjectSegment.text.label("text"),
+            rank.label("rank"),
+            func.row_number().over(
+                partition_by=ProjectSegment.project_id,
+                order_by=(rank.desc(), ProjectSegment.start_ms.asc())
+            ).label("position")
+        )
+        .join(Project, Project.id == ProjectSegment.project_id)
+        .filter(Project.user_id == user_uuid)
+        .filter(ProjectSegment.search_vector.op("@@")(ts_query))
+        .subquery()
+    )
+    return (
+        session.query(
+            ranked.c.project_id,
+            ranked.c.segment_id,
+            ranked.c.start_ms,
+            ranked.c.end_ms,
+            ranked.c.rank,
+            func.ts_headline(
+                SEARCH_CONFIG,
+                ranked.c.text,
+                ts_query,
+                HEADLINE_OPTIONS
+            ).label("snippet")
+        )
+        .filter(ranked.c.position <= SEGMENTS_PER_PROJECT)
+        .order_by(ranked.c.rank.desc())
+        .limit(limit * SEGMENTS_PER_PROJECT)
+        .all()
+    )
+
+
+def _column_hits(id_column, column, query, like):
+    # Columna desnuda para que el índice trigram sirva al ILIKE y al %
+    contains = column.ilike(like, escape=LIKE_ESCAPE)
+    return (
+        select(
+            id_column.label("project_id"),
+            # Un substring exacto siempre debe ganarle a un parecido
+            case((contains, 1.0), else_=func.similarity(column, query)).label("score")
+        )
+        .where(column.isnot(None))
+        .where(or_(contains, column.op("%")(query)))
+    )
+
+
+def _metadata_hits(session, user_uuid, query, limit):
+    """
+    Proyectos cuyo título o participante se parece a la query (pg_trgm). Un
+    UNION en vez de un OR sobre las dos tablas: cada lado usa su índice.
+    """
+    like = f"%{_escape_like(query)}%"
+    title_hits = _column_hits(Project.id, Project.title, query, like).where(
+        Project.user_id == user_uuid
+    )
+    participant_hits = (
+        _column_hits(ProjectState.project_id, ProjectState.participant_name, query, like)
+        .join(Project, Project.id == ProjectState.project_id)
+        .where(Project.user_id == user_uuid)
+    )
+    hits = union_all(title_hits, participant_hits).subquery()
+    score = func.max(hits.c.score)
+    return (
+        session.query(hits.c.project_id, score.label("score"))
+        .group_by(hits.c.project_id)
+        .order_by(score.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def search_projects(user_id, query, limit=20):
+    """
+    Busca en título, participante y en lo que se dijo en cada segmento.
+
+    Retorna proyectos ordenados por relevancia; cada uno trae los segmentos
+    que calzaron con sus tiempos (start_ms/end_ms) y un snippet resaltado.
+    """
+    user_uuid = to_uuid(user_id)
+    query = (query or "").strip()
+    if not user_uuid or len(query) < MIN_QUERY_LENGTH:
+        return []
+
+    session = Session()
+    try:
+        segment_rows = _segment_hits(session, user_uuid, query, limit)
+        metadata_rows = _metadata_hits(session, user_uuid, query, limit)
+
+        metadata_scores = {}
+        transcript_scores = {}
+        matched = {}
+        segments = {}
+        for project_id, score in metadata_rows:
+            metadata_scores[project_id] = float(score or 0.0)
+            matched.setdefault(project_id, set()).add("metadata")
+
+        for row in segment_rows:
+            rank = float(row.rank or 0.0)
+            transcript_scores[row.project_id] = max(transcript_scores.get(row.project_id, 0.0), rank)
+            matched.setdefault(row.project_id, set()).add("transcript")
+            segments.setdefault(row.project_id, []).append({
+                "segment_id": row.segment_id,
+                "start_ms": row.start_ms,
+                "end_ms": row.end_ms,
+                "rank": round(rank, 4),
+                "snippet": row.snippet
+            })
+
+        # Las dos fuentes en [0, 1] y con el mismo peso: el rank de texto se
+        # lleva relativo al mejor de esta búsqueda (por sí solo casi nunca
+        # pasa de 0.1). Calzar en ambas suma.
+        best_rank = max(transcript_scores.values(), default=0.0)
+        scores = {
+            project_id: (
+                metadata_scores.get(project_id, 0.0)
+                + (transcript_scores.get(project_id, 0.0) / best_rank if best_rank else 0.0)
+            ) / 2
+            for project_id in matched
+        }
+
+        if not scores:
+            return []
+
+        top_ids = sorted(scores, key=lambda pid: scores[pid], reverse=True)[:limit]
+        rows = (
+            session.query(Project, ProjectState.participant_name)
+            .join(ProjectState, ProjectState.project_id == Project.id)
+            .filter(Project.id.in_(top_ids))
+            .all()
+        )
+        by_id = {project.id: (project, participant) for project, participant in rows}
+
+        results = []
+        for project_id in top_ids:
+            if project_id not in by_id:
+                continue
+            project, participant = by_id[project_id]
+            results.append({
+                "project_id": str(project.id),
+                "project_name": project.title,
+                "participant_name": participant,
+                "status": project.status,
+                "created_at": project.created_at.isoformat() if project.created_at else None,
+                "score": round(scores[project_id], 4),
+                "matched": sorted(matched.get(project_id, ())),
+                "segments": sorted(
+                    segments.get(project_id, []),
+                    key=lambda seg: seg["start_ms"]
+                )
+            })
+        return results
+    finally:
+        Session.remove()
@@ -0,0 +1,184 @@
+import time
+import uuid
+from datetime import datetime, timezone
+
+from sqlalchemy import DateTime, cast, column, update, values
+from sqlalchemy.dialects.postgresql import UUID
+
+from config import Config
+from extensions import Session
+from logger import get_logger
+from models import UserSession
+from services.cache import get_redis_client
+
+
+log = get_logger("session_activity")
+_redis = get_redis_client()
+
+
+SESSION_LAST_SEEN_KEY = "session:last_seen"
+USER_LAST_SEEN_KEY = "user:last_seen"
+# Toques pendientes de bajar a Postgres. Al flushear se renombran a una
+# llave propia de la corrida y se anotan en BATCHES_KEY hasta terminar
+PENDING_KEY = "session:last_seen:pending"
+BATCH_PREFIX = "session:last_seen:batch:"
+BATCHES_KEY = "session:last_seen:batches"
+# Un lote que sigue anotado después de esto quedó de una corrida que falló
+BATCH_RETRY_SECONDS = 5 * 60
+
+CONNECTED_WINDOW_SECONDS = 10 * 60
+FLUSH_BATCH_SIZE = 1000
+
+# KEYS[1]: pendientes, KEYS[2]: lotes en curso, KEYS[3]: llave del lote
+# ARGV[1]: now. Todos los workers flushean; el rename va junto con el
+# registro para que nadie pise ni pierda un lote ajeno.
+_CLAIM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('RENAME', KEYS[1], KEYS[3])
+redis.call('ZADD', KEYS[2], ARGV[1], KEYS[3])
+return 1
+"""
+
+_claim_script = _redis.register_script(_CLAIM_SCRIPT)
+
+
+def record_touch(session_id, user_id):
+    """Registra actividad solo en Redis; el flusher la lleva a user_sessions."""
+    now = time.time()
+    pipe = _redis.pipeline(transaction=False)
+    pipe.zadd(SESSION_LAST_SEEN_KEY, {str(session_id): now})
+    pipe.zadd(USER_LAST_SEEN_KEY, {str(user_id): now})
+    pipe.zadd(PENDING_KEY, {str(session_id): now})
+    pipe.execute()
+
+
+def forget_session(session_id):
+    try:
+        pipe = _redis.pipeline(transaction=False)
+        pipe.zrem(SESSION_LAST_SEEN_KEY, str(session_id))
+        pipe.zrem(PENDING_KEY, str(session_id))
+        pipe.execute()
+    except Exception:
+        pass
+
+
+def _to_datetime(timestamp):
+    return datetime.fromtimestamp(float(timestamp), tz=timezone.utc)
+
+
+def get_last_seen(session_ids):
+    """{session_id: datetime} para las sesiones con actividad en Redis."""
+    session_ids = [str(session_id) for session_id in session_ids]
+    if not session_ids:
+        return {}
+    try:
+        pipe = _redis.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.zscore(SESSION_LAST_SEEN_KEY, session_id)
+        scores = pipe.execute()
+    except Exception:
+        return {}
+    return {
+        session_id: _to_datetime(score)
+        for session_id, score in zip(session_ids, scores)
+        if score is not None
+    }
+
+
+def count_connected_users(window_seconds=CONNECTED_WINDOW_SECONDS):
+    """
+    None si Redis no responde o no tiene registro de actividad (reinicio,
+    flush): el que llama cuenta desde user_sessions.
+    """
+    try:
+        pipe = _redis.pipeline(transaction=False)
+        pipe.exists(USER_LAST_SEEN_KEY)
+        pipe.zcount(USER_LAST_SEEN_KEY, time.time() - window_seconds, "+inf")
+        exists, count = pipe.execute()
+    except Exception:
+        return None
+    if not exists:
+        return None
+    return int(count)
+
+
+def _bulk_update(session, rows):
+    data = values(
+        column("id", UUID(as_uuid=False)),
+        column("last_seen_at", DateTime(timezone=True)),
+        name="seen"
+    ).data(rows)
+    result = session.execute(
+        update(UserSession)
+        .where(UserSession.id == cast(data.c.id, UUID(as_uuid=True)))
+        .where(UserSession.last_seen_at < data.c.last_seen_at)
+        .values(last_seen_at=data.c.last_seen_at)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount or 0
+
+
+def _flush_batch(batch_key):
+    pending = _redis.zrange(batch_key, 0, -1, withscores=True)
+    rows = [
+        (member.decode("utf-8"), _to_datetime(score))
+        for member, score in pending
+    ]
+
+    session = Session()
+    try:
+        updated = 0
+        for start in range(0, len(rows), FLUSH_BATCH_SIZE):
+            updated += _bulk_update(session, rows[start:start + FLUSH_BATCH_SIZE])
+        session.commit()
+    finally:
+        Session.remove()
+
+    pipe = _redis.pipeline(transaction=False)
+    pipe.delete(batch_key)
+    pipe.zrem(BATCHES_KEY, batch_key)
+    pipe.execute()
+    return len(rows), updated
+
+
+def flush_session_activity():
+    """Baja los toques pendientes con un UPDATE ... FROM (VALUES ...) por lote."""
+    now = time.time()
+    batch_key = f"{BATCH_PREFIX}{uuid.uuid4().hex}"
+    batches = []
+    if _claim_script(keys=[PENDING_KEY, BATCHES_KEY, batch_key], args=[now]):
+        batches.append(batch_key)
+
+    # Lotes de corridas que fallaron a medias. Si dos workers toman el mismo
+    # no pasa nada: el UPDATE solo avanza last_seen_at.
+    for stale in _redis.zrangebyscore(BATCHES_KEY, "-inf", now - BATCH_RETRY_SECONDS):
+        batches.append(stale.decode("utf-8"))
+
+    touches = 0
+    updated = 0
+    for key in batches:
+        batch_touches, batch_updated = _flush_batch(key)
+        touches += batch_touches
+        updated += batch_updated
+
+    # Ninguna sesión vive más que SESSION_LIFETIME_DAYS; para usuarios solo
+    # importa la ventana de "conectado"
+    horizon = time.time() - max(CONNECTED_WINDOW_SECONDS, Config.SESSION_LIFETIME_DAYS * 86400)
+    _redis.zremrangebyscore(SESSION_LAST_SEEN_KEY, "-inf", horizon)
+    _redis.zremrangebyscore(USER_LAST_SEEN_KEY, "-inf", time.time() - CONNECTED_WINDOW_SECONDS)
+
+    if touches:
+        log.info("Actividad de sesiones: %s toques, %s filas actualizadas", touches, updated)
+    return updated
+
+
+def run_flush_loop(interval_seconds=None):
+    interval_seconds = interval_seconds or Config.SESSION_FLUSH_INTERVAL_SECONDS
+    while True:
+        try:
+            flush_session_activity()
+        except Exception as e:
+            log.error("Error al persistir actividad de sesiones: %s", e)
+        time.sleep(interval_seconds)
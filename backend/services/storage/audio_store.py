@@ -24,6 +24,10 @@ class BaseAudioStorage:
     def ensure_local_file(self, project_id, chunk_meta):
         raise NotImplementedError
 
+    def delete_project(self, project_id):
+        """Borra los chunks guardados fuera del directorio del proyecto."""
+        return 0
+
     def cleanup_local_file(self, path):
         try:
             if path and os.path.exists(path):
@@ -66,9 +70,11 @@ class S3AudioStorage(BaseAudioStorage):
         self._prefix = Config.S3_AUDIO_PREFIX.strip('/')
         self._client = boto3.client("s3")
 
+    def _project_prefix(self, project_id):
+        return f"{self._prefix}/{project_id}" if self._prefix else project_id
+
     def _object_key(self, project_id, seq):
-        base = f"{self._prefix}/{project_id}" if self._prefix else project_id
-        return f"{base}/chunk_{seq:06d}.webm"
+        return f"{self._project_prefix(project_id)}/chunk_{seq:06d}.webm"
 
     def save_chunk(self, project_id, seq, data):
         key = self._object_key(project_id, seq)
@@ -92,6 +98,25 @@ class S3AudioStorage(BaseAudioStorage):
             raise AudioStorageError(f"Error descargando chunk S3: {exc}") from exc
         return tmp.name, True
 
+    def delete_project(self, project_id):
+        prefix = self._project_prefix(project_id) + "/"
+        deleted = 0
+        try:
+            paginator = self._client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self._bucket, Prefix=prefix):
+                keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+                if not keys:
+                    continue
+                # list_objects_v2 pagina de a 1000, el máximo de delete_objects
+                self._client.delete_objects(
+                    Bucket=self._bucket,
+                    Delete={"Objects": keys, "Quiet": True}
+                )
+                deleted += len(keys)
+        except (BotoCoreError, ClientError) as exc:
+            raise AudioStorageError(f"Error borrando chunks S3: {exc}") from exc
+        return deleted
+
 
 _storage_instance = None
 
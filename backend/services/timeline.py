@@ -1,10 +1,23 @@
+import json
 import uuid
+from typing import cast
 
 from sqlalchemy import update
 
 from extensions import Session
 from models import ProjectPhoto, ProjectState
 from services import project_store
+from services.cache import get_redis_client
+
+
+_redis = get_redis_client()
+
+# El manifiesto se guarda por versión; escribir una foto sube la versión y
+# las copias viejas simplemente expiran
+PHOTO_MANIFEST_TTL = 300
+# La versión se renueva al subirla y al cachear un manifiesto, así dura más
+# que cualquier copia hecha con ella; la de un proyecto quieto o borrado expira
+PHOTO_VERSION_TTL = 24 * 60 * 60
 
 
 def _to_uuid(value):
@@ -16,6 +29,34 @@ def _to_uuid(value):
         return None
 
 
+def _manifest_version_key(project_id):
+    return f"photos:version:{project_id}"
+
+
+def _manifest_key(project_id, version):
+    return f"photos:manifest:{project_id}:{version}"
+
+
+def _bump_manifest_version(project_id):
+    # Siempre después del commit: quien lea la versión nueva ve los datos nuevos
+    try:
+        pipe = _redis.pipeline()
+        pipe.incr(_manifest_version_key(project_id))
+        pipe.expire(_manifest_version_key(project_id), PHOTO_VERSION_TTL)
+        pipe.execute()
+    except Exception:
+        pass
+
+
+def _photo_dict(photo):
+    return {
+        "photo_id": photo.photo_id,
+        "t_ms": photo.t_ms,
+        "original_path": photo.original_path,
+        "stylized_path": photo.stylized_path
+    }
+
+
 def add_photo(project_id, photo_id, t_ms, original_path, stylized_path=None):
     project_uuid = _to_uuid(project_id)
     if not project_uuid:
@@ -40,6 +81,7 @@ def add_photo(project_id, photo_id, t_ms, original_path, stylized_path=None):
         )
         session.commit()
         project_store.invalidate_cache(project_id)
+        _bump_manifest_version(project_id)
 
         return {
             "photo_id": photo_id,
@@ -80,16 +122,85 @@ def update_photo_stylized(project_id, photo_id, stylized_path):
 
         session.commit()
         project_store.invalidate_cache(project_id)
+        _bump_manifest_version(project_id)
         return True
     finally:
         Session.remove()
 
 
+def update_photos_stylized(project_id, stylized_paths):
+    """
+    Igual que update_photo_stylized pero para varias fotos en una sola
+    transacción. stylized_paths: {photo_id: ruta}.
+    """
+    project_uuid = _to_uuid(project_id)
+    if not project_uuid:
+        raise ValueError("project_id inválido")
+    if not stylized_paths:
+        return 0
+
+    session = Session()
+    try:
+        photos = (
+            session.query(ProjectPhoto)
+            .filter(ProjectPhoto.project_id == project_uuid)
+            .filter(ProjectPhoto.photo_id.in_(list(stylized_paths.keys())))
+            .with_for_update()
+            .all()
+        )
+        newly_done = 0
+        for photo in photos:
+            stylized_path = stylized_paths[photo.photo_id]
+            if stylized_path and not photo.stylized_path:
+                newly_done += 1
+            photo.stylized_path = stylized_path
+
+        if newly_done:
+            session.execute(
+                update(ProjectState)
+                .where(ProjectState.project_id == project_uuid)
+                .values(photos_done=ProjectState.photos_done + newly_done)
+            )
+
+        session.commit()
+        project_store.invalidate_cache(project_id)
+        _bump_manifest_version(project_id)
+        return len(photos)
+    finally:
+        Session.remove()
+
+
+def get_photo(project_id, photo_id):
+    project_uuid = _to_uuid(project_id)
+    if not project_uuid:
+        return None
+
+    session = Session()
+    try:
+        photo = (
+            session.query(ProjectPhoto)
+            .filter_by(project_id=project_uuid, photo_id=photo_id)
+            .first()
+        )
+        return _photo_dict(photo) if photo else None
+    finally:
+        Session.remove()
+
+
 def get_photos(project_id):
     project_uuid = _to_uuid(project_id)
     if not project_uuid:
         return []
 
+    version = None
+    try:
+        version = int(_redis.get(_manifest_version_key(project_id)) or 0)
+        cached_raw = _redis.get(_manifest_key(project_id, version))
+        if cached_raw:
+            return json.loads(cast(bytes, cached_raw).decode("utf-8"))
+    except Exception:
+        pass
+
     session = Session()
     try:
         photos = (
@@ -98,14 +209,20 @@ def get_photos(project_id):
             .order_by(ProjectPhoto.t_ms.asc(), ProjectPhoto.id.asc())
             .all()
         )
-        return [
-            {
-                "photo_id": photo.photo_id,
-                "t_ms": photo.t_ms,
-                "original_path": photo.original_path,
-                "stylized_path": photo.stylized_path
-            }
-            for photo in photos
-        ]
+        data = [_photo_dict(photo) for photo in photos]
     finally:
         Session.remove()
+
+    if version is not None:
+        try:
+            pipe = _redis.pipeline()
+            pipe.setex(
+                _manifest_key(project_id, version),
+                PHOTO_MANIFEST_TTL,
+                json.dumps(data, ensure_ascii=False).encode("utf-8")
+            )
+            pipe.expire(_manifest_version_key(project_id), PHOTO_VERSION_TTL)
+            pipe.execute()
+        except Exception:
+            pass
+    return data
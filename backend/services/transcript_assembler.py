@@ -0,0 +1,183 @@
+from logger import get_logger
+from services.cache import get_redis_client
+
+
+log = get_logger("transcript_assembler")
+_redis = get_redis_client()
+
+
+# Transcripción armada a medida que llegan los segmentos, en cualquier orden.
+# prepare fija el orden (por start_ms) y los marcadores de foto que van
+# después de cada segmento; cada texto que llega se guarda por índice y el
+# puntero `next` avanza mientras el prefijo sea contiguo, haciendo APPEND al
+# texto plano y al texto con marcadores. Cuando llega el último, finalize
+# encuentra el input del LLM listo.
+
+TRANSCRIPT_TTL = 2 * 24 * 60 * 60
+
+
+def _parts_key(project_id):
+    return f"transcript:{project_id}:parts"
+
+
+def _marked_key(project_id):
+    return f"transcript:{project_id}:marked"
+
+
+def _plain_key(project_id):
+    return f"transcript:{project_id}:plain"
+
+
+# KEYS[1]: hash (next, total, i:<segmento> -> índice, m:<índice>, t:<índice>)
+# KEYS[2]: texto con marcadores, KEYS[3]: texto plano
+# ARGV: ttl, luego pares segmento, texto
+# Devuelve {next, total}; next = -1 si no hay ensamblado para el proyecto
+# Un texto distinto para un índice ya pasado (corrida duplicada o reintento)
+# obliga a rearmar ambos textos desde el principio.
+_ADD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {-1, 0}
+end
+local nxt = tonumber(redis.call('HGET', KEYS[1], 'next'))
+local total = tonumber(redis.call('HGET', KEYS[1], 'total'))
+local rebuild = false
+for i = 2, #ARGV, 2 do
+    local idx = redis.call('HGET', KEYS[1], 'i:' .. ARGV[i])
+    if idx then
+        local field = 't:' .. idx
+        if tonumber(idx) < nxt and redis.call('HGET', KEYS[1], field) ~= ARGV[i + 1] then
+            rebuild = true
+        end
+        redis.call('HSET', KEYS[1], field, ARGV[i + 1])
+    end
+end
+if rebuild then
+    redis.call('DEL', KEYS[2], KEYS[3])
+    nxt = 0
+end
+while nxt < total do
+    local text = redis.call('HGET', KEYS[1], 't:' .. nxt)
+    if not text then
+        break
+    end
+    local markers = redis.call('HGET', KEYS[1], 'm:' .. nxt) or ''
+    redis.call('APPEND', KEYS[2], text .. markers)
+    if text ~= '' then
+        if redis.call('STRLEN', KEYS[3]) > 0 then
+            redis.call('APPEND', KEYS[3], ' ' .. text)
+        else
+            redis.call('APPEND', KEYS[3], text)
+        end
+    end
+    nxt = nxt + 1
+end
+redis.call('HSET', KEYS[1], 'next', nxt)
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], tonumber(ARGV[1]))
+end
+return {nxt, total}
+"""
+
+_add_script = _redis.register_script(_ADD_SCRIPT)
+
+
+def photo_markers(segments, photos):
+    """
+    Marcadores que van después de cada segmento (ya ordenados): las fotos con
+    t_ms <= end_ms que no cayeron en uno anterior. Las que quedan después
+    del último segmento van con él.
+    """
+    sorted_photos = sorted(photos, key=lambda p: p.get("t_ms", 0))
+    photo_index = 0
+    total_photos = len(sorted_photos)
+    markers = []
+    for segment in segments:
+        segment_end = segment.get("end_ms", 0)
+        parts = []
+        while photo_index < total_photos and sorted_photos[photo_index].get("t_ms", 0) <= segment_end:
+            parts.append(f" [[FOTO:{sorted_photos[photo_index]['photo_id']}]] ")
+            photo_index += 1
+        markers.append("".join(parts))
+
+    leftover = "".join(
+        f" [[FOTO:{photo['photo_id']}]] " for photo in sorted_photos[photo_index:]
+    )
+    if markers:
+        markers[-1] += leftover
+    return markers, leftover
+
+
+def init(project_id, segments, photos):
+    """
+    Arma el esqueleto para los segmentos de esta corrida. Los que ya están
+    transcritos (reintento de prepare) entran de una vez.
+    """
+    ordered = sorted(segments.values(), key=lambda s: s.get("start_ms", 0))
+    markers, _ = photo_markers(ordered, photos)
+
+    mapping = {"next": 0, "total": len(ordered)}
+    for index, (segment, marker) in enumerate(zip(ordered, markers)):
+        mapping[f"i:{segment['segment_id']}"] = index
+        if marker:
+            mapping[f"m:{index}"] = marker
+
+    pipe = _redis.pipeline()
+    pipe.delete(_parts_key(project_id), _marked_key(project_id), _plain_key(project_id))
+    pipe.hset(_parts_key(project_id), mapping=mapping)
+    pipe.expire(_parts_key(project_id), TRANSCRIPT_TTL)
+    pipe.execute()
+
+    done = [
+        (segment["segment_id"], segment.get("text") or "")
+        for segment in ordered
+        if segment.get("status") == "done"
+    ]
+    if done:
+        _add(project_id, done)
+
+
+def _add(project_id, items):
+    args = [TRANSCRIPT_TTL]
+    for segment_id, text in items:
+        args.extend([segment_id, text])
+    result = _add_script(
+        keys=[_parts_key(project_id), _marked_key(project_id), _plain_key(project_id)],
+        args=args
+    )
+    return int(result[0]), int(result[1])
+
+
+def add_segment(project_id, segment_id, text):
+    """Suma un segmento transcrito. Si Redis falla, finalize arma todo desde la base."""
+    try:
+        ready, total = _add(project_id, [(segment_id, text or "")])
+    except Exception as e:
+        log.warning("No se pudo sumar %s al ensamblado de %s: %s", segment_id, project_id, e)
+        return None
+    if ready < 0:
+        return None
+    return ready, total
+
+
+def get_transcript(project_id, with_markers=False):
+    """
+    Prefijo contiguo ya armado: {"text", "segments_ready", "segments_total",
+    "complete"}. None si no hay ensamblado para el proyecto.
+    """
+    try:
+        pipe = _redis.pipeline(transaction=False)
+        pipe.hmget(_parts_key(project_id), "next", "total")
+        pipe.get(_marked_key(project_id) if with_markers else _plain_key(project_id))
+        (ready, total), text = pipe.execute()
+    except Exception:
+        return None
+    if ready is None or total is None:
+        return None
+    ready = int(ready)
+    total = int(total)
+    return {
+        "text": (text or b"").decode("utf-8").strip(),
+        "segments_ready": ready,
+        "segments_total": total,
+        "complete": ready >= total,
+    }
@@ -0,0 +1,318 @@
+import json
+import os
+import random
+import signal
+import socket
+import threading
+import time
+
+from rq import SimpleWorker
+from rq.timeouts import TimerDeathPenalty
+
+from config import Config
+from logger import get_logger
+from services.queue import BULK_SUFFIX, LANE_BULK, is_bulk_queue, lane_queue_name
+
+
+log = get_logger("worker_pool")
+
+
+QUEUE_ALIASES = {
+    "prepare": "RQ_PREPARE_QUEUE",
+    "transcribe": "RQ_TRANSCRIBE_QUEUE",
+    "photos": "RQ_PHOTO_QUEUE",
+    "llm": "RQ_LLM_QUEUE",
+}
+
+UTILISATION_KEY = "worker:utilisation:{host}"
+# Cada cuánto un slot con las bulk cerradas vuelve a mirar el gate
+BULK_GATE_RECHECK_SECONDS = 5
+UTILISATION_TTL = 5 * 60
+
+
+def resolve_queue_name(name):
+    attr = QUEUE_ALIASES.get(name)
+    return getattr(Config, attr) if attr else name
+
+
+def _parse_spec(spec, cast):
+    result = []
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, value = part.partition("=")
+        try:
+            number = cast(value)
+        except ValueError:
+            raise ValueError(f"Valor inválido en '{part}'")
+        if number < 0:
+            raise ValueError(f"Valor negativo en '{part}'")
+        result.append((resolve_queue_name(name.strip()), number))
+    return result
+
+
+def parse_slot_spec(spec):
+    """
+    "transcribe=8,photos=4" -> [(cola, 8), (cola, 4)]. Acepta alias o el
+    nombre real de la cola.
+    """
+    return _parse_spec(spec, int)
+
+
+def parse_weight_spec(spec):
+    """Como parse_slot_spec pero con pesos decimales: "transcribe=4,llm=0.5"."""
+    return dict(_parse_spec(spec, float))
+
+
+class SlotWorker(SimpleWorker):
+    """
+    SimpleWorker que corre en un hilo: sin handlers de señales (solo el hilo
+    principal puede instalarlos) y con timeouts por timer en vez de SIGALRM.
+    Si escucha varias colas, el orden se sortea por peso después de cada job.
+    """
+
+    # Usa atributos privados de RQ (fijado en requirements.txt):
+    # _install_signal_handlers (se anula), _ordered_queues (orden de las
+    # colas que se sortea) y _stop_requested (parada desde WorkerPool).
+    death_penalty_class = TimerDeathPenalty
+
+    def __init__(self, *args, slot_group=None, weights=None, bulk_gate=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slot_group = slot_group
+        self.weights = weights or {}
+        self.bulk_gate = bulk_gate
+        self.busy_since = None
+        self.busy_seconds = 0.0
+        self._bulk_excluded = False
+        self._shuffle_queues()
+
+    def _install_signal_handlers(self):
+        pass
+
+    def _weighted_order(self, queues):
+        if len(queues) < 2 or not self.weights:
+            return list(queues)
+        pending = list(queues)
+        ordered = []
+        while pending:
+            weights = [
+                max(0.0, self.weights.get(_base_queue_name(q.name), 1.0)) or 0.01
+                for q in pending
+            ]
+            chosen = random.choices(pending, weights=weights)[0]
+            ordered.append(chosen)
+            pending.remove(chosen)
+        return ordered
+
+    def _shuffle_queues(self):
+        # Las altas siempre antes que las bulk; las bulk solo si hay cupo
+        high = [q for q in self.queues if not is_bulk_queue(q.name)]
+        bulk = [q for q in self.queues if is_bulk_queue(q.name)]
+        ordered = self._weighted_order(high)
+        self._bulk_excluded = False
+        if bulk:
+            if self.bulk_gate is None or self.bulk_gate.has_room():
+                ordered += self._weighted_order(bulk)
+            else:
+                self._bulk_excluded = True
+        self._ordered_queues = ordered or high
+
+    def reorder_queues(self, reference_queue):
+        self._shuffle_queues()
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        # Sin las bulk, RQ se quedaría en el BLPOP de las altas todo el
+        # timeout aunque el gate se libere; se escucha de a tramos cortos y
+        # se vuelve a mirar el gate entre uno y otro
+        while True:
+            self._shuffle_queues()
+            if not self._bulk_excluded or timeout is None:
+                return super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
+            result = super().dequeue_job_and_maintain_ttl(
+                BULK_GATE_RECHECK_SECONDS,
+                BULK_GATE_RECHECK_SECONDS
+            )
+            if result is not None or self._stop_requested:
+                return result
+
+    def perform_job(self, job, queue):
+        is_bulk = self.bulk_gate is not None and is_bulk_queue(queue.name)
+        if is_bulk:
+            self.bulk_gate.enter()
+        self.busy_since = time.monotonic()
+        try:
+            return super().perform_job(job, queue)
+        finally:
+            self.busy_seconds += time.monotonic() - self.busy_since
+            self.busy_since = None
+            if is_bulk:
+                self.bulk_gate.leave()
+
+    def busy_total(self):
+        busy = self.busy_seconds
+        if self.busy_since is not None:
+            busy += time.monotonic() - self.busy_since
+        return busy
+
+
+def _base_queue_name(queue_name):
+    if is_bulk_queue(queue_name):
+        return queue_name[:-len(BULK_SUFFIX)]
+    return queue_name
+
+
+class BulkGate:
+    """
+    Tope de slots de un grupo ocupados con jobs bulk. Es blando: se consulta
+    antes de cada dequeue, así que dos slots pueden pasarse por uno.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self._lock = threading.Lock()
+
+    def has_room(self):
+        with self._lock:
+            return self.running < self.limit
+
+    def enter(self):
+        with self._lock:
+            self.running += 1
+
+    def leave(self):
+        with self._lock:
+            self.running = max(0, self.running - 1)
+
+
+class WorkerPool:
+    """Varios SlotWorker en un mismo proceso, agrupados por cola."""
+
+    def __init__(self, redis_conn, slots, shared=0, weights=None):
+        self.redis_conn = redis_conn
+        self.slots = [(queue, count) for queue, count in slots if count > 0]
+        self.shared = shared
+        self.weights = weights or {queue: float(count) for queue, count in self.slots}
+        self.workers = []
+        self.threads = []
+        self._stopping = threading.Event()
+        self._last_busy = {}
+        self._last_report = time.monotonic()
+
+    def _worker_name(self, group, index):
+        return f"{socket.gethostname()}.{os.getpid()}.{group}.{index}"
+
+    def _spawn(self, group, queues, index, bulk_gate):
+        worker = SlotWorker(
+            queues,
+            connection=self.redis_conn,
+            name=self._worker_name(group, index),
+            slot_group=group,
+            weights=self.weights,
+            bulk_gate=bulk_gate
+        )
+        thread = threading.Thread(
+            target=self._run_worker,
+            args=(worker,),
+            name=f"slot-{group}-{index}",
+            daemon=True
+        )
+        self.workers.append(worker)
+        self.threads.append(thread)
+
+    def _run_worker(self, worker):
+        while not self._stopping.is_set():
+            try:
+                worker.work(with_scheduler=False)
+                return
+            except Exception as e:
+                log.error("Slot %s cayó: %s. Reiniciando en 5s", worker.name, e)
+                time.sleep(5)
+
+    def _bulk_gate(self, slot_count):
+        return BulkGate(max(1, int(slot_count * Config.BULK_MAX_SLOT_SHARE)))
+
+    def _with_bulk(self, queues):
+        return list(queues) + [lane_queue_name(queue, LANE_BULK) for queue in queues]
+
+    def start(self):
+        for queue, count in self.slots:
+            gate = self._bulk_gate(count)
+            for index in range(count):
+                self._spawn(queue, self._with_bulk([queue]), index, gate)
+        all_queues = [queue for queue, _ in self.slots]
+        shared_gate = self._bulk_gate(self.shared)
+        for index in range(self.shared):
+            self._spawn("shared", self._with_bulk(all_queues), index, shared_gate)
+        for thread in self.threads:
+            thread.start()
+        log.info(
+            "Pool de workers: %s%s",
+            ", ".join(f"{queue}={count}" for queue, count in self.slots),
+            f", shared={self.shared}" if self.shared else ""
+        )
+
+    def stop(self, *_):
+        if self._stopping.is_set():
+            return
+        log.info("Deteniendo pool: se terminan los jobs en curso")
+        self._stopping.set()
+        for worker in self.workers:
+            worker._stop_requested = True
+
+    def utilisation(self):
+        """Uso por grupo desde el último reporte: slots ocupados y % de tiempo."""
+        now = time.monotonic()
+        elapsed = max(1e-6, now - self._last_report)
+        groups = {}
+        for worker in self.workers:
+            busy_total = worker.busy_total()
+            delta = busy_total - self._last_busy.get(worker.name, 0.0)
+            self._last_busy[worker.name] = busy_total
+            group = groups.setdefault(worker.slot_group, {"slots": 0, "busy": 0, "busy_seconds": 0.0})
+            group["slots"] += 1
+            group["busy"] += 1 if worker.busy_since is not None else 0
+            group["busy_seconds"] += delta
+        self._last_report = now
+        return {
+            name: {
+                "slots": data["slots"],
+                "busy": data["busy"],
+                "utilisation": round(min(1.0, data["busy_seconds"] / (data["slots"] * elapsed)), 3)
+            }
+            for name, data in groups.items()
+        }
+
+    def report(self):
+        stats = self.utilisation()
+        log.info(
+            "Uso de slots: %s",
+            ", ".join(
+                f"{name} {data['busy']}/{data['slots']} ({data['utilisation'] * 100:.0f}%)"
+                for name, data in sorted(stats.items())
+            )
+        )
+        key = UTILISATION_KEY.format(host=f"{socket.gethostname()}.{os.getpid()}")
+        try:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            pipe.hset(key, mapping={name: json.dumps(data) for name, data in stats.items()})
+            pipe.expire(key, UTILISATION_TTL)
+            pipe.execute()
+        except Exception as e:
+            log.warning("No se pudo publicar uso de slots: %s", e)
+
+    def run(self, report_interval=60):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.start()
+        while any(thread.is_alive() for thread in self.threads):
+            self._stopping.wait(report_interval)
+            if self._stopping.is_set():
+                break
+            self.report()
+
+        # Los slots ociosos siguen bloqueados en el dequeue; basta con esperar
+        # a que los ocupados terminen su job
+        while any(worker.busy_since is not None for worker in self.workers):
+            time.sleep(1)
@@ -0,0 +1,82 @@
+"""
+Pruebas del reparto round-robin de fair_queue contra un Redis real. Usa
+REDIS_URL; si no hay Redis se saltan.
+
+    REDIS_URL=redis://localhost:6379/15 python3 -m pytest tests/test_fair_queue.py
+"""
+
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("redis")
+pytest.importorskip("rq")
+
+from rq.job import Job, JobStatus  # noqa: E402
+
+from services import fair_queue  # noqa: E402
+from services.cache import get_redis_client  # noqa: E402
+from services.queue import get_queue  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def redis_conn():
+    conn = get_redis_client()
+    try:
+        conn.ping()
+    except Exception as e:
+        pytest.skip(f"Redis no disponible: {e}")
+    return conn
+
+
+@pytest.fixture
+def queue(redis_conn, monkeypatch):
+    monkeypatch.setattr(fair_queue.Config, "FAIR_QUEUE_DEPTH", 3)
+    queue = get_queue(f"test_fair_queue_{uuid.uuid4().hex[:8]}")
+    yield queue
+    queue.delete(delete_jobs=True)
+    redis_conn.delete(
+        fair_queue._ring_key(queue.name),
+        fair_queue._active_key(queue.name),
+        fair_queue._releasing_key(queue.name)
+    )
+
+
+def _submit(queue, project_id, count):
+    jobs = [
+        fair_queue.create_deferred_job(queue, "transcribe_segment", project_id, f"seg_{i:04d}")
+        for i in range(count)
+    ]
+    fair_queue.submit(queue.name, project_id, jobs)
+    return jobs
+
+
+def test_released_jobs_are_queued_in_rq(queue, redis_conn):
+    jobs = _submit(queue, "p1", 2)
+    assert queue.get_job_ids() == [job.id for job in jobs]
+    for job in jobs:
+        assert Job.fetch(job.id, connection=redis_conn).get_status() == JobStatus.QUEUED
+
+
+def test_round_robin_between_projects(queue):
+    long_jobs = _submit(queue, "largo", 5)
+    # La cola RQ ya está llena con el proyecto largo; el corto espera su turno
+    short_jobs = _submit(queue, "corto", 2)
+    assert queue.get_job_ids() == [job.id for job in long_jobs[:3]]
+
+    queue.empty()
+    fair_queue.pump(queue.name)
+    assert queue.get_job_ids() == [long_jobs[3].id, short_jobs[0].id, long_jobs[4].id]
+
+
+def test_drop_project_removes_pending_jobs(queue, redis_conn):
+    _submit(queue, "largo", 2)
+    pending = _submit(queue, "otro", 4)
+    dropped = fair_queue.drop_project(queue.name, "otro")
+    # El primero ya estaba en RQ; el resto se descarta
+    assert dropped == [job.id for job in pending[1:]]
+    assert not any(Job.exists(job.id, connection=redis_conn) for job in pending[1:])
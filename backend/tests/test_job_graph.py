@@ -0,0 +1,164 @@
+"""
+Pruebas del fan-in de job_graph contra un Redis real (los scripts Lua no
+corren en un mock). Usa REDIS_URL; si no hay Redis se saltan.
+
+    REDIS_URL=redis://localhost:6379/15 python3 -m pytest tests/test_job_graph.py
+"""
+
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("redis")
+pytest.importorskip("rq")
+
+from rq.job import Job, JobStatus  # noqa: E402
+
+from services import fair_queue, job_graph  # noqa: E402
+from services.cache import get_redis_client  # noqa: E402
+from services.queue import get_queue  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def redis_conn():
+    conn = get_redis_client()
+    try:
+        conn.ping()
+    except Exception as e:
+        pytest.skip(f"Redis no disponible: {e}")
+    return conn
+
+
+@pytest.fixture
+def graph(redis_conn):
+    """Un grafo con dos hijos (uno que aborta, otro que no) y su final."""
+    graph_id = str(uuid.uuid4())
+    run_id = f"run.{uuid.uuid4().hex[:8]}"
+    queue = get_queue(f"test_job_graph_{uuid.uuid4().hex[:8]}")
+
+    def child(policy):
+        return fair_queue.create_deferred_job(
+            queue,
+            "transcribe_segment",
+            graph_id,
+            "seg_0000",
+            meta=job_graph.child_meta(graph_id, run_id, policy)
+        )
+
+    final_job = fair_queue.create_deferred_job(queue, "finalize_project", graph_id)
+    abort_child = child(job_graph.POLICY_ABORT)
+    continue_child = child(job_graph.POLICY_CONTINUE)
+    job_graph.create(
+        graph_id,
+        run_id,
+        {
+            abort_child.id: job_graph.POLICY_ABORT,
+            continue_child.id: job_graph.POLICY_CONTINUE,
+        },
+        final_job,
+        on_abort="fail_project"
+    )
+
+    yield {
+        "id": graph_id,
+        "run": run_id,
+        "queue": queue,
+        "final": final_job,
+        "abort_child": abort_child,
+        "continue_child": continue_child,
+    }
+
+    job_graph.discard(graph_id, run_id)
+    for job in (final_job, abort_child, continue_child):
+        if Job.exists(job.id, connection=redis_conn):
+            job.delete()
+    queue.delete(delete_jobs=True)
+
+
+def _final_status(graph, redis_conn):
+    if not Job.exists(graph["final"].id, connection=redis_conn):
+        return None
+    return Job.fetch(graph["final"].id, connection=redis_conn).get_status()
+
+
+def _in_active(graph, redis_conn):
+    return redis_conn.zscore(job_graph.ACTIVE_KEY, graph["id"]) is not None
+
+
+def test_final_released_when_last_child_finishes(graph, redis_conn):
+    assert job_graph.child_finished(graph["abort_child"], job_graph.OUTCOME_OK) == "wait"
+    assert job_graph.get_status(graph["id"])["remaining"] == 1
+    assert _final_status(graph, redis_conn) == JobStatus.DEFERRED
+
+    assert job_graph.child_finished(graph["continue_child"], job_graph.OUTCOME_OK) == "release"
+    assert _final_status(graph, redis_conn) == JobStatus.QUEUED
+    assert job_graph.get_status(graph["id"])["state"] == job_graph.STATE_RELEASED
+    assert not _in_active(graph, redis_conn)
+
+
+def test_repeated_completion_counts_once(graph):
+    job_graph.child_finished(graph["abort_child"], job_graph.OUTCOME_OK)
+    assert job_graph.child_finished(graph["abort_child"], job_graph.OUTCOME_OK) == "duplicate"
+    assert job_graph.get_status(graph["id"])["remaining"] == 1
+
+
+def test_continue_failure_still_releases(graph, redis_conn):
+    job_graph.child_finished(graph["continue_child"], job_graph.OUTCOME_FAILED)
+    assert job_graph.child_finished(graph["abort_child"], job_graph.OUTCOME_OK) == "release"
+    assert job_graph.get_status(graph["id"])["failed"] == 1
+    assert _final_status(graph, redis_conn) == JobStatus.QUEUED
+
+
+def test_abort_waits_for_running_children(graph, redis_conn):
+    assert job_graph.child_finished(graph["abort_child"], job_graph.OUTCOME_FAILED) == "abort"
+    assert job_graph.get_status(graph["id"])["state"] == "aborting"
+    assert _final_status(graph, redis_conn) is None
+    assert graph["queue"].count == 0
+
+    # El hijo en curso termina: recién ahí se encola on_abort, con el run
+    assert job_graph.child_finished(graph["continue_child"], job_graph.OUTCOME_OK) == "abort_done"
+    assert job_graph.get_status(graph["id"])["state"] == job_graph.STATE_ABORTED
+    assert not _in_active(graph, redis_conn)
+    (on_abort,) = graph["queue"].get_jobs()
+    assert on_abort.args[:2] == ("fail_project", graph["id"])
+    assert on_abort.args[-1] == graph["run"]
+
+
+def test_children_of_another_run_are_ignored(graph):
+    stale = Job.fetch(graph["abort_child"].id, connection=graph["queue"].connection)
+    stale.meta = job_graph.child_meta(graph["id"], "otro.run", job_graph.POLICY_ABORT)
+    assert job_graph.child_finished(stale, job_graph.OUTCOME_FAILED) == "stale"
+    assert not job_graph.is_active(stale)
+    assert job_graph.get_status(graph["id"])["remaining"] == 2
+
+
+def test_sweep_counts_dead_children(graph, redis_conn):
+    graph["continue_child"].set_status(JobStatus.FAILED)
+    assert job_graph.sweep_graph(graph["id"]) == 1
+    status = job_graph.get_status(graph["id"])
+    assert status["remaining"] == 1
+    assert status["failed"] == 1
+    assert status["state"] == "waiting"
+
+
+def test_sweep_grace_for_children_not_enqueued_yet(graph, redis_conn, monkeypatch):
+    graph["abort_child"].delete()
+    assert job_graph.sweep_graph(graph["id"]) == 0
+    assert job_graph.get_status(graph["id"])["remaining"] == 2
+
+    monkeypatch.setattr(job_graph, "SWEEP_GRACE_SECONDS", 0)
+    assert job_graph.sweep_graph(graph["id"]) == 1
+    assert job_graph.get_status(graph["id"])["state"] == "aborting"
+
+
+def test_discard_only_drops_its_own_run(graph, redis_conn):
+    assert not job_graph.discard(graph["id"], "otro.run")
+    assert job_graph.get_status(graph["id"]) is not None
+
+    assert job_graph.discard(graph["id"], graph["run"])
+    assert job_graph.get_status(graph["id"]) is None
+    assert not _in_active(graph, redis_conn)
@@ -1,17 +1,24 @@
 import argparse
 import os
-import argparse
 import threading
 import time
+from datetime import timezone
 
 from redis import Redis
-from rq import Worker
+from rq import SimpleWorker, Worker, get_current_job
 from rq.utils import import_attribute
+from sqlalchemy import text
 
 from config import Config
 from logger import get_logger
+from services import job_graph
 from services.db_health import get_expected_head, schema_is_current
+from services.fair_queue import run_pump_loop
+from services.queue import LANE_BULK, LANES, is_bulk_queue, lane_queue_name
+from services.quotas import run_persist_loop
 from services.retention import run_cleanup_loop
+from services.session_activity import run_flush_loop
+from services.worker_pool import WorkerPool, parse_slot_spec, parse_weight_spec
 
 
 log = get_logger("worker")
@@ -21,17 +28,121 @@ ALLOWED_JOBS = {
     "prepare_project": "services.jobs.prepare_project.prepare_project_job",
     "transcribe_segment": "services.jobs.transcribe_segment.transcribe_segment_job",
     "stylize_photo": "services.jobs.stylize_photo_job.stylize_photo_job",
+    "stylize_project_photos": "services.jobs.stylize_photo_job.stylize_project_photos_job",
     "finalize_project": "services.jobs.finalize_project.finalize_project_job",
+    "fail_project": "services.jobs.finalize_project.fail_project_job",
 }
 
 
+# alias -> función ya importada; en modo preload se llena al arrancar
+_job_funcs = {}
+
+
+def _resolve_job(alias):
+    func = _job_funcs.get(alias)
+    if func is None:
+        func = import_attribute(ALLOWED_JOBS[alias])
+        _job_funcs[alias] = func
+    return func
+
+
 def dispatch(alias, *args, **kwargs):
-    target = ALLOWED_JOBS.get(alias)
-    if not target:
+    if alias not in ALLOWED_JOBS:
         log.warning("Alias de job no permitido: %s", alias)
         return None
-    func = import_attribute(target)
-    return func(*args, **kwargs)
+
+    resolve_start = time.perf_counter()
+    func = _resolve_job(alias)
+    resolve_ms = (time.perf_counter() - resolve_start) * 1000
+
+    # Lo que pasó entre que RQ marcó el job como iniciado y que la función
+    # arranca (resolución, imports perezosos). En fork RQ marca started_at ya
+    # dentro del work-horse: el costo del fork y de reabrir conexiones cae en
+    # el tiempo del job, que es la cifra a comparar entre modos (ver README).
+    setup_ms = None
+    job = get_current_job()
+    if job and job.started_at:
+        started_at = job.started_at
+        if started_at.tzinfo is None:
+            started_at = started_at.replace(tzinfo=timezone.utc)
+        setup_ms = max(0.0, time.time() - started_at.timestamp()) * 1000
+
+    # Solo los hijos de un grafo van a Redis; is_child mira la meta del job
+    graph_child = job_graph.is_child(job)
+
+    # Hijo de un grafo que abortó (o de un intento anterior): no gastar en él
+    if graph_child and not job_graph.is_active(job):
+        log.info("Job %s (%s) omitido: su grafo ya no está activo", alias, job.id)
+        job_graph.child_finished(job, job_graph.OUTCOME_CANCELLED)
+        return None
+
+    run_start = time.perf_counter()
+    try:
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            # Sin reintentos pendientes el job ya no va a terminar bien
+            if graph_child and not job.retries_left:
+                job_graph.child_finished(job, job_graph.OUTCOME_FAILED)
+            raise
+        if graph_child:
+            job_graph.child_finished(job, job_graph.OUTCOME_OK)
+        return result
+    finally:
+        log.info(
+            "Job %s: %.0f ms (setup %s ms, resolución %.2f ms)",
+            alias,
+            (time.perf_counter() - run_start) * 1000,
+            f"{setup_ms:.1f}" if setup_ms is not None else "?",
+            resolve_ms
+        )
+
+
+def _timed(label, fn):
+    start = time.perf_counter()
+    try:
+        fn()
+    except Exception as e:
+        log.warning("Warm-up %s falló: %s", label, e)
+        return
+    log.info("Warm-up %s: %.1f ms", label, (time.perf_counter() - start) * 1000)
+
+
+def preload_jobs():
+    for alias in ALLOWED_JOBS:
+        _resolve_job(alias)
+
+
+def warm_up(redis_conn):
+    """
+    Deja listo en este proceso todo lo que los jobs crean de forma perezosa.
+    Solo tiene sentido sin fork: en un hijo forkeado se perdería igual.
+    """
+    from extensions import engine
+    from helpers import load_prompt
+    from services.lm.openai_client import get_openai_client
+    from services.media.gemini_client import get_gemini_client
+    from services.storage import get_audio_storage
+
+    def warm_db():
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+    def warm_prompts():
+        prompts_dir = os.path.join(os.path.dirname(__file__), "prompts")
+        for name in os.listdir(prompts_dir):
+            if name.endswith(".txt"):
+                load_prompt(name[:-4])
+
+    total_start = time.perf_counter()
+    _timed("jobs", preload_jobs)
+    _timed("postgres", warm_db)
+    _timed("redis", redis_conn.ping)
+    _timed("openai", get_openai_client)
+    _timed("gemini", get_gemini_client)
+    _timed("storage", get_audio_storage)
+    _timed("prompts", warm_prompts)
+    log.info("Warm-up total: %.1f ms", (time.perf_counter() - total_start) * 1000)
 
 
 def parse_args():
@@ -41,6 +152,36 @@ def parse_args():
         help="Comma separated list of queue names to listen on",
         default=""
     )
+    parser.add_argument(
+        "--slots",
+        help="Slots concurrentes por cola en este proceso, ej. "
+             "transcribe=8,photos=4,llm=2 (implica modo preload)",
+        default=Config.WORKER_SLOTS
+    )
+    parser.add_argument(
+        "--weights",
+        help="Pesos para los slots compartidos, ej. transcribe=4,llm=1. "
+             "Por defecto, la cantidad de slots de cada cola",
+        default=""
+    )
+    parser.add_argument(
+        "--shared",
+        type=int,
+        default=0,
+        help="Slots extra que toman de todas las colas de --slots según peso"
+    )
+    parser.add_argument(
+        "--no-bulk",
+        action="store_true",
+        help="No escuchar las colas *_bulk de las colas indicadas"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["fork", "preload"],
+        default=Config.WORKER_MODE,
+        help="fork: un work-horse por job (default de RQ). "
+             "preload: sin fork, con clientes y jobs precargados"
+    )
     return parser.parse_args()
 
 
@@ -69,16 +210,58 @@ def main():
         daemon=True
     )
     cleanup_thread.start()
+    session_flush_thread = threading.Thread(
+        target=run_flush_loop,
+        daemon=True
+    )
+    session_flush_thread.start()
+    quota_persist_thread = threading.Thread(
+        target=run_persist_loop,
+        daemon=True
+    )
+    quota_persist_thread.start()
+    fair_pump_thread = threading.Thread(
+        target=run_pump_loop,
+        args=([lane_queue_name(Config.RQ_TRANSCRIBE_QUEUE, lane) for lane in LANES],),
+        daemon=True
+    )
+    fair_pump_thread.start()
+    graph_sweep_thread = threading.Thread(
+        target=job_graph.run_sweep_loop,
+        daemon=True
+    )
+    graph_sweep_thread.start()
+    if args.slots:
+        slots = parse_slot_spec(args.slots)
+        weights = parse_weight_spec(args.weights)
+        warm_up(redis_conn)
+        pool = WorkerPool(redis_conn, slots, shared=args.shared, weights=weights or None)
+        pool.run(report_interval=Config.WORKER_REPORT_INTERVAL)
+        return
+
     queues = [q.strip() for q in args.queues.split(",") if q.strip()]
     if not queues:
         queues = [
-            Config.RQ_AUDIO_QUEUE,
+            Config.RQ_PREPARE_QUEUE,
             Config.RQ_TRANSCRIBE_QUEUE,
             Config.RQ_PHOTO_QUEUE,
             Config.RQ_LLM_QUEUE
         ]
-    log.info("Worker listening on queues: %s", ", ".join(queues))
-    worker = Worker(queues, connection=redis_conn, name=None)
+    if not args.no_bulk:
+        # RQ atiende las colas en orden: primero todas las altas, luego bulk
+        queues += [
+            lane_queue_name(queue, LANE_BULK)
+            for queue in queues
+            if not is_bulk_queue(queue)
+        ]
+    log.info("Worker listening on queues: %s (mode=%s)", ", ".join(queues), args.mode)
+    if args.mode == "preload":
+        warm_up(redis_conn)
+        worker = SimpleWorker(queues, connection=redis_conn, name=None)
+    else:
+        # Los hijos heredan los módulos ya importados
+        preload_jobs()
+        worker = Worker(queues, connection=redis_conn, name=None)
     worker.work()
 
 
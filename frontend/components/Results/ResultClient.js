@@ -15,6 +15,8 @@ import DeleteProjectModal from "@/components/Projects/DeleteProjectModal";
 import ExportDropdown from "@/components/Results/ExportDropdown";
 
 const POLL_INTERVAL = 2000;
+// Debe coincidir con PREVIEW_STREAM_ERROR_MARKER en backend/routes/jobs.py
+const PREVIEW_ERROR_MARKER = "<!--preview-error-->";
 
 export default function ResultClient({
   projectId,
@@ -134,16 +136,55 @@ export default function ResultClient({
       setPreviewLoading(true);
       setPreviewError("");
       try {
-        const res = await fetch(`/api/project/${projectId}/preview`, {
+        const res = await fetch(`/api/project/${projectId}/preview/stream`, {
           credentials: "include"
         });
-        const data = await res.json();
-        if (!active) return;
-        if (data.ok) {
-          setPreviewHtml(data.html || "");
-        } else {
+        if (!res.ok || !res.body) {
+          const data = await res.json().catch(() => ({}));
+          if (!active) return;
           setPreviewError(data.error || "Error cargando preview");
+          return;
+        }
+        // El backend manda un elemento HTML completo por línea. Juntamos los
+        // trozos y pintamos a lo más una vez por frame, hasta el último salto
+        // de línea recibido.
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        const chunks = [];
+        let tail = "";
+        let frame = null;
+        const flush = () => {
+          frame = null;
+          if (!active) return;
+          setPreviewHtml(chunks.join(""));
+          setPreviewLoading(false);
+        };
+        try {
+          while (true) {
+            const { done, value } = await reader.read();
+            if (!active) {
+              reader.cancel();
+              return;
+            }
+            if (done) break;
+            tail += decoder.decode(value, { stream: true });
+            const cut = tail.lastIndexOf("\n");
+            if (cut >= 0) {
+              chunks.push(tail.slice(0, cut + 1));
+              tail = tail.slice(cut + 1);
+              if (frame === null) frame = requestAnimationFrame(flush);
+            }
+          }
+        } finally {
+          if (frame !== null) cancelAnimationFrame(frame);
+        }
+        chunks.push(tail + decoder.decode());
+        const html = chunks.join("");
+        if (html.includes(PREVIEW_ERROR_MARKER)) {
+          setPreviewError("Error cargando preview");
+          return;
         }
+        setPreviewHtml(html);
       } catch (err) {
         if (!active) return;
         setPreviewError("Error cargando preview");
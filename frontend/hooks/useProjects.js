@@ -13,6 +13,7 @@ export function useProjects() {
   const [status, setStatus] = useState("");
   const pollingRef = useRef(null);
   const offsetRef = useRef(0);
+  const cursorRef = useRef(null);
   const initializedRef = useRef(false);
 
   const load = useCallback(
@@ -22,6 +23,7 @@ export function useProjects() {
       const silent = options.silent === true;
       const nextLimit = options.limit ?? DEFAULT_LIMIT;
       const nextOffset = reset ? 0 : offsetRef.current;
+      const nextCursor = reset ? null : cursorRef.current;
       const nextQuery = options.query ?? query;
       const nextStatus = options.status ?? status;
       if (!silent) setLoading(true);
@@ -30,6 +32,7 @@ export function useProjects() {
           limit: String(nextLimit),
           offset: String(nextOffset)
         });
+        if (nextCursor) params.append("cursor", nextCursor);
         if (nextQuery) params.append("q", nextQuery);
         if (nextStatus) params.append("status", nextStatus);
 
@@ -48,6 +51,7 @@ export function useProjects() {
         }
         const newOffset = nextOffset + nextLimit;
         offsetRef.current = newOffset;
+        cursorRef.current = data.next_cursor || null;
         setOffset(newOffset);
       } finally {
         if (!silent) setLoading(false);
@@ -93,6 +97,7 @@ export function useProjects() {
     setQuery(nextQuery);
     setStatus(nextStatus);
     setOffset(0);
+    cursorRef.current = null;
     setItems([]);
     setTotal(0);
   }, []);